@@ -0,0 +1,266 @@
+"""Pool of the Docker daemons the runs of an evaluation are spread over."""
+import asyncio
+import logging
+import os
+from pathlib import Path
+from typing import Any, Awaitable, Callable
+
+import aiodocker
+from aiodocker.exceptions import DockerError
+from aiohttp import ClientConnectionError, ClientError, ClientSession, ClientTimeout, TCPConnector, UnixConnector
+
+from mindforge_harness.docker.docker_utils import get_from_existing_image
+from mindforge_harness.docker.resources import get_host_capacity, get_resource_limits
+
+MF_DOCKER_HOSTS = os.environ.get("MF_DOCKER_HOSTS", "")
+MF_BACKEND_MAX_CONNECTIONS = int(os.environ.get("MF_BACKEND_MAX_CONNECTIONS", "32"))
+LOCAL_DOCKER_SOCKET = "/var/run/docker.sock"
+# Seconds a daemon has to answer a probe before it is considered down
+PROBE_TIMEOUT = 10
+
+def parse_docker_hosts(docker_hosts: str, default_capacity: int) -> list[tuple[str, int]]:
+    """Parse comma-separated Docker endpoints with an optional capacity, e.g. "unix:///var/run/docker.sock=8,tcp://10.0.0.2:2375"."""
+    hosts = []
+    for host in docker_hosts.split(","):
+        host = host.strip()
+        if not host:
+            continue
+        url, sep, capacity = host.rpartition("=")
+        hosts.append((url, int(capacity)) if sep and capacity.isdigit() else (host, default_capacity))
+    return hosts
+
+def is_backend_failure(error: BaseException) -> bool:
+    """Whether an error may come from the daemon being unreachable rather than from the run itself.
+
+    aiodocker raises the connection errors of its requests as a DockerError of status 900, and lets timeouts through.
+    """
+    if isinstance(error, DockerError):
+        return error.status == 900
+    return isinstance(error, (ClientConnectionError, ConnectionError, asyncio.TimeoutError))
+
+class DockerBackend:
+    """A Docker daemon with its own client, connection pool and number of concurrent runs."""
+
+    def __init__(self, url: str, capacity: int, client: aiodocker.Docker, session: ClientSession=None, remote: bool=False):
+        """Wrap the client of the daemon at `url`, running at most `capacity` runs at a time.
+
+        Args:
+            session: The HTTP session of the client, closed with the backend.
+            remote: Whether the daemon does not share the filesystem of this host, so run files cannot be bind mounted.
+        """
+        self.url = url
+        self.capacity = capacity
+        self.client = client
+        self.session = session
+        self.remote = remote
+        self.active = 0
+        self.healthy = True
+        # CPUs and memory bytes of the host, read on the first run with a resource request
+        self.cpus: float = None
+        self.memory: int = None
+        self.used_cpus = 0.0
+        self.used_memory = 0
+        self.stats = {"runs": 0, "rerouted": 0, "image_hits": 0}
+
+    @classmethod
+    def connect(cls, url: str, capacity: int, timeout: int, logger: logging.Logger) -> "DockerBackend":
+        """Connect to the daemon at `url`, or to the local daemon if `url` is None."""
+        client_timeout = ClientTimeout(total=timeout, sock_connect=30) # sock_connect=30 is the default value
+        if url is None:
+            if os.path.exists(LOCAL_DOCKER_SOCKET) and Path(LOCAL_DOCKER_SOCKET).is_socket():
+                session = ClientSession(connector=UnixConnector(LOCAL_DOCKER_SOCKET), timeout=client_timeout)
+                return cls("local", capacity, aiodocker.Docker(session=session), session)
+            logger.debug("Timeout for building is not applied.")
+            return cls("local", capacity, aiodocker.Docker())
+
+        if url.startswith("unix://"):
+            connector = UnixConnector(url[len("unix://"):], limit=MF_BACKEND_MAX_CONNECTIONS)
+        elif url.startswith(("tcp://", "http://", "https://")):
+            connector = TCPConnector(limit=MF_BACKEND_MAX_CONNECTIONS)
+        else:
+            # e.g. ssh://, with the connector of aiodocker
+            return cls(url, capacity, aiodocker.Docker(url=url), remote=True)
+        session = ClientSession(connector=connector, timeout=client_timeout)
+        return cls(url, capacity, aiodocker.Docker(url=url, session=session), session, remote=not url.startswith("unix://"))
+
+    async def load_capacity(self, logger: logging.Logger) -> None:
+        """Read the CPUs and memory of the host once."""
+        if self.cpus is None:
+            self.cpus, self.memory = await get_host_capacity(self.client, logger)
+            logger.info(f"Docker host {self.url} admits runs up to {self.cpus:g} CPUs and {self.memory / 1024 ** 3:.1f} GiB.")
+
+    def clamp(self, request: tuple[float, int]) -> tuple[float, int]:
+        """Reduce a request to the capacity of the host, so a run larger than the host runs alone instead of never."""
+        cpus, memory = request
+        return min(cpus, self.cpus), min(memory, self.memory)
+
+    def resource_limits(self, request: tuple[float, int]) -> dict:
+        """Get the container host config limiting a run to its request, reduced to the capacity of the host as when it was admitted."""
+        return get_resource_limits(self.clamp(request))
+
+    def fits(self, request: tuple[float, int]) -> bool:
+        """Whether a run slot is free, and the CPUs and memory of a request, if any, too."""
+        if self.active >= self.capacity:
+            return False
+        if request is None:
+            return True
+        cpus, memory = self.clamp(request)
+        return self.used_cpus + cpus <= self.cpus + 1e-9 and self.used_memory + memory <= self.memory
+
+    def load(self) -> float:
+        """The used fraction of the most used of the run slots, the CPUs and the memory."""
+        if self.cpus is None:
+            return self.active / self.capacity
+        return max(self.active / self.capacity, self.used_cpus / self.cpus, self.used_memory / self.memory)
+
+    async def has_image(self, image_name: str) -> bool:
+        """Whether the daemon already holds an image."""
+        try:
+            return bool(await get_from_existing_image(self.client, image_name))
+        except (ClientError, DockerError, OSError):
+            return False
+
+    async def probe(self) -> bool:
+        """Whether the daemon answers."""
+        try:
+            await asyncio.wait_for(self.client.version(), timeout=PROBE_TIMEOUT)
+            return True
+        except (ClientError, DockerError, OSError, asyncio.TimeoutError):
+            return False
+
+    async def close(self) -> None:
+        """Close the client and its session."""
+        await self.client.close()
+        if self.session:
+            await self.session.close()
+
+class BackendPool:
+    """Spread runs over Docker daemons, each running at most its capacity at a time.
+
+    A run goes to a daemon that already holds its image when one has a free slot, and otherwise to the
+    least loaded daemon, which pulls or builds the image itself. When a daemon stops answering, it is
+    drained, i.e. gets no new runs, and the runs that failed on it are rerouted to the other daemons.
+    """
+
+    def __init__(self, backends: list[DockerBackend]):
+        """Create a pool of `backends`, the first one being the primary daemon, e.g. for the builds planned upfront."""
+        self.backends = backends
+        self.condition = asyncio.Condition()
+
+    @classmethod
+    def from_hosts(cls, docker_hosts: str, capacity: int, timeout: int, logger: logging.Logger) -> "BackendPool":
+        """Connect to comma-separated Docker endpoints, or to the local daemon if there is none.
+
+        Args:
+            docker_hosts: The endpoints, each optionally followed by "=<capacity>".
+            capacity: The capacity of the endpoints without one.
+            timeout: The timeout of the requests to the daemons.
+        """
+        hosts = parse_docker_hosts(docker_hosts or "", capacity)
+        if not hosts:
+            return cls([DockerBackend.connect(None, capacity, timeout, logger)])
+        return cls([DockerBackend.connect(url, host_capacity, timeout, logger) for url, host_capacity in hosts])
+
+    @property
+    def primary(self) -> DockerBackend:
+        """The first daemon."""
+        return self.backends[0]
+
+    async def acquire(
+        self,
+        image_name: str,
+        prefer: DockerBackend=None,
+        request: tuple[float, int]=None,
+        logger: logging.Logger=None,
+    ) -> DockerBackend:
+        """Take a run slot, on `prefer` if it is free, else on a daemon holding `image_name`, else on the least loaded one.
+
+        With a `request` of CPUs and memory bytes, the run is only admitted on a daemon whose host has them free.
+        Smaller runs may go first while a larger one waits for enough resources to be released.
+        """
+        if request is not None:
+            await asyncio.gather(*(backend.load_capacity(logger or logging.getLogger(__name__)) for backend in self.backends if backend.healthy))
+        holding = set()
+        if len(self.backends) > 1 and not (prefer and prefer.healthy):
+            healthy = [backend for backend in self.backends if backend.healthy]
+            has_images = await asyncio.gather(*(backend.has_image(image_name) for backend in healthy))
+            holding = {backend.url for backend, has_image in zip(healthy, has_images) if has_image}
+        async with self.condition:
+            while True:
+                healthy = [backend for backend in self.backends if backend.healthy]
+                if not healthy:
+                    raise Exception("No Docker daemon is available, every one of them failed.")
+                free = [backend for backend in healthy if backend.fits(request)]
+                if free:
+                    if prefer in free:
+                        backend = prefer
+                    else:
+                        candidates = [backend for backend in free if backend.url in holding] or free
+                        backend = min(candidates, key=lambda backend: backend.load())
+                    backend.active += 1
+                    if request is not None:
+                        cpus, memory = backend.clamp(request)
+                        backend.used_cpus += cpus
+                        backend.used_memory += memory
+                    backend.stats["runs"] += 1
+                    backend.stats["image_hits"] += backend.url in holding
+                    return backend
+                await self.condition.wait()
+
+    async def release(self, backend: DockerBackend, request: tuple[float, int]=None) -> None:
+        """Give back a run slot, and the resources of its request."""
+        async with self.condition:
+            backend.active -= 1
+            if request is not None:
+                cpus, memory = backend.clamp(request)
+                backend.used_cpus -= cpus
+                backend.used_memory -= memory
+            self.condition.notify_all()
+
+    async def drain(self, backend: DockerBackend, logger: logging.Logger) -> None:
+        """Stop sending runs to a daemon that does not answer anymore."""
+        async with self.condition:
+            if backend.healthy:
+                backend.healthy = False
+                logger.warning(f"Docker daemon {backend.url} does not answer, draining it.")
+            # Waiters may have to fail now that there is one daemon less
+            self.condition.notify_all()
+
+    async def run(
+        self,
+        image_name: str,
+        func: Callable[[DockerBackend], Awaitable[Any]],
+        logger: logging.Logger,
+        prefer: DockerBackend=None,
+        request: tuple[float, int]=None,
+    ) -> tuple[DockerBackend, Any]:
+        """Run `func` on a daemon, rerouting it to another daemon if that one fails, and return the daemon and the result.
+
+        With a `request` of CPUs and memory bytes, `func` only runs once a daemon has them free.
+        """
+        for attempt in range(len(self.backends)):
+            backend = await self.acquire(image_name, prefer, request, logger)
+            try:
+                return backend, await func(backend)
+            except Exception as e:
+                if not is_backend_failure(e) or attempt == len(self.backends) - 1 or await backend.probe():
+                    raise e
+                await self.drain(backend, logger)
+                backend.stats["rerouted"] += 1
+                logger.warning(f"Rerouting a run of {image_name} from Docker daemon {backend.url}: {e}")
+            finally:
+                await self.release(backend, request)
+
+    def report(self) -> dict[str, dict]:
+        """The runs of every daemon."""
+        return {backend.url: {**backend.stats, "healthy": backend.healthy} for backend in self.backends}
+
+    async def close(self) -> None:
+        """Close the clients of all daemons."""
+        await asyncio.gather(*(backend.close() for backend in self.backends))
+
+    async def __aenter__(self) -> "BackendPool":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.close()
@@ -0,0 +1,90 @@
+"""Persistent record of the image builds that failed, so known-bad builds are not retried by every run."""
+import os
+import time
+from uuid import uuid4
+
+import orjson
+
+BUILD_FAILURE_CACHE_FILE = os.environ.get("BUILD_FAILURE_CACHE_FILE", "build_failures.json")
+MF_BUILD_FAILURE_TTL = float(os.environ.get("MF_BUILD_FAILURE_TTL", str(24 * 3600)))
+MF_RETRY_FAILED_BUILDS = os.environ.get("MF_RETRY_FAILED_BUILDS", "false").lower() in ("true", "1")
+
+class BuildFailureCache:
+    """Build failures keyed by image name, with the spec hash, the error and when they expire.
+
+    A failure only matches the exact spec (and Dockerfile templates) that failed, through the full spec
+    hash, and is forgotten after `ttl` seconds or once the image builds. With `retry`, failures are
+    ignored and every build is attempted again. Several runs may share the file, so only the entries a
+    run recorded or cleared are written over the current content of the file.
+    """
+
+    def __init__(self, path: str=BUILD_FAILURE_CACHE_FILE, ttl: float=MF_BUILD_FAILURE_TTL, retry: bool=MF_RETRY_FAILED_BUILDS):
+        """Create a cache persisted in `path` whose entries expire after `ttl` seconds."""
+        self.path = path
+        self.ttl = ttl
+        self.retry = retry
+        self.failures: dict[str, dict] = None
+        self._changes: dict[str, dict] = {}  # Entries recorded, or cleared (None), since the last save
+
+    def read(self) -> dict[str, dict]:
+        """Read the failures persisted in the file."""
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "rb") as f:
+            return orjson.loads(f.read())
+
+    def load(self) -> dict[str, dict]:
+        """Load the persisted failures once."""
+        if self.failures is None:
+            self.failures = self.read()
+        return self.failures
+
+    def save(self) -> None:
+        """Merge the changes of this run into the persisted failures, atomically."""
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        failures = self.read()
+        for image_name, failure in self._changes.items():
+            if failure is None:
+                failures.pop(image_name, None)
+            else:
+                failures[image_name] = failure
+        tmp_path = f"{self.path}.{uuid4()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(failures, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_path, self.path)
+        self.failures = failures
+        self._changes = {}
+
+    def get(self, image_name: str, spec_hash: str="") -> dict:
+        """Get the unexpired failure of an image built from `spec_hash`, or None."""
+        if self.retry:
+            return None
+        failure = self.load().get(image_name)
+        if not failure or failure["spec_hash"] != spec_hash:
+            return None
+        if time.time() > failure["time"] + failure["ttl"]:
+            self.clear(image_name)
+            return None
+        return failure
+
+    def record(self, image_name: str, spec_hash: str, error: str) -> None:
+        """Record that the image failed to build."""
+        failure = {"spec_hash": spec_hash, "error": error, "time": time.time(), "ttl": self.ttl}
+        self.load()[image_name] = self._changes[image_name] = failure
+        self.save()
+
+    def clear(self, image_name: str) -> None:
+        """Forget the failure of an image, e.g. after a successful build."""
+        if self.load().pop(image_name, None) is not None:
+            self._changes[image_name] = None
+            self.save()
+
+    def describe(self, image_name: str, failure: dict) -> str:
+        """Error message of a build skipped because of a known failure."""
+        age = (time.time() - failure["time"]) / 60
+        expires = (failure["time"] + failure["ttl"] - time.time()) / 60
+        return (f"Image {image_name} failed to build {age:.0f} minutes ago, skipping the build for another "
+                f"{expires:.0f} minutes. Use --retry_failed_builds to force a retry. Error: {failure['error']}")
+
+GLOBAL_BUILD_FAILURES = BuildFailureCache()
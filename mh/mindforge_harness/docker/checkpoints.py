@@ -0,0 +1,92 @@
+"""Post-install checkpoint images, derived from a spec image after the checkout and install of a commit."""
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from uuid import uuid4
+
+import aiodocker
+
+from mindforge_harness.docker.docker_utils import get_from_existing_image, get_image_index, normalize_image_tag
+from mindforge_harness.docker.image_builder import image_build_locks
+from mindforge_harness.docker.image_gc import CHECKPOINT_TAG, GLOBAL_IMAGE_GC
+
+MF_CHECKPOINT_INSTALLS = os.environ.get("MF_CHECKPOINT_INSTALLS", "false").lower() in ["true", "1"]
+
+def get_checkpoint_image_name(image_name: str, base_commit: str, setup_script: str) -> str:
+    """Get the name of the checkpoint of a spec image, keyed by the commit and the setup script holding the install."""
+    repository = normalize_image_tag(image_name).rpartition(":")[0]
+    checkpoint_hash = hashlib.sha256(f"{repository}\0{base_commit}\0{setup_script}".encode()).hexdigest()
+    return f"{repository}{CHECKPOINT_TAG}{checkpoint_hash[:12]}"
+
+async def get_or_create_checkpoint(
+    client: aiodocker.Docker,
+    image_name: str,
+    base_commit: str,
+    setup_script: str,
+    environment: list[str],
+    host_config: dict,
+    timeout: float,
+    logger: logging.Logger,
+) -> str:
+    """Get the checkpoint image of a spec image at a commit, running the setup script and committing it if it does not exist.
+
+    The checkpoint is protected from the garbage collector, the caller releases it with `GLOBAL_IMAGE_GC.release` once its run is over.
+    """
+    checkpoint_name = get_checkpoint_image_name(image_name, base_commit, setup_script)
+    GLOBAL_IMAGE_GC.protect(checkpoint_name)
+    try:
+        return await _get_or_create_checkpoint(client, image_name, checkpoint_name, setup_script, environment, host_config, timeout, logger)
+    except BaseException as e:
+        GLOBAL_IMAGE_GC.release(checkpoint_name)
+        raise e
+
+async def _get_or_create_checkpoint(
+    client: aiodocker.Docker,
+    image_name: str,
+    checkpoint_name: str,
+    setup_script: str,
+    environment: list[str],
+    host_config: dict,
+    timeout: float,
+    logger: logging.Logger,
+) -> str:
+    """Get or create the checkpoint `checkpoint_name` of a spec image."""
+    async with image_build_locks[checkpoint_name]:
+        if await get_from_existing_image(client, checkpoint_name):
+            GLOBAL_IMAGE_GC.touch(checkpoint_name)
+            logger.info(f"Using checkpoint image {checkpoint_name}.")
+            return checkpoint_name
+
+        setup_start = time.perf_counter()
+        config = {
+            "Image": image_name,
+            "HostConfig": {"Privileged": False, **(host_config or {})},
+            "Cmd": ["bash", "-c", setup_script],
+            "Env": environment,
+            "Tty": True,
+        }
+        container_name = f"{checkpoint_name.replace('/', '-')}-{uuid4()}"
+        container = await client.containers.create_or_replace(name=container_name, config=config)
+        try:
+            await container.start()
+            try:
+                result = await asyncio.wait_for(container.wait(), timeout=timeout)
+            except TimeoutError:
+                raise TimeoutError(f"Checkpoint setup of {checkpoint_name} timed out after {timeout} seconds.")
+            logger.debug("\n".join(await container.log(stdout=True, stderr=True)))
+            if result.get("StatusCode"):
+                raise Exception(f"Checkpoint setup of {checkpoint_name} exited with code {result['StatusCode']}.")
+            # The setup command must not become the command of the derived image
+            await container.commit(repository=checkpoint_name, tag="latest", changes=['CMD ["/bin/bash"]'])
+        finally:
+            try:
+                await container.delete(force=True)
+            except Exception as e:
+                logger.error(f"Failed to delete container: {e}")
+
+        get_image_index(client).add(checkpoint_name)
+        GLOBAL_IMAGE_GC.touch(checkpoint_name)
+        logger.info(f"Created checkpoint image {checkpoint_name} in {time.perf_counter() - setup_start:.2f} seconds.")
+        return checkpoint_name
@@ -13,7 +13,9 @@ ENV http_proxy={http_proxy}
 ENV https_proxy={https_proxy}
 """
 
-DOCKER_FILE_R2E = """
+# Base images hold everything that does not depend on a spec: apt, uv and certificates.
+# They are built once per (python version, template, green zone) and spec images are built FROM them.
+BASE_DOCKER_FILE_R2E = """
 FROM ubuntu:22.04
 
 RUN apt-get update && apt-get install -y ca-certificates
@@ -23,7 +25,6 @@ RUN apt-get update && apt-get install -y ca-certificates
 
 RUN echo "tzdata tzdata/Areas select Asia" | debconf-set-selections && echo "tzdata tzdata/Zones/Asia select Hong_Kong" | debconf-set-selections
 
-ARG OLD_COMMIT
 RUN apt-get update -y && apt-get upgrade -y
 RUN apt-get install ca-certificates -y
 
@@ -38,8 +39,14 @@ RUN curl -LsSf https://astral.sh/uv/install.sh | sh
 
 ENV PATH="/root/.cargo/bin:${{PATH}}"
 ENV PATH="/root/.local/bin:${{PATH}}"
+"""
 
-RUN git clone https://github.com/pandas-dev/pandas.git testbed
+# The build context holds the repository checked out at the base commit, so the build needs no clone
+DOCKER_FILE_R2E = """
+FROM {base_image}
+{wheelhouse}
+
+COPY {repo_path} /testbed
 
 COPY run_tests.sh /testbed/run_tests.sh
 
@@ -47,8 +54,6 @@ COPY install.sh /testbed/install.sh
 
 WORKDIR /testbed
 
-RUN git checkout $OLD_COMMIT
-
 RUN git status
 
 RUN bash install.sh
@@ -62,7 +67,7 @@ ENV PATH="$VIRTUAL_ENV/bin:$PATH"
 COPY r2e_tests /r2e_tests
 """
 
-DOCKER_FILE = """
+BASE_DOCKER_FILE = """
 FROM python:{python}-slim
 
 # Certificates
@@ -82,36 +87,109 @@ RUN apt-get update && apt-get install -y --no-install-recommends \
 
 # Set working directory
 WORKDIR $WORKSPACE
+"""
+
+DOCKER_FILE = """
+FROM {base_image}
 
 # Copy necessary files
 COPY ./patch_codes.py /app/
 COPY {repo_path} $WORKSPACE
+{wheelhouse}
 
 # Run pre-installation and installation commands in a single step
 RUN {pre_install} && {pip_install}
 RUN uv pip install --system --no-cache-dir pytest pytest-json-report pytest-timeout
 """
 
+# (base Dockerfile, spec Dockerfile) per template
+DOCKER_TEMPLATES = {
+    "r2e": (BASE_DOCKER_FILE_R2E, DOCKER_FILE_R2E),
+    "slim": (BASE_DOCKER_FILE, DOCKER_FILE),
+}
+DOCKER_TEMPLATE = "r2e"
+
+# Phase markers of the evaluation scripts, "<phase> start <epoch seconds>" and "<phase> end <epoch seconds> <exit code>"
+PHASE_MARKERS = """phase_start() {{ echo "$1 start $(date +%s.%N)" >> /results/phases.txt; }}
+phase_end() {{ echo "$1 end $(date +%s.%N) $2" >> /results/phases.txt; }}
+"""
+
 EVAL_SCRIPT = """#!/bin/bash
 
+""" + PHASE_MARKERS + """
 set -x
 
 # Patch pytest-json-report
 sed -i '230s/.*/            root=str(session.fspath if "fspath" in session.__dict__ else session.path),/' /usr/local/lib/{pyversion}/site-packages/pytest_jsonreport/plugin.py
 
+phase_start checkout
 time git checkout $GIT_COMMIT
+phase_end checkout $?
 
+phase_start patch
 python /app/patch_codes.py
+phase_end patch $?
 
+phase_start install
 time {install} > /results/install_log.txt 2> /results/install_log.txt
+phase_end install $?
+
+phase_start eval_commands
+eval_rc=0
+{eval_commands}
+phase_end eval_commands $eval_rc
+
+# Some debug info
+ls
+cd /workspace
+
+phase_start tests
+time {test_cmd} > /results/test_log.txt 2> /results/test_err.txt
+phase_end tests $?
+"""
+
+# Post-install checkpoints split the evaluation script: the setup runs once per (image, commit, install)
+# and is committed into a derived image, the runs from that image only patch and test.
+# The install runs before the patches here, so it must not depend on the patched sources.
+CHECKPOINT_SCRIPT = """#!/bin/bash
+
+set -x
+
+# Patch pytest-json-report
+sed -i '230s/.*/            root=str(session.fspath if "fspath" in session.__dict__ else session.path),/' /usr/local/lib/{pyversion}/site-packages/pytest_jsonreport/plugin.py
+
+# A failed checkout or install must not be committed and reused by every later run
+time git checkout $GIT_COMMIT || exit $?
+
+time {install} > /checkpoint_install_log.txt 2> /checkpoint_install_log.txt || exit $?
+
+exit 0
+"""
+
+# The checkout and install phases ran in the setup, they are not part of the runs
+EVAL_SCRIPT_FROM_CHECKPOINT = """#!/bin/bash
+
+""" + PHASE_MARKERS + """
+set -x
+
+cp /checkpoint_install_log.txt /results/install_log.txt
+
+phase_start patch
+python /app/patch_codes.py
+phase_end patch $?
 
+phase_start eval_commands
+eval_rc=0
 {eval_commands}
+phase_end eval_commands $eval_rc
 
 # Some debug info
 ls
 cd /workspace
 
+phase_start tests
 time {test_cmd} > /results/test_log.txt 2> /results/test_err.txt
+phase_end tests $?
 """
 
 PATCH_CODE_PY = """import subprocess
@@ -182,6 +260,5 @@ if __name__ == "__main__":
     print(f"🕒 Patching completed in {time.perf_counter() - start_time:.2f} seconds")
 """
 
-# Hash the Dockerfile and patch code to generate a unique identifier for the Docker image
-# DOCKER_IMAGE_COMBINED = (DOCKER_FILE + GREEN_ZONE_CERTIFICATES + PATCH_CODE_PY).encode()
-DOCKER_IMAGE_COMBINED = (DOCKER_FILE_R2E + GREEN_ZONE_CERTIFICATES + PATCH_CODE_PY).encode()
\ No newline at end of file
+# Hash the Dockerfiles and patch code to generate a unique identifier for the Docker image
+DOCKER_IMAGE_COMBINED = (''.join(DOCKER_TEMPLATES[DOCKER_TEMPLATE]) + GREEN_ZONE_CERTIFICATES + PATCH_CODE_PY).encode()
\ No newline at end of file
@@ -0,0 +1,229 @@
+"""Pool of long-lived containers per image, reset between the runs they serve."""
+import asyncio
+import io
+import logging
+import os
+import tarfile
+import time
+from collections import defaultdict
+from uuid import uuid4
+
+import aiodocker
+import orjson
+from aiodocker.exceptions import DockerError
+
+MF_CONTAINER_POOL = os.environ.get("MF_CONTAINER_POOL", "false").lower() in ["true", "1"]
+MF_CONTAINER_MAX_REUSE = int(os.environ.get("MF_CONTAINER_MAX_REUSE", "20"))
+MF_CONTAINER_POOL_IDLE = int(os.environ.get("MF_CONTAINER_POOL_IDLE", "4"))
+
+POOL_STATE_DIR = "/.mf_pool"
+# Lists the installed distributions without pip, which the environments of the r2e template do not have.
+# The repository under test is left out, every run reinstalls it at its commit and its version may hold the commit.
+# It is installed from the working directory, so its `direct_url.json` points there, or its metadata lives there.
+LIST_PACKAGES = """python3 -c '
+import importlib.metadata as m, json, os
+def is_local(path):
+    return path == os.getcwd() or path.startswith(os.getcwd() + os.sep)
+def from_repository(d):
+    url = json.loads(d.read_text("direct_url.json") or "{}").get("url", "")
+    return url.startswith("file://") and is_local(url[len("file://"):]) or is_local(os.path.abspath(str(getattr(d, "_path", ""))))
+print(sorted((d.metadata["Name"] or "", d.version) for d in m.distributions() if not from_repository(d)))
+'"""
+
+# Records the state of a clean container: the untracked files of the image working directory,
+# e.g. the run_tests.sh, install.sh and .venv of the r2e template, and the installed packages.
+SNAPSHOT_SCRIPT = f"""set -e
+mkdir -p /patches /results {POOL_STATE_DIR}
+git ls-files --others --directory > {POOL_STATE_DIR}/untracked.txt
+{LIST_PACKAGES} > {POOL_STATE_DIR}/packages.txt 2>/dev/null || true
+"""
+
+# Restores the repository to its snapshot, keeping the untracked files of the snapshot, and clears the run files.
+# Ignored files such as build artifacts are kept, the evaluation script reinstalls the repository anyway.
+# Fails when the installed packages changed since the snapshot, since they cannot be restored, so the container is replaced.
+RESET_SCRIPT = f"""set -e
+git reset --hard -q
+set --
+while IFS= read -r path; do set -- "$@" -e "/$path"; done < {POOL_STATE_DIR}/untracked.txt
+git clean -fdq "$@"
+{LIST_PACKAGES} > {POOL_STATE_DIR}/packages_now.txt 2>/dev/null || true
+cmp -s {POOL_STATE_DIR}/packages.txt {POOL_STATE_DIR}/packages_now.txt
+rm -rf /patches /results /eval.sh /pass_report.json
+mkdir -p /patches /results
+"""
+
+class ContainerSession:
+    """A running container that commands are executed in, with files copied in and out through archives."""
+
+    def __init__(self, container: aiodocker.docker.DockerContainer, key: tuple[str, str]):
+        """Wrap a started container of the pool key `key`."""
+        self.container = container
+        self.key = key
+        self.uses = 0
+
+    async def exec(self, cmd: list[str], environment: list[str]=None, timeout: float=None) -> tuple[int, str]:
+        """Run a command in the container and return its exit code and output. A timeout raises TimeoutError."""
+        execution = await self.container.exec(cmd, stdout=True, stderr=True, environment=environment)
+        output = []
+
+        async def read_output():
+            async with execution.start(detach=False) as stream:
+                while (message := await stream.read_out()) is not None:
+                    output.append(message.data.decode(errors="replace"))
+        try:
+            await asyncio.wait_for(read_output(), timeout=timeout)
+        except TimeoutError:
+            raise TimeoutError(f"Command timed out after {timeout:g} seconds.")
+        return (await execution.inspect())["ExitCode"], "".join(output)
+
+    async def put_files(self, files: dict[str, str]) -> None:
+        """Write text files into the container, keyed by absolute path."""
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            for path, content in files.items():
+                data = content.encode()
+                tarinfo = tarfile.TarInfo(path.lstrip("/"))
+                tarinfo.size = len(data)
+                tarinfo.mode = 0o755
+                tarinfo.mtime = int(time.time())
+                tar.addfile(tarinfo, io.BytesIO(data))
+        await self.container.put_archive("/", buffer.getvalue())
+
+    async def get_file(self, path: str) -> bytes:
+        """Read a regular file of the container, or None if it does not exist."""
+        try:
+            tar = await self.container.get_archive(path)
+        except DockerError as e:
+            if e.status == 404:
+                return None
+            raise e
+        with tar:
+            member = tar.next()
+            return tar.extractfile(member).read() if member and member.isreg() else None
+
+    async def get_dir(self, path: str, dest_dir: str) -> None:
+        """Copy a directory of the container into `dest_dir`, e.g. `/results` into `dest_dir`/results."""
+        tar = await self.container.get_archive(path)
+        with tar:
+            await asyncio.to_thread(tar.extractall, dest_dir, filter="data")
+
+    async def is_healthy(self) -> bool:
+        """Whether the container is still running."""
+        try:
+            return (await self.container.show())["State"]["Running"]
+        except DockerError:
+            return False
+
+    async def snapshot(self) -> bool:
+        """Record the current state of the container as the state `reset` restores, returning whether it worked."""
+        try:
+            exit_code, _ = await self.exec(["sh", "-c", SNAPSHOT_SCRIPT], timeout=60)
+        except (DockerError, TimeoutError):
+            return False
+        return exit_code == 0
+
+    async def reset(self) -> bool:
+        """Restore the repository of the snapshot and clear the files of the last run, returning whether it worked."""
+        try:
+            exit_code, _ = await self.exec(["sh", "-c", RESET_SCRIPT], timeout=60)
+        except (DockerError, TimeoutError):
+            return False
+        return exit_code == 0
+
+class ContainerPool:
+    """Keep started containers per (image, host config) and hand them to the runs of that image.
+
+    A container runs an idle command, and every run executes its evaluation script in it instead of
+    creating, starting and deleting a container of its own. Containers are reset to their state at start
+    when they are released, so each run starts from the repository of a fresh container, and they are
+    replaced after `max_reuse` runs, after a failed run or reset, when a run changed the installed
+    packages, or when they stop running. At most `max_idle` containers are kept per key.
+    """
+
+    def __init__(self, client: aiodocker.Docker, max_reuse: int=MF_CONTAINER_MAX_REUSE, max_idle: int=MF_CONTAINER_POOL_IDLE):
+        """Create a pool of the containers of `client`."""
+        self.client = client
+        self.max_reuse = max_reuse
+        self.max_idle = max_idle
+        self.idle: dict[tuple[str, str], list[ContainerSession]] = defaultdict(list)
+        self.stats = {
+            "created": 0, "reused": 0, "discarded": 0, "reset_failures": 0,
+            "create_seconds": 0.0, "delete_seconds": 0.0, "deleted": 0, "reset_seconds": 0.0, "resets": 0,
+        }
+
+    async def _create(self, image_name: str, host_config: dict, key: tuple[str, str]) -> ContainerSession:
+        """Create and start a container idling until it is used."""
+        create_start = time.perf_counter()
+        config = {
+            "Image": image_name,
+            "HostConfig": {"Privileged": False, **(host_config or {})},
+            "Entrypoint": ["sleep"],
+            "Cmd": ["infinity"],
+            "Tty": True,
+        }
+        container_name = f"{image_name.replace('/', '-').replace(':', '-')}-pool-{uuid4()}"
+        container = await self.client.containers.create_or_replace(name=container_name, config=config)
+        await container.start()
+        session = ContainerSession(container, key)
+        await session.snapshot()
+        self.stats["created"] += 1
+        self.stats["create_seconds"] += time.perf_counter() - create_start
+        return session
+
+    async def _delete(self, session: ContainerSession, logger: logging.Logger) -> None:
+        """Delete the container of a session."""
+        delete_start = time.perf_counter()
+        try:
+            await session.container.delete(force=True)
+        except DockerError as e:
+            logger.error(f"Failed to delete container: {e}")
+        self.stats["deleted"] += 1
+        self.stats["delete_seconds"] += time.perf_counter() - delete_start
+
+    async def acquire(self, image_name: str, host_config: dict, logger: logging.Logger) -> ContainerSession:
+        """Get a clean container of an image, reusing an idle one when there is a healthy one."""
+        key = (image_name, orjson.dumps(host_config or {}, option=orjson.OPT_SORT_KEYS).decode())
+        while self.idle[key]:
+            session = self.idle[key].pop()
+            if await session.is_healthy():
+                self.stats["reused"] += 1
+                session.uses += 1
+                return session
+            self.stats["discarded"] += 1
+            await self._delete(session, logger)
+        session = await self._create(image_name, host_config, key)
+        session.uses += 1
+        return session
+
+    async def release(self, session: ContainerSession, logger: logging.Logger, reusable: bool=True) -> None:
+        """Give a container back after a run, resetting it for the next run, or delete it."""
+        if reusable and session.uses < self.max_reuse and len(self.idle[session.key]) < self.max_idle:
+            reset_start = time.perf_counter()
+            reset = await session.reset()
+            self.stats["resets"] += 1
+            self.stats["reset_seconds"] += time.perf_counter() - reset_start
+            if reset:
+                self.idle[session.key].append(session)
+                return
+            self.stats["reset_failures"] += 1
+            logger.warning(f"Failed to reset container {session.container.id}, replacing it.")
+        await self._delete(session, logger)
+
+    def report(self) -> dict:
+        """Compare the lifecycle cost of a fresh container with the reset of a reused one."""
+        fresh = (self.stats["create_seconds"] / max(self.stats["created"], 1)
+                 + self.stats["delete_seconds"] / max(self.stats["deleted"], 1))
+        reset = self.stats["reset_seconds"] / max(self.stats["resets"], 1)
+        return {
+            **self.stats,
+            "fresh_container_seconds": fresh,
+            "reset_seconds_per_run": reset,
+            "saved_seconds_per_reuse": fresh - reset,
+            "saved_seconds": self.stats["reused"] * (fresh - reset),
+        }
+
+    async def close(self, logger: logging.Logger) -> None:
+        """Delete all idle containers."""
+        sessions = [session for sessions in self.idle.values() for session in sessions]
+        self.idle.clear()
+        await asyncio.gather(*(self._delete(session, logger) for session in sessions))
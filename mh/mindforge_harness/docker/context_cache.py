@@ -0,0 +1,240 @@
+"""Content-addressed on-disk cache of the repository part of image build contexts."""
+import asyncio
+import hashlib
+import itertools
+import os
+import posixpath
+import tempfile
+from collections import defaultdict
+from typing import Awaitable, Callable, Iterator
+
+import git
+
+from mindforge_harness.docker.consts import DOCKER_IMAGE_COMBINED
+from mindforge_harness.docker.repo_cache import RepoSnapshot
+from mindforge_harness.utils import (
+    BUILD_CONTEXT_CHUNK_SIZE,
+    DEFAULT_BUILD_CONTEXT_IGNORE,
+    TAR_END_OF_ARCHIVE,
+    IterStream,
+    gzip_chunks,
+    is_ignored,
+    iter_context_files,
+    iter_tar_members,
+    load_dockerignore,
+    parse_dockerignore,
+    parse_size,
+)
+
+BUILD_CONTEXT_CACHE_DIR = os.environ.get("BUILD_CONTEXT_CACHE_DIR", "build_context_caches")
+BUILD_CONTEXT_CACHE_MAX_SIZE = parse_size(os.environ.get("BUILD_CONTEXT_CACHE_MAX_SIZE", "20G"))
+# Changed whenever the same patterns select other files, so entries of the former selection are not reused
+CONTEXT_KEY_VERSION = "2"
+
+def iter_file_chunks(path: str) -> Iterator[bytes]:
+    """Yield the content of a file chunk by chunk. The file is opened right away, so a later eviction cannot race the read."""
+    f = open(path, "rb")
+
+    def chunks():
+        with f:
+            while chunk := f.read(BUILD_CONTEXT_CHUNK_SIZE):
+                yield chunk
+    return chunks()
+
+def iter_changed_files(repo: git.Repo, repo_path: str, arc_root: str, ignore_patterns: list[str]) -> list[tuple[str, str]]:
+    """List the (file_path, arcname) of the files of a context that differ from HEAD, per `git status`.
+
+    Deleted files and the refs of the repository have no file_path, untracked or ignored directories are walked.
+    """
+    # Without renames, every entry is "XY path" and a renamed file is listed as deleted and added
+    status = repo.git.status("--porcelain", "-z", "--ignored", "--untracked-files=normal", "--no-renames")
+    relpaths = [entry[3:] for entry in status.split("\0") if entry]
+    files = []
+    for relpath in sorted(path.rstrip("/") for path in relpaths):
+        if is_ignored(relpath, ignore_patterns):
+            continue
+        file_path = os.path.join(repo_path, relpath)
+        if os.path.isdir(file_path) and not os.path.islink(file_path):
+            files.extend(
+                (path, arcname) for path, arcname in iter_context_files(file_path, posixpath.join(arc_root, relpath))
+                if not is_ignored(arcname[len(arc_root) + 1:], ignore_patterns)
+            )
+        else:
+            files.append((file_path if os.path.lexists(file_path) else None, posixpath.join(arc_root, relpath)))
+    # The `.git` directory goes into the context too, its refs change whenever commits are fetched
+    if not is_ignored(".git", ignore_patterns):
+        files.extend((None, f"{arc_root}/.git/{ref}") for ref in repo.git.for_each_ref("--format=%(refname) %(objectname)").splitlines())
+    return files
+
+class BuildContextCache:
+    """Cache of the compressed repository tarball that goes into every build context.
+
+    Entries are keyed by the repository HEAD, the files that differ from it (paths, sizes and modification
+    times after filtering) and the Dockerfile templates, so specs of the same repository
+    that only differ in e.g. `pip_packages` reuse one tarball instead of re-walking and re-compressing
+    the tree. The cache is bounded by `max_size` bytes and evicts the least recently used entries.
+
+    A cached entry is a gzip member holding the tar records of the repository without the end-of-archive
+    marker. The spec specific files are appended as a second gzip member, which Docker decompresses as
+    one stream.
+    """
+
+    def __init__(self, cache_dir: str=BUILD_CONTEXT_CACHE_DIR, max_size: int=BUILD_CONTEXT_CACHE_MAX_SIZE):
+        """Create a cache in `cache_dir` holding at most `max_size` bytes. A `max_size` of 0 disables it."""
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._locks = defaultdict(asyncio.Lock)
+
+    def context_key(self, repo_path: str, ignore_patterns: list[str], revision: str=None) -> str:
+        """Compute the cache key of the repository part of a build context.
+
+        A `revision` tells that the repository is a clean checkout it fully determines, so neither the repository
+        nor its files are read and `repo_path` need not be checked out yet. Otherwise a git repository is keyed by
+        its HEAD and the files `git status` reports as changed, untracked or ignored, and only other directories
+        are walked.
+        """
+        repo, head = None, ""
+        if not revision:
+            try:
+                repo = git.Repo(repo_path)
+                head = repo.head.commit.hexsha
+            except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError, ValueError):
+                pass
+        digest = hashlib.sha256(CONTEXT_KEY_VERSION.encode())
+        digest.update(head.encode())
+        digest.update(hashlib.sha256(DOCKER_IMAGE_COMBINED).digest())
+        digest.update("\0".join(ignore_patterns).encode())
+        arc_root = os.path.basename(repo_path)
+        if revision:
+            digest.update(f"{arc_root}\0{revision}".encode())
+            return digest.hexdigest()
+        files = None
+        if repo is not None and head:
+            try:
+                files = iter_changed_files(repo, repo_path, arc_root, ignore_patterns)
+            except git.exc.GitCommandError:
+                pass
+        for file_path, arcname in files if files is not None else iter_context_files(repo_path, arc_root, ignore_patterns):
+            if file_path is None:
+                digest.update(f"{arcname}\n".encode())
+                continue
+            st = os.lstat(file_path)
+            digest.update(f"{arcname}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+        return digest.hexdigest()
+
+    def _write_entry(self, entry_path: str, repo_path: str, ignore_patterns: list[str]) -> None:
+        """Write the compressed repository tar records to the cache, atomically."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                files = iter_context_files(repo_path, os.path.basename(repo_path), ignore_patterns)
+                for chunk in gzip_chunks(iter_tar_members(files)):
+                    f.write(chunk)
+            os.replace(tmp_path, entry_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def evict(self, keep: str=None) -> list[str]:
+        """Remove the least recently used entries, except `keep`, until the cache fits in `max_size`."""
+        if not os.path.isdir(self.cache_dir):
+            return []
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".tar.gz"):
+                st = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted.append(name)
+        return evicted
+
+    async def get_repo_entry(
+        self,
+        repo_path: str,
+        ignore_patterns: list[str],
+        revision: str=None,
+        checkout: Callable[[], Awaitable[str]]=None,
+    ) -> str:
+        """Get the path of the cached repository tarball, creating it off the event loop on a miss.
+
+        With a `revision`, `checkout` is awaited to materialize `repo_path` only when the entry has to be written.
+        """
+        key = await asyncio.to_thread(self.context_key, repo_path, ignore_patterns, revision)
+        entry_path = os.path.join(self.cache_dir, f"{key}.tar.gz")
+        async with self._locks[key]:
+            if os.path.exists(entry_path):
+                self.hits += 1
+                os.utime(entry_path)  # Mark as recently used
+                return entry_path
+            self.misses += 1
+            if checkout is not None:
+                await checkout()
+            await asyncio.to_thread(self._write_entry, entry_path, repo_path, ignore_patterns)
+        await asyncio.to_thread(self.evict, os.path.basename(entry_path))
+        return entry_path
+
+    def spec_member(self, build_context_path: str, additional_files: list[str]=None) -> Iterator[bytes]:
+        """Compress the spec specific files of a build context, with the end-of-archive marker."""
+        for file_path in additional_files or []:
+            if not os.path.exists(file_path):
+                raise FileNotFoundError(f"Additional file '{file_path}' not found.")
+
+        spec_files = itertools.chain(
+            iter_context_files(build_context_path, ""),
+            ((file_path, os.path.basename(file_path)) for file_path in additional_files or []),
+        )
+        return gzip_chunks(itertools.chain(iter_tar_members(spec_files), [TAR_END_OF_ARCHIVE]))
+
+    async def create_tarball(
+        self,
+        build_context_path: str,
+        repo_path: str,
+        additional_files: list[str]=None,
+        revision: str=None,
+    ) -> IterStream:
+        """Create the gzip compressed build context stream, reusing the cached repository tarball.
+
+        `revision` identifies the content of a repository snapshot, e.g. its commit and history depth.
+        """
+        ignore_patterns = DEFAULT_BUILD_CONTEXT_IGNORE + load_dockerignore(repo_path)
+        spec_member = self.spec_member(build_context_path, additional_files)
+        if not self.max_size:
+            repo_files = iter_context_files(repo_path, os.path.basename(repo_path), ignore_patterns)
+            return IterStream(itertools.chain(gzip_chunks(iter_tar_members(repo_files)), spec_member))
+
+        entry_path = await self.get_repo_entry(repo_path, ignore_patterns, revision)
+        return IterStream(itertools.chain(iter_file_chunks(entry_path), spec_member))
+
+    async def create_snapshot_tarball(
+        self,
+        build_context_path: str,
+        snapshot: RepoSnapshot,
+        additional_files: list[str]=None,
+    ) -> IterStream:
+        """Create the build context stream of a repository snapshot, checking it out only when its entry is not cached."""
+        dockerignore = await asyncio.to_thread(snapshot.read_file, ".dockerignore")
+        ignore_patterns = DEFAULT_BUILD_CONTEXT_IGNORE + parse_dockerignore(dockerignore or "")
+        spec_member = self.spec_member(build_context_path, additional_files)
+        if not self.max_size:
+            repo_path = await snapshot.checkout()
+            repo_files = iter_context_files(repo_path, os.path.basename(repo_path), ignore_patterns)
+            return IterStream(itertools.chain(gzip_chunks(iter_tar_members(repo_files)), spec_member))
+
+        entry_path = await self.get_repo_entry(snapshot.path, ignore_patterns, snapshot.revision, snapshot.checkout)
+        return IterStream(itertools.chain(iter_file_chunks(entry_path), spec_member))
+
+GLOBAL_CONTEXT_CACHE = BuildContextCache()
@@ -1,10 +1,11 @@
+import asyncio
 import os
 import logging
 import time
-import subprocess
-from typing import TypedDict
+from typing import Callable, TypedDict
 
 import aiodocker
+import orjson
 from aiodocker import DockerError
 
 # Registry config from environment
@@ -15,20 +16,26 @@ MF_REGISTRY_URL = os.environ.get("MF_REGISTRY_URL", None)
 MF_REGISTRY_USER = os.environ.get("MF_REGISTRY_USER", None)
 MF_REGISTRY_PASS = os.environ.get("MF_REGISTRY_PASS", None)
 
-logged_in = False
+logged_in: set[tuple[str, str]] = set()
 
-def login_to_registry(url: str, username: str, password: str) -> None:
-    """Login to Docker Hub using the provided username and password."""
-    global logged_in
-    if not logged_in:
-        login_cmd = f'echo "{password}" | docker login {url} -u "{username}" --password-stdin'
-        try:
-            subprocess.run(login_cmd, shell=True, check=True)
-        except subprocess.CalledProcessError as e:
-            print(f"Failed to login to {url}: {e}")
-            raise e
-        logged_in = True
-        print(f"Logged in to {url} successfully.")
+async def login_to_registry(client: aiodocker.Docker, url: str, username: str, password: str) -> None:
+    """Check the credentials of a registry once through the Docker daemon.
+
+    Pushes and pulls authenticate natively with the X-Registry-Auth header, this only fails early on bad credentials.
+    """
+    if (url, username) in logged_in:
+        return
+    try:
+        await client._query_json("auth", "POST", data=orjson.dumps({
+            "username": username,
+            "password": password,
+            "serveraddress": url or "https://index.docker.io/v1/",
+        }))
+    except DockerError as e:
+        print(f"Failed to login to {url}: {e}")
+        raise e
+    logged_in.add((url, username))
+    print(f"Logged in to {url} successfully.")
 
 class DockerRegisteryConfig(TypedDict):
     """Docker registry configuration.
@@ -52,20 +59,79 @@ GLOBAL_REGISTRY_CONFIG = DockerRegisteryConfig(
     registry_pass=MF_REGISTRY_PASS
 )
 
+def normalize_image_tag(image_name: str) -> str:
+    """Return the fully qualified `<name>:<tag>` form of an image reference."""
+    if ':' not in image_name.rsplit('/', 1)[-1]:
+        return f"{image_name}:latest"
+    return image_name
+
+class ImageIndex:
+    """In-process index of the image tags present on one Docker daemon.
+
+    The daemon is listed once on first use. Afterwards lookups are exact tag matches against the index,
+    builds/pulls/deletes done by the harness update it in place, and only a miss costs a cheap
+    `images.inspect` round trip to catch images created outside of this process.
+    """
+
+    def __init__(self):
+        """Create an empty, not yet loaded index."""
+        self.tags: set[str] = set()
+        self.loaded = False
+        self._load_lock = asyncio.Lock()
+
+    async def load(self, client: aiodocker.Docker, force: bool=False) -> None:
+        """List the images of the daemon once and index all their tags."""
+        async with self._load_lock:
+            if self.loaded and not force:
+                return
+            images = await client.images.list()
+            self.tags = {tag for img in images for tag in (img.get('RepoTags') or [])}
+            self.loaded = True
+
+    async def lookup(self, client: aiodocker.Docker, image_name: str) -> str:
+        """Return the exact local tag of `image_name`, or None if the daemon does not have it."""
+        if not self.loaded:
+            await self.load(client)
+        tag = normalize_image_tag(image_name)
+        if tag in self.tags:
+            return tag
+        try:
+            info = await client.images.inspect(tag)
+        except DockerError as e:
+            if e.status == 404:
+                return None
+            raise e
+        self.tags.update(info.get('RepoTags') or [tag])
+        return tag
+
+    def add(self, image_name: str) -> None:
+        """Record a tag created by a build, pull, tag or load."""
+        self.tags.add(normalize_image_tag(image_name))
+
+    def discard(self, image_name: str) -> None:
+        """Forget a tag removed from the daemon."""
+        self.tags.discard(normalize_image_tag(image_name))
+
+def get_daemon_id(client: aiodocker.Docker) -> str:
+    """Identify the daemon of a client by the URL it was created with, as aiodocker rewrites socket URLs to unix://localhost."""
+    return getattr(client, '_connection_info', None) or getattr(client, 'docker_host', None)
+
+# One index per daemon, shared by every client talking to it
+image_indexes: dict[str, ImageIndex] = {}
+
+def get_image_index(client: aiodocker.Docker) -> ImageIndex:
+    """Get the image index of the daemon the client is connected to."""
+    daemon_id = get_daemon_id(client)
+    if daemon_id not in image_indexes:
+        image_indexes[daemon_id] = ImageIndex()
+    return image_indexes[daemon_id]
+
 async def get_from_existing_image(
     client: aiodocker.Docker,
     image_name: str,
 ) -> str:
-    """Get the image name from existing images."""
-    images = await client.images.list()
-    existing_images = [img['RepoTags'] for img in images if img.get('RepoTags')]
-    for tags in existing_images:
-        if not tags:
-            continue
-        for tag in tags:
-            if image_name in tag:
-                return tag
-    return None
+    """Get the exact local tag of an image, or None if it does not exist locally."""
+    return await get_image_index(client).lookup(client, image_name)
 
 def get_registry_img_name(
     image_name: str,
@@ -77,8 +143,14 @@ def get_registry_img_name(
         return f"{registery_config['registry_url']}/{image_name}"
     return f"{registery_config['registry_user']}/{image_name}"
 
-async def push_img_to_registry(client: aiodocker.Docker, image_name: str, registery_config: DockerRegisteryConfig, logger: logging.Logger) -> None:
-    """Push an image to Docker Hub."""
+async def push_img_to_registry(
+    client: aiodocker.Docker,
+    image_name: str,
+    registery_config: DockerRegisteryConfig,
+    logger: logging.Logger,
+    on_progress: Callable[[int], None]=None,
+) -> None:
+    """Push an image to the registry, reporting the bytes uploaded so far to `on_progress`."""
     try:
         push_start = time.perf_counter()
 
@@ -86,8 +158,8 @@ async def push_img_to_registry(client: aiodocker.Docker, image_name: str, regist
         registry_image_name = get_registry_img_name(image_name, registery_config)
         await client.images.tag(image_name, registry_image_name)
 
-        # Login to Docker Hub
-        login_to_registry(
+        await login_to_registry(
+            client,
             registry_url if registry_url else '',
             registery_config['registry_user'],
             registery_config['registry_pass']
@@ -95,16 +167,21 @@ async def push_img_to_registry(client: aiodocker.Docker, image_name: str, regist
         
         # Actually push the image
         logger.info(f"Pushing image {registry_image_name} to {registry_url if registry_url else 'docker.io'}...")
-        push_logs = await client.images.push(registry_image_name, auth={
+        push_logs = client.images.push(registry_image_name, auth={
             'username': registery_config['registry_user'],
             'password': registery_config['registry_pass']
-        })
-        for log_msg in push_logs:
-            if 'status' in log_msg:
-                logger.debug(log_msg['status'])
-            elif 'error' in log_msg:
+        }, stream=True)
+        uploaded = {}  # Bytes uploaded by layer
+        async for log_msg in push_logs:
+            if 'error' in log_msg:
                 logger.error(f"Error pushing image: {log_msg['error']}")
                 raise Exception(f"Failed to push image: {log_msg['error']}")
+            elif 'status' in log_msg:
+                logger.debug(log_msg['status'])
+                if log_msg.get('progressDetail', {}).get('current') and 'id' in log_msg:
+                    uploaded[log_msg['id']] = log_msg['progressDetail']['current']
+                    if on_progress:
+                        on_progress(sum(uploaded.values()))
 
         logger.info(f"Successfully pushed {registry_image_name} in {time.perf_counter() - push_start:.2f} seconds")
     except Exception as e:
@@ -116,9 +193,29 @@ async def push_img_to_registry(client: aiodocker.Docker, image_name: str, regist
         except DockerError as e:
             pass
 
+# Pulls in flight by (daemon, image), so concurrent waiters of an image share one pull
+pulls_in_flight: dict[tuple[str, str], asyncio.Task] = {}
+# Size, duration and throughput of every pull done by this process
+pull_stats: dict[str, dict] = {}
+
+def is_image_not_found(error: DockerError) -> bool:
+    """Whether a pull failed because the registry does not have the image, rather than for any other reason."""
+    message = str(error.message).lower()
+    return error.status == 404 or any(
+        reason in message for reason in ("manifest unknown", "not found", "does not exist")
+    )
+
 async def pull_img_from_registry(client: aiodocker.Docker, image_name: str, registery_config: DockerRegisteryConfig, logger: logging.Logger) -> str:
-    """Pull an image from Docker Hub."""
+    """Pull an image from the registry and tag it as `image_name`. Concurrent pulls of an image are shared."""
+    key = (get_daemon_id(client), image_name)
+    if key not in pulls_in_flight:
+        pulls_in_flight[key] = asyncio.create_task(_pull_img_from_registry(client, image_name, registery_config, logger))
+        pulls_in_flight[key].add_done_callback(lambda _: pulls_in_flight.pop(key, None))
+    # Shield the shared pull, so a cancelled waiter does not cancel it for everyone else
+    return await asyncio.shield(pulls_in_flight[key])
 
+async def _pull_img_from_registry(client: aiodocker.Docker, image_name: str, registery_config: DockerRegisteryConfig, logger: logging.Logger) -> str:
+    """Pull an image from the registry."""
     pull_start = time.perf_counter()
     registry_image_name = get_registry_img_name(image_name, registery_config)
 
@@ -133,16 +230,22 @@ async def pull_img_from_registry(client: aiodocker.Docker, image_name: str, regi
             logger.debug(log_msg['status'])
         elif 'error' in log_msg:
             logger.error(f"Error pulling image: {log_msg['error']}")
-            raise DockerError(f"Failed to pull image {image_name}: {log_msg['error']}")
+            status = 404 if 'manifest unknown' in log_msg['error'].lower() else 500
+            raise DockerError(status, f"Failed to pull image {image_name}: {log_msg['error']}")
 
     await client.images.tag(registry_image_name, image_name)
+    get_image_index(client).add(image_name)
+    size = (await client.images.inspect(image_name)).get('Size', 0)
     try:
         await client.images.delete(registry_image_name, force=True)
     except DockerError as e:
         pass
 
-    logger.info(f"Successfully pulled {registry_image_name} in {time.perf_counter() - pull_start:.2f} seconds")
-    return registry_image_name
+    seconds = time.perf_counter() - pull_start
+    pull_stats[image_name] = {"size": size, "seconds": seconds, "throughput": size / seconds if seconds else 0.0}
+    logger.info(f"Successfully pulled {registry_image_name} ({size / 1024 ** 2:.0f} MiB) in {seconds:.2f} seconds, "
+                f"{pull_stats[image_name]['throughput'] / 1024 ** 2:.1f} MiB/s")
+    return image_name
 
 async def push_local_images():
     registry = "10.10.100.19:5000"
@@ -150,12 +253,13 @@ async def push_local_images():
     GLOBAL_REGISTRY_CONFIG['registry_user'] = "bmc"
     GLOBAL_REGISTRY_CONFIG['registry_pass'] = "bmc"
     
-    login_to_registry(
+    client = aiodocker.Docker()
+    await login_to_registry(
+        client,
         registry,
         GLOBAL_REGISTRY_CONFIG['registry_user'],
         GLOBAL_REGISTRY_CONFIG['registry_pass']
     )
-    client = aiodocker.Docker()
     await pull_img_from_registry(
         client,
         "hello-world",
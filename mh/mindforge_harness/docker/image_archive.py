@@ -0,0 +1,221 @@
+"""Move images between hosts without a registry, through a content-addressed archive directory."""
+import asyncio
+import gzip
+import hashlib
+import io
+import logging
+import os
+import re
+import tarfile
+from typing import Iterator
+from uuid import uuid4
+
+import aiodocker
+import orjson
+
+from mindforge_harness.docker.docker_utils import get_image_index, normalize_image_tag
+from mindforge_harness.logger import MindForgeHarnessLogger
+from mindforge_harness.utils import (
+    BUILD_CONTEXT_CHUNK_SIZE,
+    TAR_END_OF_ARCHIVE,
+    IterStream,
+    intern_spec_dicts,
+    load_dataset_from_path,
+)
+
+IMAGE_ARCHIVE_DIR = os.environ.get("IMAGE_ARCHIVE_DIR", "image_archives")
+MF_MAX_ARCHIVE_WORKERS = int(os.environ.get("MF_MAX_ARCHIVE_WORKERS", "2"))
+
+# Blobs of the OCI layout written by `docker save` are already named by their digest
+OCI_BLOB = re.compile(r"^blobs/sha256/([0-9a-f]{64})$")
+TARINFO_FIELDS = ("name", "mode", "mtime", "uid", "gid", "uname", "gname", "linkname", "size")
+
+class AsyncStreamFile(io.RawIOBase):
+    """Blocking file object over an asyncio stream, for a worker thread while the event loop serves the reads."""
+
+    def __init__(self, stream: asyncio.StreamReader, loop: asyncio.AbstractEventLoop):
+        """Wrap the stream of the event loop `loop`."""
+        self._stream = stream
+        self._loop = loop
+
+    def readable(self) -> bool:
+        """Return True, the stream is readable."""
+        return True
+
+    def readinto(self, b) -> int:
+        """Read the next bytes of the stream into a pre-allocated buffer."""
+        data = asyncio.run_coroutine_threadsafe(self._stream.read(len(b)), self._loop).result()
+        b[:len(data)] = data
+        return len(data)
+
+class ImageArchive:
+    """Directory holding images as gzip compressed, content-addressed blobs plus one recipe per image.
+
+    `docker save` of an image is split into its files. Each file is stored once as `blobs/<sha256>.gz`,
+    so the layers shared by images, e.g. those of the base images, are stored and copied only once.
+    The recipe lists the tar members of the save in order, so `docker load` gets the exact same stream back.
+    """
+
+    def __init__(self, archive_dir: str=IMAGE_ARCHIVE_DIR):
+        """Create an archive in `archive_dir`."""
+        self.archive_dir = archive_dir
+        self.blobs_dir = os.path.join(archive_dir, "blobs")
+        self.recipes_dir = os.path.join(archive_dir, "images")
+
+    def blob_path(self, digest: str) -> str:
+        """Path of the blob of a digest."""
+        return os.path.join(self.blobs_dir, f"{digest}.gz")
+
+    def recipe_path(self, image_name: str) -> str:
+        """Path of the recipe of an image."""
+        return os.path.join(self.recipes_dir, f"{normalize_image_tag(image_name).replace('/', '_').replace(':', '__')}.json")
+
+    def images(self) -> list[str]:
+        """List the images in the archive."""
+        if not os.path.isdir(self.recipes_dir):
+            return []
+        images = []
+        for file in sorted(os.listdir(self.recipes_dir)):
+            with open(os.path.join(self.recipes_dir, file), "rb") as f:
+                images.append(orjson.loads(f.read())["image"])
+        return images
+
+    def _store_member(self, tar: tarfile.TarFile, member: tarfile.TarInfo, stats: dict) -> str:
+        """Store the content of a regular file member as a blob, unless it is already stored, and return its digest."""
+        source = tar.extractfile(member)
+        stats["bytes"] += member.size
+        # Known blobs are drained without compressing them again
+        if (match := OCI_BLOB.match(member.name)) and os.path.exists(self.blob_path(match.group(1))):
+            while source.read(BUILD_CONTEXT_CHUNK_SIZE):
+                pass
+            return match.group(1)
+
+        digest = hashlib.sha256()
+        tmp_path = os.path.join(self.blobs_dir, f".{uuid4()}.tmp")
+        with gzip.open(tmp_path, "wb", compresslevel=6) as f:
+            while chunk := source.read(BUILD_CONTEXT_CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+        blob_path = self.blob_path(digest.hexdigest())
+        if os.path.exists(blob_path):
+            os.remove(tmp_path)
+        else:
+            os.replace(tmp_path, blob_path)
+            stats["new_bytes"] += member.size
+            stats["new_blobs"] += 1
+        return digest.hexdigest()
+
+    def _split(self, fileobj: io.RawIOBase, image_name: str) -> dict:
+        """Split a `docker save` stream into blobs and write the recipe of the image."""
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        os.makedirs(self.recipes_dir, exist_ok=True)
+        stats = {"bytes": 0, "new_bytes": 0, "blobs": 0, "new_blobs": 0}
+        members = []
+        with tarfile.open(fileobj=fileobj, mode="r|") as tar:
+            for member in tar:
+                record = {field: getattr(member, field) for field in TARINFO_FIELDS}
+                record["type"] = member.type.decode()
+                if member.isreg():
+                    record["digest"] = self._store_member(tar, member, stats)
+                    stats["blobs"] += 1
+                members.append(record)
+
+        tmp_path = f"{self.recipe_path(image_name)}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps({"image": normalize_image_tag(image_name), "members": members}))
+        os.replace(tmp_path, self.recipe_path(image_name))
+        return stats
+
+    def iter_image_tar(self, image_name: str) -> Iterator[bytes]:
+        """Yield the `docker save` stream of an image back from its recipe and blobs."""
+        with open(self.recipe_path(image_name), "rb") as f:
+            recipe = orjson.loads(f.read())
+        for record in recipe["members"]:
+            tarinfo = tarfile.TarInfo(record["name"])
+            for field in TARINFO_FIELDS[1:]:
+                setattr(tarinfo, field, record[field])
+            tarinfo.type = record["type"].encode()
+            yield tarinfo.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+            if "digest" not in record:
+                continue
+            with gzip.open(self.blob_path(record["digest"]), "rb") as blob:
+                while chunk := blob.read(BUILD_CONTEXT_CHUNK_SIZE):
+                    yield chunk
+            if tarinfo.size % tarfile.BLOCKSIZE:
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - tarinfo.size % tarfile.BLOCKSIZE)
+        yield TAR_END_OF_ARCHIVE
+
+    async def export_image(self, client: aiodocker.Docker, image_name: str, logger: logging.Logger) -> dict:
+        """Stream `docker save` of an image into the archive and return the bytes and blobs it added."""
+        async with client.images.export_image(normalize_image_tag(image_name)) as stream:
+            stats = await asyncio.to_thread(self._split, AsyncStreamFile(stream, asyncio.get_running_loop()), image_name)
+        logger.info(f"Exported {image_name}: {stats['new_blobs']}/{stats['blobs']} new blobs, "
+                    f"{stats['new_bytes'] / 1024 ** 2:.0f}/{stats['bytes'] / 1024 ** 2:.0f} MiB new.")
+        return stats
+
+    async def import_image(self, client: aiodocker.Docker, image_name: str, logger: logging.Logger) -> str:
+        """Stream `docker load` of an image from the archive."""
+        # The stream is produced in the HTTP client's executor thread while the daemon reads it
+        logs = await client.images.import_image(IterStream(self.iter_image_tar(image_name)))
+        for log in logs:
+            if 'error' in log:
+                raise Exception(f"Failed to import image {image_name}: {log['error']}")
+            if 'stream' in log:
+                logger.debug(log['stream'].strip())
+        get_image_index(client).add(image_name)
+        logger.info(f"Imported {image_name}.")
+        return normalize_image_tag(image_name)
+
+def get_dataset_image_names(dataset_name: str) -> list[str]:
+    """Get the distinct image names needed by the instances of a dataset."""
+    raw_dataset = load_dataset_from_path(dataset_name)
+    intern_spec_dicts(raw_dataset)
+    return list(dict.fromkeys(data['image_name'] for data in raw_dataset if data.get('image_name')))
+
+async def export_images(archive_dir: str=IMAGE_ARCHIVE_DIR, dataset_name: str=None, max_workers: int=MF_MAX_ARCHIVE_WORKERS) -> dict:
+    """Export the local images of a dataset, or all local harness images, into an archive directory."""
+    archive = ImageArchive(archive_dir)
+    sem = asyncio.Semaphore(max_workers)
+    with MindForgeHarnessLogger("image-archive", log_file=None, add_stdout=True) as logger:
+        async with aiodocker.Docker() as client:
+            if dataset_name:
+                image_names = get_dataset_image_names(dataset_name)
+            else:
+                images = await client.images.list(filters={"reference": ["eval-*"]})
+                image_names = sorted({tag for img in images for tag in img.get('RepoTags') or [] if tag.startswith("eval-")})
+
+            async def export_one(image_name: str) -> dict:
+                async with sem:
+                    if not await get_image_index(client).lookup(client, image_name):
+                        logger.warning(f"Image {image_name} does not exist locally, skipping it.")
+                        return None
+                    return await archive.export_image(client, image_name, logger)
+
+            stats = [s for s in await asyncio.gather(*(export_one(name) for name in image_names)) if s]
+        total = sum(s["bytes"] for s in stats)
+        added = sum(s["new_bytes"] for s in stats)
+        logger.info(f"Exported {len(stats)} images to {archive_dir}, {added / 1024 ** 3:.2f} GiB stored for "
+                    f"{total / 1024 ** 3:.2f} GiB of images.")
+        return {"images": len(stats), "bytes": total, "new_bytes": added}
+
+async def import_images(archive_dir: str=IMAGE_ARCHIVE_DIR, dataset_name: str=None, max_workers: int=MF_MAX_ARCHIVE_WORKERS) -> list[str]:
+    """Import the archived images of a dataset, or all archived images, that do not exist locally."""
+    archive = ImageArchive(archive_dir)
+    sem = asyncio.Semaphore(max_workers)
+    archived = set(archive.images())
+    image_names = [normalize_image_tag(name) for name in get_dataset_image_names(dataset_name)] if dataset_name else sorted(archived)
+    with MindForgeHarnessLogger("image-archive", log_file=None, add_stdout=True) as logger:
+        async with aiodocker.Docker() as client:
+
+            async def import_one(image_name: str) -> str:
+                async with sem:
+                    if image_name not in archived:
+                        logger.warning(f"Image {image_name} is not in {archive_dir}, skipping it.")
+                        return None
+                    if await get_image_index(client).lookup(client, image_name):
+                        return None
+                    return await archive.import_image(client, image_name, logger)
+
+            imported = [name for name in await asyncio.gather(*(import_one(name) for name in image_names)) if name]
+        logger.info(f"Imported {len(imported)} images from {archive_dir}.")
+        return imported
@@ -1,4 +1,5 @@
 import asyncio
+import hashlib
 import os
 import tempfile
 import time
@@ -12,30 +13,67 @@ from aiodocker.exceptions import DockerError
 
 from mindforge_harness.logger import TQDMLogger, MindForgeHarnessLogger
 from mindforge_harness.utils import (
+    canonicalize_spec_dict,
     create_tarball,
-    consistent_hash,
-    get_cached_or_clone_repo,
+    get_image_name,
+    get_spec_hash,
+    normalize_python_version,
 )
 from mindforge_harness.docker.consts import (
     GREEN_ZONE_CERTIFICATES,
-    # DOCKER_FILE,
-    DOCKER_FILE_R2E,
+    DOCKER_TEMPLATE,
+    DOCKER_TEMPLATES,
     GREEN_ZONE_CERTIFICATES_DIR,
     PATCH_CODE_PY,
     PANDAS_INSTALLATION_DIR
 )
+from mindforge_harness.docker.build_failures import GLOBAL_BUILD_FAILURES
+from mindforge_harness.docker.context_cache import GLOBAL_CONTEXT_CACHE
+from mindforge_harness.docker.image_gc import GLOBAL_IMAGE_GC
+from mindforge_harness.docker.package_cache import GLOBAL_PACKAGE_CACHE, TEST_PACKAGES
+from mindforge_harness.docker.push_queue import GLOBAL_PUSH_QUEUE
+from mindforge_harness.docker.registry_client import get_registry_catalog
+from mindforge_harness.docker.repo_cache import GLOBAL_REPO_CACHE
 from mindforge_harness.docker.docker_utils import (
     DockerRegisteryConfig,
     GLOBAL_REGISTRY_CONFIG,
     get_registry_img_name,
     get_from_existing_image,
-    push_img_to_registry,
+    get_image_index,
+    is_image_not_found,
     pull_img_from_registry,
 )
 
 # Global lock to track ongoing builds
 image_build_locks = defaultdict(asyncio.Lock)
-failed_images = set()
+# Base images built in this run, `force_rebuild` does not build them again for every spec image
+rebuilt_base_images: set[str] = set()
+
+def format_certificates(green_zone: bool=False) -> str:
+    """Format the certificates section of the base Dockerfile."""
+    if not green_zone:
+        return ""
+    return GREEN_ZONE_CERTIFICATES.format(
+        http_proxy=os.environ.get("http_proxy", ""),
+        https_proxy=os.environ.get("https_proxy", "")
+    )
+
+def format_base_dockerfile(python_version: str, green_zone: bool=False, template: str=DOCKER_TEMPLATE) -> str:
+    """Format the base Dockerfile shared by all specs with the same python version, template and green zone."""
+    return DOCKER_TEMPLATES[template][0].format(
+        python=normalize_python_version(python_version),
+        certificates=format_certificates(green_zone),
+    )
+
+def get_base_image_name(python_version: str, green_zone: bool=False, template: str=DOCKER_TEMPLATE) -> str:
+    """Get the name of the base image of a (python version, template, green zone).
+
+    The python version is left out when the base Dockerfile of the template does not use it, so its specs share one base.
+    """
+    base_hash = hashlib.sha256(format_base_dockerfile(python_version, green_zone, template).encode()).hexdigest()
+    zone = "green" if green_zone else "blue"
+    python = f"-py{normalize_python_version(python_version)}" if "{python}" in DOCKER_TEMPLATES[template][0] else ""
+    return f"eval-base-{template}{python}-{zone}-{base_hash[:8]}"
 
 def format_dockerfile(
     repo_path: str,
@@ -43,18 +81,12 @@ def format_dockerfile(
     pip_packages: list[str],
     packages: str,
     pre_install: list[str],
-    green_zone: bool=False
+    green_zone: bool=False,
+    base_image: str=None,
+    template: str=DOCKER_TEMPLATE,
+    wheelhouse: str="",
 ) -> str:
-    """Format Dockerfile according to your specs."""
-    if green_zone:
-        http_proxy = os.environ.get("http_proxy", "")
-        https_proxy = os.environ.get("https_proxy", "")
-        certificates = GREEN_ZONE_CERTIFICATES.format(
-            http_proxy=http_proxy,
-            https_proxy=https_proxy
-        )
-    else:
-        certificates = ""
+    """Format the spec Dockerfile according to your specs. It is built FROM the shared base image."""
     # Build up the pip install commands
     pip_install = ""
     if packages:
@@ -65,30 +97,99 @@ def format_dockerfile(
     if not pre_install:
         pre_install = ['true']
     elif "apt-get update" not in pre_install:
-        pre_install.insert(0, "apt-get update")
+        pre_install = ["apt-get update", *pre_install]  # Do not modify the spec, it is hashed into the image name
     template_vars_dockerfile = {
         "repo_path": repo_path,
-        "python": python_version if not python_version.startswith('python') else python_version[:6],
+        "base_image": base_image or get_base_image_name(python_version, green_zone, template),
         "pre_install": " && ".join(pre_install),
         "pip_install": pip_install,
-        "certificates": certificates
+        "wheelhouse": wheelhouse,
     }
-    # return DOCKER_FILE.format(**template_vars_dockerfile)
     try:
-        return DOCKER_FILE_R2E.format(**template_vars_dockerfile)
+        return DOCKER_TEMPLATES[template][1].format(**template_vars_dockerfile)
     except Exception as e:
         print(str(e))
         return
 
-def get_image_name(repo_name: str, spec_dict: dict) -> str:
-    """Get a unique Docker Hub-compatible image name.
+async def run_docker_build(client: aiodocker.Docker, tar_stream, image_name: str, build_dir: str, spec_hash: str="") -> None:
+    """Build an image from a build context stream, capturing the logs to `build_dir`/build.log.
 
-    <dockerhub-user>/<something-unique>:<tag> (if you need a tag)
-    For simplicity, we'll do no explicit tag, just "latest".
+    Errors reported by the build itself are recorded as failures of `spec_hash`, daemon errors and timeouts are not.
     """
-    repo_name = repo_name.lower()
-    spec_hash = consistent_hash(spec_dict)
-    return f"eval-{repo_name.replace('/', '-')}-{spec_hash[:8]}"
+    build_logs = client.images.build(
+        fileobj=tar_stream,
+        tag=image_name,
+        encoding="gzip",
+        forcerm=True,
+        rm=True,
+        stream=True,
+    )
+
+    # Capture logs to build.log
+    with MindForgeHarnessLogger(f"build-{image_name}", os.path.join(build_dir, "build.log"), add_stdout=True) as build_logger:
+        try:
+            async for log in build_logs:
+                if 'stream' in log:
+                    build_logger.debug(log['stream'].strip())
+                elif 'error' in log:
+                    build_logger.error(f"Error: {log['error']}")
+                    GLOBAL_BUILD_FAILURES.record(image_name, spec_hash, log['error'].strip())
+                    raise Exception(f"Build failed: {log['error']}.\n"
+                                    f"For more details, check the logs at {build_dir}")
+        except DockerError as e:
+            if e.status == 0:
+                # The build reported an error in its stream, newer aiodocker raise it instead of yielding it
+                build_logger.error(f"Error: {e.message}")
+                GLOBAL_BUILD_FAILURES.record(image_name, spec_hash, e.message.strip())
+                raise Exception(f"Build failed: {e.message}.\n"
+                                f"For more details, check the logs at {build_dir}") from e
+            build_logger.error(f"Failed to fetch the logs while building {image_name}:\n {e}")
+            raise e
+        except TimeoutError:
+            error = f"Build timeout after {client.session.timeout.total} seconds."
+            build_logger.error(error)
+            raise TimeoutError(error)
+    get_image_index(client).add(image_name)
+    GLOBAL_IMAGE_GC.touch(image_name)
+    GLOBAL_BUILD_FAILURES.clear(image_name)
+
+async def build_base_image(
+    client: aiodocker.Docker,
+    python_version: str,
+    docker_work_dir: str,
+    green_zone: bool=False,
+    force_rebuild: bool=False,
+) -> str:
+    """Build or get the shared base image of a python version and green zone. `force_rebuild` rebuilds it once per run."""
+    base_image = get_base_image_name(python_version, green_zone)
+
+    async with image_build_locks[base_image]:
+        # The name of a base image already hashes its Dockerfile
+        if failure := GLOBAL_BUILD_FAILURES.get(base_image):
+            raise Exception(GLOBAL_BUILD_FAILURES.describe(base_image, failure))
+        force_rebuild = force_rebuild and base_image not in rebuilt_base_images
+        if not force_rebuild and await get_from_existing_image(client, base_image):
+            return base_image
+
+        with TQDMLogger(f'build-{base_image}', os.path.join(docker_work_dir, "build-or-fetch.log")) as logger:
+            logger.info(f"Base image {base_image} not found locally, building...")
+            build_start = time.perf_counter()
+            build_dir = os.path.join(docker_work_dir, base_image)
+            os.makedirs(build_dir, exist_ok=True)
+            with open(os.path.join(build_dir, "Dockerfile"), "w") as f:
+                f.write(format_base_dockerfile(python_version, green_zone))
+
+            tar_stream = create_tarball(
+                build_dir, None,
+                [
+                    os.path.join(GREEN_ZONE_CERTIFICATES_DIR, "hwweb.crt"),
+                    os.path.join(GREEN_ZONE_CERTIFICATES_DIR, "hwweb.pem"),
+                ] if green_zone else []
+            )
+            await run_docker_build(client, tar_stream, base_image, build_dir)
+            rebuilt_base_images.add(base_image)
+            logger.info(f"Built base image {base_image} in {time.perf_counter() - build_start:.2f} seconds.")
+            return base_image
 
 async def build_docker_image_from_specs(
     client: aiodocker.Docker,
@@ -99,12 +200,19 @@ async def build_docker_image_from_specs(
     green_zone: bool=False,
     registry_config: DockerRegisteryConfig=None,
 ) -> str:
-    """Build or get a Docker image from your specs."""
+    """Build or get a Docker image from your specs.
+
+    The repository goes into the image checked out at the tip of its default branch, so the content of an image
+    only depends on its spec and not on the instance that needs it first. The evaluation checks out each instance commit.
+    """
+    # Build the canonical spec, which is what the image name hashes
+    spec_dict = canonicalize_spec_dict(spec_dict)
     image_name = get_image_name(repo_name, spec_dict)
+    spec_hash = get_spec_hash(spec_dict)
 
     async with image_build_locks[image_name]:
-        if image_name in failed_images:
-            raise Exception(f"Failed to build image {image_name} before. Skipping the build.")
+        if failure := GLOBAL_BUILD_FAILURES.get(image_name, spec_hash):
+            raise Exception(GLOBAL_BUILD_FAILURES.describe(image_name, failure))
 
         # Use TQDMLogger for your logging
         with TQDMLogger(f'build-{image_name}', os.path.join(docker_work_dir, "build-or-fetch.log")) as logger:
@@ -118,16 +226,19 @@ async def build_docker_image_from_specs(
                 # Attempt to PULL from Docker Hub first (if pull_from_registry=True)
                 # IMPORTANT: image_name ALREADY has "byelegumes/..." so no double prefix
                 # --------------------------
-                if registry_config and registry_config["pull_from_registry"]:
+                if registry_config and registry_config["pull_from_registry"] and not get_registry_catalog(registry_config).known_missing(image_name):
                     try:
-                       return pull_img_from_registry(
+                        return await pull_img_from_registry(
                             client,
                             image_name,
                             registry_config,
                             logger
                         )
                     except DockerError as e:
-                        logger.info(f"Image not found in Registry or pull failed: {e}. Will build locally...")
+                        # Only a missing image is built, other errors would likely fail the build as well
+                        if not is_image_not_found(e):
+                            raise e
+                        logger.info(f"Image not found in Registry: {e}. Will build locally...")
 
             # --------------------------
             # Build the image
@@ -148,17 +259,29 @@ async def build_docker_image_from_specs(
             if not pip_packages:
                 logger.warning(f"No pip packages found in the spec for {image_name}.")
 
-            # Create Dockerfile
-            repo_path = get_cached_or_clone_repo(repo_name, clean_cache=force_rebuild,)
-            logger.debug(f"Cloned repo to {repo_path}")
-            
+            # Shared base image with apt, uv and certificates
+            base_image = await build_base_image(client, spec_dict['python'], docker_work_dir, green_zone=green_zone, force_rebuild=force_rebuild)
+
+            # Wheels already in the host wheelhouse are not downloaded again
+            wheelhouse = await GLOBAL_PACKAGE_CACHE.prepare_build_dir(
+                client,
+                base_image,
+                normalize_python_version(spec_dict['python']),
+                [*pip_packages, *(spec_dict.get("packages") or "").split(), *TEST_PACKAGES],
+                build_dir,
+                logger,
+            )
+
+            # Create Dockerfile, the repository snapshot is named like the repository
             formatted_docker = format_dockerfile(
-                repo_path=os.path.basename(repo_path),
+                repo_path=os.path.basename(GLOBAL_REPO_CACHE.repo_path(repo_name)),
                 python_version=spec_dict['python'],
                 pip_packages=pip_packages,
                 packages=spec_dict.get("packages"),
                 pre_install=spec_dict.get("pre_install"),
-                green_zone=green_zone
+                green_zone=green_zone,
+                base_image=base_image,
+                wheelhouse=wheelhouse,
             )
             with open(os.path.join(build_dir, "Dockerfile"), "w") as f:
                 f.write(formatted_docker)
@@ -170,45 +293,25 @@ async def build_docker_image_from_specs(
             with open(patch_script_path, "w") as f:
                 f.write(PATCH_CODE_PY)
 
-            # Create a tarball of the build directory
-            tar_stream = create_tarball(
-                build_dir, repo_path,
-                [
+            additional_files = [
+                os.path.join(PANDAS_INSTALLATION_DIR, "install.sh"),
+                os.path.join(PANDAS_INSTALLATION_DIR, "run_tests.sh"),
+            ] if DOCKER_TEMPLATE == "r2e" else []
+            if green_zone:
+                additional_files += [
                     os.path.join(GREEN_ZONE_CERTIFICATES_DIR, "hwweb.crt"),
                     os.path.join(GREEN_ZONE_CERTIFICATES_DIR, "hwweb.pem"),
-                    os.path.join(PANDAS_INSTALLATION_DIR, "install.sh"),
-                    os.path.join(PANDAS_INSTALLATION_DIR, "run_tests.sh"),
-                ] if green_zone else []
-            )
+                ]
 
-            # Build logs from aiodocker
-            build_logs = client.images.build(
-                fileobj=tar_stream,
-                tag=image_name,
-                encoding="gzip",
-                forcerm=True,
-                rm=True,
-                stream=True,
-            )
+            # Check out the default branch from the local mirror, the build itself needs no network for the repository,
+            # only when the build context cache has no entry of its revision
+            async with GLOBAL_REPO_CACHE.snapshot(repo_name, logger=logger) as snapshot:
+                logger.debug(f"Resolved {repo_name} at {snapshot.revision}")
 
-            # Capture logs to build.log
-            with MindForgeHarnessLogger(f"build-{image_name}", os.path.join(build_dir, "build.log"), add_stdout=True) as build_logger:
-                try:
-                    async for log in build_logs:
-                        if 'stream' in log:
-                            build_logger.debug(log['stream'].strip())
-                        elif 'error' in log:
-                            build_logger.error(f"Error: {log['error']}")
-                            failed_images.add(image_name)
-                            raise Exception(f"Build failed: {log['error']}.\n"
-                                            f"For more details, check the logs at {build_dir}")
-                except DockerError as e:
-                    build_logger.error(f"Failed to fetch the logs while building {image_name}:\n {e}")
-                    raise e
-                except TimeoutError:
-                    error = f"Build timeout after {client.session.timeout.total} seconds."
-                    build_logger.error(error)
-                    raise TimeoutError(error)
+                # Stream a compressed tarball of the build context, produced while the daemon reads it
+                tar_stream = await GLOBAL_CONTEXT_CACHE.create_snapshot_tarball(build_dir, snapshot, additional_files)
+
+                await run_docker_build(client, tar_stream, image_name, build_dir, spec_hash=spec_hash)
 
             # Cleanup
             os.remove(patch_script_path)
@@ -216,14 +319,139 @@ async def build_docker_image_from_specs(
             logger.info(f"Built Docker image {image_name} in {time.perf_counter() - build_start:.2f} seconds.")
 
             # --------------------------
-            # Push to Docker Hub if requested
+            # Push to Docker Hub if requested, in the background so the image can be used right away
             # --------------------------
             if registry_config and registry_config["push_to_registry"]:
-                await push_img_to_registry(client, image_name, registry_config, logger)
+                GLOBAL_PUSH_QUEUE.submit(client, image_name, registry_config, os.path.join(build_dir, "push.log"))
 
             return image_name
 
-async def build_all_images(data_path: str, log_dir: str=None, force_build=False, green_zone=False):
+class BuildScheduler:
+    """Build every distinct image once, under a concurrency budget separate from the test runs.
+
+    Instances are grouped by `get_image_name`, so all instances sharing a spec wait on the same build.
+    Builds are I/O- and network-bound, so they get their own limit instead of taking test run slots.
+    """
+
+    def __init__(
+        self,
+        client: aiodocker.Docker,
+        docker_work_dir: str,
+        max_build_workers: int=4,
+        force_rebuild: bool=False,
+        green_zone: bool=False,
+        registry_config: DockerRegisteryConfig=None,
+    ):
+        """Create a scheduler building with `client` into `docker_work_dir`."""
+        self.client = client
+        self.docker_work_dir = docker_work_dir
+        self.force_rebuild = force_rebuild
+        self.green_zone = green_zone
+        self.registry_config = registry_config
+        self.builds: dict[str, asyncio.Task] = {}
+        self.build_times: dict[str, float] = {}
+        self.queue_depth = 0  # Builds waiting for a free build slot
+        self.running = 0
+        self._sem = asyncio.Semaphore(max_build_workers)
+
+    def schedule(self, repo_name: str, spec_dict: dict, image_name: str=None) -> asyncio.Task:
+        """Schedule the build of the image of a spec, or return the build already scheduled for it."""
+        image_name = image_name or get_image_name(repo_name, spec_dict)
+        if image_name not in self.builds:
+            self.builds[image_name] = asyncio.create_task(self._build(image_name, repo_name, spec_dict))
+        return self.builds[image_name]
+
+    async def get(self, repo_name: str, spec_dict: dict, image_name: str=None) -> str:
+        """Wait for the image of a spec to be ready and return its name."""
+        # Shield the shared build, so a cancelled waiter does not cancel it for everyone else
+        return await asyncio.shield(self.schedule(repo_name, spec_dict, image_name))
+
+    async def plan(self, instances: Iterable[dict]) -> dict:
+        """Find the distinct images the instances need, check which exist and start preparing all of them."""
+        specs = {}
+        for instance in instances:
+            if instance.get('spec_dict'):
+                image_name = instance.get('image_name') or get_image_name(instance['repo'], instance['spec_dict'])
+                specs.setdefault(image_name, (instance['repo'], instance['spec_dict']))
+        existing = await asyncio.gather(*(get_from_existing_image(self.client, image_name) for image_name in specs))
+        known_failed = sum(
+            1 for (image_name, (_, spec_dict)), found in zip(specs.items(), existing)
+            if not found and GLOBAL_BUILD_FAILURES.get(image_name, get_spec_hash(spec_dict))
+        )
+        # Ask the registry about all missing images at once, so the builds know whether to pull or build
+        in_registry = 0
+        if self.registry_config and self.registry_config['pull_from_registry']:
+            missing = [image_name for image_name, found in zip(specs, existing) if not found]
+            answers = await get_registry_catalog(self.registry_config).check(missing, self.registry_config)
+            in_registry = sum(1 for answer in answers.values() if answer)
+        for image_name, (repo_name, spec_dict) in specs.items():
+            self.schedule(repo_name, spec_dict, image_name)
+        return {
+            "images": len(specs),
+            "existing": sum(1 for name in existing if name),
+            "in_registry": in_registry,
+            "known_failed": known_failed,
+        }
+
+    async def _build(self, image_name: str, repo_name: str, spec_dict: dict) -> str:
+        """Build one image once a build slot is free."""
+        # Images that already exist never wait behind running builds for a slot
+        if not self.force_rebuild and await get_from_existing_image(self.client, image_name):
+            self.build_times[image_name] = 0.0
+            return image_name
+
+        # Known-bad builds fail right away instead of waiting for a build slot
+        if failure := GLOBAL_BUILD_FAILURES.get(image_name, get_spec_hash(spec_dict)):
+            raise Exception(GLOBAL_BUILD_FAILURES.describe(image_name, failure))
+
+        self.queue_depth += 1
+        try:
+            await self._sem.acquire()
+        finally:
+            self.queue_depth -= 1
+        self.running += 1
+        build_start = time.perf_counter()
+        try:
+            return await build_docker_image_from_specs(
+                client=self.client,
+                repo_name=repo_name,
+                spec_dict=spec_dict,
+                docker_work_dir=self.docker_work_dir,
+                force_rebuild=self.force_rebuild,
+                green_zone=self.green_zone,
+                registry_config=self.registry_config,
+            )
+        finally:
+            self.build_times[image_name] = time.perf_counter() - build_start
+            self.running -= 1
+            self._sem.release()
+
+    async def build_all(self, instances: Iterable[dict]) -> dict[str, BaseException]:
+        """Build the images of all instances with 'repo' & 'spec_dict', returning the errors by image name."""
+        for instance in instances:
+            self.schedule(instance['repo'], instance['spec_dict'], instance.get('image_name'))
+        await asyncio.gather(*self.builds.values(), return_exceptions=True)
+        return self.errors()
+
+    def errors(self) -> dict[str, BaseException]:
+        """Get the errors of the finished builds that failed."""
+        return {
+            image_name: task.exception()
+            for image_name, task in self.builds.items()
+            if task.done() and not task.cancelled() and task.exception()
+        }
+
+    def summary(self) -> dict:
+        """Summarize the builds scheduled so far."""
+        return {
+            "images": len(self.builds),
+            "failed": len(self.errors()),
+            "queue_depth": self.queue_depth,
+            "running": self.running,
+            "build_times": dict(sorted(self.build_times.items(), key=lambda x: -x[1])),
+        }
+
+async def build_all_images(data_path: str, log_dir: str=None, force_build=False, green_zone=False, max_build_workers: int=4):
     """Build all images from a data file. Each line in data file is a JSON object with 'repo' & 'spec_dict'."""
     client = aiodocker.Docker()
 
@@ -234,19 +462,21 @@ async def build_all_images(data_path: str, log_dir: str=None, force_build=False,
     docker_work_dir = log_dir or tempfile.mkdtemp()
     os.makedirs(docker_work_dir, exist_ok=True)
 
-    for instance in data:
-        repo = instance['repo']
-        spec_dict = instance['spec_dict']
-        await build_docker_image_from_specs(
-            client,
-            repo,
-            spec_dict,
-            docker_work_dir,
-            force_rebuild=force_build,
-            green_zone=green_zone,
-            registry_config=GLOBAL_REGISTRY_CONFIG,
-        )
+    scheduler = BuildScheduler(
+        client,
+        docker_work_dir,
+        max_build_workers=max_build_workers,
+        force_rebuild=force_build,
+        green_zone=green_zone,
+        registry_config=GLOBAL_REGISTRY_CONFIG,
+    )
+    errors = await scheduler.build_all(data)
+    with MindForgeHarnessLogger("build-all", log_file=None, add_stdout=True) as logger:
+        await GLOBAL_PUSH_QUEUE.join(logger)
     await client.close()
+    for image_name, error in errors.items():
+        print(f"Failed to build image {image_name}: {error}")
+    return scheduler.summary()
 
 async def build_a_spec(repo: str, spec_dict: dict, log_dir: str=None, force_build=False, green_zone=False):
     """Build a single spec."""
@@ -262,17 +492,18 @@ async def build_a_spec(repo: str, spec_dict: dict, log_dir: str=None, force_buil
         green_zone=green_zone,
         registry_config=GLOBAL_REGISTRY_CONFIG,
     )
+    with MindForgeHarnessLogger("build-a-spec", log_file=None, add_stdout=True) as logger:
+        await GLOBAL_PUSH_QUEUE.join(logger)
     await client.close()
 
-async def clean_up_images(client: aiodocker.Docker, images_to_remove: Iterable[str]=image_build_locks.keys()):
-    """Clean up images that are not in the image_build_locks."""
-    for image in images_to_remove:
-        if image in failed_images:
-            continue
-        
-        if name := get_from_existing_image(client, image):
+async def clean_up_images(client: aiodocker.Docker, images_to_remove: Iterable[str]=None):
+    """Remove the given images, by default all images built or looked up by this process."""
+    # Copy, the locks are created lazily and the dict must not change while iterating
+    for image in list(image_build_locks.keys() if images_to_remove is None else images_to_remove):
+        if name := await get_from_existing_image(client, image):
             try:
                 await client.images.delete(name, force=True)
+                get_image_index(client).discard(name)
                 print(f"Removed image {name}")
             except DockerError as e:
                 print(f"Failed to remove image {name}: {e}")
@@ -0,0 +1,170 @@
+"""Disk-budgeted garbage collection of the harness images."""
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+
+import aiodocker
+import orjson
+from aiodocker.exceptions import DockerError
+
+from mindforge_harness.docker.docker_utils import get_image_index, normalize_image_tag
+from mindforge_harness.logger import MindForgeHarnessLogger
+from mindforge_harness.utils import parse_size
+
+IMAGE_USAGE_FILE = os.environ.get("IMAGE_USAGE_FILE", "image_usage.json")
+MF_IMAGE_DISK_BUDGET = parse_size(os.environ.get("MF_IMAGE_DISK_BUDGET", "0"))  # 0 disables the collection
+MF_IMAGE_GC_INTERVAL = float(os.environ.get("MF_IMAGE_GC_INTERVAL", "60"))
+
+# Only the images created by the harness are ever collected
+IMAGE_PREFIX = "eval-"
+BASE_IMAGE_PREFIX = "eval-base-"
+# Post-install checkpoints of a spec image at a commit are named `<spec image>-ckpt-<hash>`
+CHECKPOINT_TAG = "-ckpt-"
+
+class ImageGarbageCollector:
+    """Evict the least recently used harness images once they take more than `disk_budget` bytes.
+
+    Last-use times are persisted in `usage_file`, so the order survives across runs. Images needed by a
+    queued or running instance are protected with `protect`/`release` and are never evicted. Base images
+    are shared by all spec images of a python version, so they are only evicted when nothing is protected.
+    Checkpoint images are the cheapest to recreate, so they are evicted before spec images.
+    The size of a spec image only counts its own layers, as removing it does not free the shared ones.
+    An image with several tags is counted once, and only frees its size once its last tag is removed.
+    """
+
+    def __init__(self, usage_file: str=IMAGE_USAGE_FILE, disk_budget: int=MF_IMAGE_DISK_BUDGET, interval: float=MF_IMAGE_GC_INTERVAL):
+        """Create a collector keeping the harness images within `disk_budget` bytes."""
+        self.usage_file = usage_file
+        self.disk_budget = disk_budget
+        self.interval = interval
+        self.last_used: dict[str, float] = None
+        self.protected: Counter = Counter()
+        self.evicted: list[str] = []
+        self._lock = asyncio.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        """Whether a disk budget is set."""
+        return self.disk_budget > 0
+
+    def load(self) -> dict[str, float]:
+        """Load the persisted last-use times once."""
+        if self.last_used is None:
+            self.last_used = {}
+            if os.path.exists(self.usage_file):
+                with open(self.usage_file, "rb") as f:
+                    self.last_used = orjson.loads(f.read())
+        return self.last_used
+
+    def save(self) -> None:
+        """Persist the last-use times atomically."""
+        if self.last_used is None:
+            return
+        if os.path.dirname(self.usage_file):
+            os.makedirs(os.path.dirname(self.usage_file), exist_ok=True)
+        tmp_path = f"{self.usage_file}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps(self.last_used))
+        os.replace(tmp_path, self.usage_file)
+
+    def touch(self, image_name: str) -> None:
+        """Mark an image as used now."""
+        self.load()[normalize_image_tag(image_name)] = time.time()
+
+    def protect(self, image_name: str) -> None:
+        """Keep an image while a queued or running instance needs it."""
+        self.protected[normalize_image_tag(image_name)] += 1
+
+    def release(self, image_name: str) -> None:
+        """Release one protection of an image, marking it as used."""
+        tag = normalize_image_tag(image_name)
+        self.protected[tag] -= 1
+        if self.protected[tag] <= 0:
+            del self.protected[tag]
+        self.touch(tag)
+
+    async def list_images(self, client: aiodocker.Docker) -> list[dict]:
+        """List the harness images as dicts with 'tag', 'id', 'size' and 'created', one per tag."""
+        images = await client.images.list(filters={"reference": [f"{IMAGE_PREFIX}*"]}, **{"shared-size": "1"})
+        entries = []
+        for img in images:
+            for tag in img.get('RepoTags') or []:
+                if not tag.startswith(IMAGE_PREFIX):
+                    continue
+                size = img.get('Size', 0)
+                if not tag.startswith(BASE_IMAGE_PREFIX) and img.get('SharedSize', -1) >= 0:
+                    size -= img['SharedSize']  # Only the layers of the spec itself
+                entries.append({"tag": tag, "id": img.get('Id', tag), "size": size, "created": img.get('Created', 0)})
+        return entries
+
+    async def collect(self, client: aiodocker.Docker, logger: logging.Logger) -> list[str]:
+        """Remove the least recently used unprotected images until the harness images fit in the budget."""
+        if not self.enabled:
+            return []
+        async with self._lock:
+            last_used = self.load()
+            images = await self.list_images(client)
+            sizes = {img['id']: img['size'] for img in images}
+            tags = Counter(img['id'] for img in images)
+            total = sum(sizes.values())
+            evicted = []
+            if total > self.disk_budget:
+                logger.info(f"Harness images use {total / 1024 ** 3:.2f} GiB, over the budget of {self.disk_budget / 1024 ** 3:.2f} GiB.")
+                # Checkpoints, then spec images, the least recently used first. Unknown images count as used when created
+                candidates = sorted(
+                    images,
+                    key=lambda img: (
+                        img['tag'].startswith(BASE_IMAGE_PREFIX),
+                        CHECKPOINT_TAG not in img['tag'],
+                        last_used.get(img['tag'], img['created']),
+                    ),
+                )
+                for img in candidates:
+                    if total <= self.disk_budget:
+                        break
+                    if img['tag'] in self.protected or (img['tag'].startswith(BASE_IMAGE_PREFIX) and self.protected):
+                        continue
+                    try:
+                        await client.images.delete(img['tag'])
+                    except DockerError as e:
+                        # Still used by a container that is not managed by this run
+                        logger.debug(f"Failed to remove image {img['tag']}: {e}")
+                        continue
+                    get_image_index(client).discard(img['tag'])
+                    last_used.pop(img['tag'], None)
+                    tags[img['id']] -= 1
+                    if not tags[img['id']]:
+                        total -= img['size']  # The last tag of the image, its layers are gone
+                    evicted.append(img['tag'])
+                    logger.info(f"Evicted image {img['tag']} ({img['size'] / 1024 ** 2:.0f} MiB).")
+                if total > self.disk_budget:
+                    logger.warning(f"Harness images still use {total / 1024 ** 3:.2f} GiB, the rest is in use.")
+            self.evicted.extend(evicted)
+            self.save()
+            return evicted
+
+    async def run(self, client: aiodocker.Docker, logger: logging.Logger) -> None:
+        """Collect periodically until cancelled."""
+        while True:
+            try:
+                await self.collect(client, logger)
+            except DockerError as e:
+                logger.warning(f"Image garbage collection failed: {e}")
+            await asyncio.sleep(self.interval)
+
+async def run_gc(disk_budget: str=None) -> list[str]:
+    """Collect the harness images once, outside of a run."""
+    if disk_budget:
+        GLOBAL_IMAGE_GC.disk_budget = parse_size(disk_budget)
+    with MindForgeHarnessLogger("image-gc", log_file=None, add_stdout=True) as logger:
+        if not GLOBAL_IMAGE_GC.enabled:
+            logger.warning("No image disk budget, set --image_disk_budget or MF_IMAGE_DISK_BUDGET.")
+            return []
+        async with aiodocker.Docker() as client:
+            evicted = await GLOBAL_IMAGE_GC.collect(client, logger)
+        logger.info(f"Evicted {len(evicted)} images.")
+        return evicted
+
+GLOBAL_IMAGE_GC = ImageGarbageCollector()
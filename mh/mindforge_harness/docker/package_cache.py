@@ -0,0 +1,191 @@
+"""Persistent host-side wheelhouse shared by all image builds."""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import shutil
+from pathlib import Path
+from uuid import uuid4
+
+import aiodocker
+import orjson
+
+from mindforge_harness.utils import parse_size
+
+WHEELHOUSE_DIR = os.environ.get("WHEELHOUSE_DIR", "wheelhouse_caches")
+WHEELHOUSE_MAX_SIZE = parse_size(os.environ.get("WHEELHOUSE_MAX_SIZE", "50G"))
+MF_USE_WHEELHOUSE = os.environ.get("MF_USE_WHEELHOUSE", "false").lower() in ("true", "1")
+MF_OFFLINE_BUILDS = os.environ.get("MF_OFFLINE_BUILDS", "false").lower() in ("true", "1")
+
+# Packages installed in every spec image on top of the spec's own packages
+TEST_PACKAGES = ["pytest", "pytest-json-report", "pytest-timeout"]
+
+# Build args are only visible to the RUN steps of the build and are not kept in the image
+WHEELHOUSE_LAYER = """
+COPY wheelhouse /wheelhouse
+ARG UV_FIND_LINKS=/wheelhouse
+ARG PIP_FIND_LINKS=/wheelhouse
+ARG UV_OFFLINE={offline}
+ARG PIP_NO_INDEX={offline}
+"""
+
+DOWNLOAD_LINE = re.compile(r"^(Saved|File was already downloaded) /wheelhouse/(\S+)", re.MULTILINE)
+
+class PackageCache:
+    """Wheelhouse directory on the host, filled by `pip download` and copied into the build contexts.
+
+    The wheels a spec needs are downloaded once, from inside its base image so that the platform matches
+    and with pip run by `uvx` on the spec's python, since the bases do not all ship pip, into a directory
+    shared by all builds. Each build gets hardlinks of the wheels
+    listed in the spec's manifest and installs with `--find-links`, so packages already in the wheelhouse
+    are never downloaded again. When every wheel of a spec is cached, the build can run fully offline.
+    The wheelhouse is bounded by `max_size` bytes and evicts the least recently used wheels.
+    """
+
+    def __init__(
+        self,
+        wheelhouse_dir: str=WHEELHOUSE_DIR,
+        max_size: int=WHEELHOUSE_MAX_SIZE,
+        enabled: bool=MF_USE_WHEELHOUSE,
+        offline: bool=MF_OFFLINE_BUILDS,
+    ):
+        """Create a wheelhouse in `wheelhouse_dir` holding at most `max_size` bytes."""
+        self.wheelhouse_dir = os.path.abspath(wheelhouse_dir)
+        self.max_size = max_size
+        self.enabled = enabled
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self._locks: dict[str, asyncio.Lock] = {}
+
+    @property
+    def hit_ratio(self) -> float:
+        """Ratio of the wheels that were already in the wheelhouse when a build needed them."""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def manifest_path(self, base_image: str, python_version: str, packages: list[str]) -> str:
+        """Path of the manifest listing the wheelhouse files needed for packages on a base image and python version."""
+        key = hashlib.sha256(orjson.dumps([base_image, python_version, sorted(packages)])).hexdigest()
+        return os.path.join(self.wheelhouse_dir, "manifests", f"{key}.json")
+
+    def load_manifest(self, base_image: str, python_version: str, packages: list[str]) -> list[str]:
+        """Load the manifest of packages on a base image and python version, or None if it is missing or some files were evicted."""
+        manifest_path = self.manifest_path(base_image, python_version, packages)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path, "rb") as f:
+            files = orjson.loads(f.read())
+        if not all(os.path.exists(os.path.join(self.wheelhouse_dir, file)) for file in files):
+            return None
+        return files
+
+    async def prefetch(
+        self,
+        client: aiodocker.Docker,
+        base_image: str,
+        python_version: str,
+        packages: list[str],
+        logger: logging.Logger,
+    ) -> list[str]:
+        """Download the missing wheels of packages for a python version into the wheelhouse and return the files they need."""
+        manifest_path = self.manifest_path(base_image, python_version, packages)
+        lock = self._locks.setdefault(manifest_path, asyncio.Lock())
+        async with lock:
+            if (files := self.load_manifest(base_image, python_version, packages)) is not None:
+                self.hits += len(files)
+                return files
+            if self.offline:
+                raise Exception(f"Offline build but the wheelhouse misses packages of {base_image} for python {python_version}. "
+                                "Fill it with --use_wheelhouse on a host with network access first.")
+
+            os.makedirs(self.wheelhouse_dir, exist_ok=True)
+            container = await client.containers.create_or_replace(
+                name=f"wheelhouse-{uuid4()}",
+                config={
+                    "Image": base_image,
+                    "Cmd": ["uvx", "--python", python_version, "pip", "download", "--dest", "/wheelhouse", *packages],
+                    "HostConfig": {"Binds": [f"{self.wheelhouse_dir}:/wheelhouse:rw"]},
+                },
+            )
+            try:
+                await container.start()
+                status = await container.wait()
+                logs = "\n".join(await container.log(stdout=True, stderr=True))
+            finally:
+                await container.delete(force=True)
+
+            if status.get("StatusCode"):
+                logger.warning(f"Failed to download packages into the wheelhouse, building without it:\n{logs[-2000:]}")
+                return []
+
+            files = []
+            for action, file in DOWNLOAD_LINE.findall(logs):
+                files.append(file)
+                if action == "Saved":
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+            with open(manifest_path, "wb") as f:
+                f.write(orjson.dumps(sorted(set(files))))
+        await asyncio.to_thread(self.evict)
+        return files
+
+    def link_into(self, files: list[str], build_dir: str) -> None:
+        """Hardlink (or copy across devices) wheelhouse files into `build_dir`/wheelhouse, marking them as used."""
+        target_dir = os.path.join(build_dir, "wheelhouse")
+        shutil.rmtree(target_dir, ignore_errors=True)
+        os.makedirs(target_dir)
+        for file in files:
+            source = os.path.join(self.wheelhouse_dir, file)
+            os.utime(source)  # Mark as recently used
+            try:
+                os.link(source, os.path.join(target_dir, file))
+            except OSError:
+                shutil.copy2(source, os.path.join(target_dir, file))
+
+    def evict(self) -> list[str]:
+        """Remove the least recently used wheels until the wheelhouse fits in `max_size`."""
+        if not os.path.isdir(self.wheelhouse_dir):
+            return []
+        entries = [(p.stat().st_mtime, p.stat().st_size, p) for p in Path(self.wheelhouse_dir).iterdir() if p.is_file()]
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            evicted.append(path.name)
+        return evicted
+
+    async def prepare_build_dir(
+        self,
+        client: aiodocker.Docker,
+        base_image: str,
+        python_version: str,
+        packages: list[str],
+        build_dir: str,
+        logger: logging.Logger,
+    ) -> str:
+        """Fill the wheelhouse of a build directory and return the Dockerfile lines using it."""
+        if not self.enabled:
+            return ""
+        for attempt in range(2):
+            files = await self.prefetch(client, base_image, python_version, packages, logger)
+            if not files:
+                return ""
+            try:
+                self.link_into(files, build_dir)
+                break
+            except FileNotFoundError as e:
+                # Evicted by another build since the manifest was read, which now misses and is downloaded again
+                if attempt:
+                    raise e
+                logger.info(f"Wheelhouse file evicted while linking it, fetching the packages of {base_image} again: {e}")
+        logger.info(f"Wheelhouse: {len(files)} files for {base_image}, hit ratio {self.hit_ratio:.0%}")
+        return WHEELHOUSE_LAYER.format(offline="true" if self.offline else "false")
+
+GLOBAL_PACKAGE_CACHE = PackageCache()
@@ -0,0 +1,110 @@
+"""Background queue pushing built images to the registry, outside of the build locks."""
+import asyncio
+import logging
+import os
+import time
+
+import aiodocker
+
+from mindforge_harness.docker.docker_utils import DockerRegisteryConfig, push_img_to_registry
+from mindforge_harness.docker.image_gc import GLOBAL_IMAGE_GC
+from mindforge_harness.logger import TQDMLogger
+
+MF_MAX_PUSH_WORKERS = int(os.environ.get("MF_MAX_PUSH_WORKERS", "2"))
+MF_PUSH_RETRIES = int(os.environ.get("MF_PUSH_RETRIES", "3"))
+MF_PUSH_BACKOFF = float(os.environ.get("MF_PUSH_BACKOFF", "5"))
+
+class PushQueue:
+    """Push images in the background with at most `max_workers` uploads at a time.
+
+    An image is handed to the queue once it is built, so the instances waiting on it run right away
+    instead of waiting for a multi-GB upload. Each image is pushed once per run, failed pushes are
+    retried `retries` times with exponential backoff, and the image is kept from the garbage collector
+    until its push is over.
+    """
+
+    def __init__(self, max_workers: int=MF_MAX_PUSH_WORKERS, retries: int=MF_PUSH_RETRIES, backoff: float=MF_PUSH_BACKOFF):
+        """Create a queue running `max_workers` pushes at a time."""
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.pushes: dict[str, asyncio.Task] = {}
+        self.status: dict[str, dict] = {}
+        self._sem = asyncio.Semaphore(max_workers)
+
+    def submit(self, client: aiodocker.Docker, image_name: str, registry_config: DockerRegisteryConfig, log_file: str) -> asyncio.Task:
+        """Queue the push of an image, logging to `log_file`, or return the push already queued for it."""
+        if image_name not in self.pushes:
+            self.status[image_name] = {"state": "queued", "attempts": 0, "bytes": 0, "seconds": 0.0, "error": None}
+            GLOBAL_IMAGE_GC.protect(image_name)
+            self.pushes[image_name] = asyncio.create_task(self._push(client, image_name, registry_config, log_file))
+        return self.pushes[image_name]
+
+    async def _push(self, client: aiodocker.Docker, image_name: str, registry_config: DockerRegisteryConfig, log_file: str) -> None:
+        """Push one image once a push slot is free, retrying with backoff without holding the slot."""
+        status = self.status[image_name]
+        push_start = time.perf_counter()
+        try:
+            with TQDMLogger(f'push-{image_name}', log_file) as logger:
+                await self._push_with_retries(client, image_name, registry_config, logger, status)
+        finally:
+            status["seconds"] = time.perf_counter() - push_start
+            GLOBAL_IMAGE_GC.release(image_name)
+
+    async def _push_with_retries(
+        self,
+        client: aiodocker.Docker,
+        image_name: str,
+        registry_config: DockerRegisteryConfig,
+        logger: logging.Logger,
+        status: dict,
+    ) -> None:
+        """Attempt the push until it succeeds or the retries are exhausted."""
+        while True:
+            async with self._sem:
+                status["state"] = "pushing"
+                status["attempts"] += 1
+                try:
+                    await push_img_to_registry(
+                        client, image_name, registry_config, logger,
+                        on_progress=lambda uploaded: status.update(bytes=uploaded),
+                    )
+                    status["state"] = "pushed"
+                    return
+                except Exception as e:
+                    status["error"] = str(e)
+            if status["attempts"] > self.retries:
+                status["state"] = "failed"
+                logger.error(f"Giving up pushing {image_name} after {status['attempts']} attempts: {status['error']}")
+                return
+            status["state"] = "queued"
+            delay = self.backoff * 2 ** (status["attempts"] - 1)
+            logger.warning(f"Push of {image_name} failed, retrying in {delay:.0f} seconds: {status['error']}")
+            await asyncio.sleep(delay)
+
+    def progress(self) -> dict[str, int]:
+        """Count the pushes by state."""
+        counts = {"queued": 0, "pushing": 0, "pushed": 0, "failed": 0}
+        for status in self.status.values():
+            counts[status["state"]] += 1
+        return counts
+
+    async def join(self, logger: logging.Logger, interval: float=30) -> dict[str, dict]:
+        """Wait for all queued pushes, logging the progress every `interval` seconds, and return their status."""
+        pending = [task for task in self.pushes.values() if not task.done()]
+        while pending:
+            _, pending = await asyncio.wait(pending, timeout=interval)
+            if pending:
+                counts = self.progress()
+                uploading = sum(s["bytes"] for s in self.status.values() if s["state"] == "pushing")
+                logger.info(f"Waiting for {len(pending)} image pushes: {counts['pushed']} pushed, {counts['failed']} failed, "
+                            f"{uploading / 1024 ** 2:.0f} MiB uploaded by the running pushes.")
+        counts = self.progress()
+        if self.status:
+            logger.info(f"Pushed {counts['pushed']} images to the registry, {counts['failed']} failed.")
+        for image_name, status in self.status.items():
+            if status["state"] == "failed":
+                logger.info(f"Failed to push {image_name} after {status['attempts']} attempts: {status['error']}")
+        return self.status
+
+GLOBAL_PUSH_QUEUE = PushQueue()
@@ -0,0 +1,152 @@
+"""Check which images a Docker registry holds through its HTTP API, without pulling them."""
+import asyncio
+import base64
+import os
+import re
+
+import aiohttp
+
+from mindforge_harness.docker.docker_utils import DockerRegisteryConfig, get_registry_img_name
+
+MF_REGISTRY_SCHEME = os.environ.get("MF_REGISTRY_SCHEME", "https")  # Plain http only when set explicitly
+MF_REGISTRY_MAX_CONNECTIONS = int(os.environ.get("MF_REGISTRY_MAX_CONNECTIONS", "32"))
+
+DOCKER_HUB_REGISTRY = "registry-1.docker.io"
+MANIFEST_MEDIA_TYPES = ", ".join([
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.oci.image.index.v1+json",
+])
+BEARER_CHALLENGE = re.compile(r'(\w+)="([^"]*)"')
+
+class RegistryCatalog:
+    """Answer whether images exist in a registry with parallel manifest HEAD requests.
+
+    Requests share one pooled session, and every answer is cached for the whole run, so the planner and
+    the builds never ask twice for the same image. Registries using token authentication (Docker Hub)
+    get a bearer token per repository, others get basic authentication.
+    """
+
+    def __init__(
+        self,
+        registry_url: str,
+        username: str=None,
+        password: str=None,
+        scheme: str=MF_REGISTRY_SCHEME,
+        max_connections: int=MF_REGISTRY_MAX_CONNECTIONS,
+        timeout: float=30,
+    ):
+        """Create a catalog of `registry_url`, or of Docker Hub when it is empty or docker.io."""
+        self.host = registry_url if registry_url and registry_url != 'docker.io' else DOCKER_HUB_REGISTRY
+        self.basic_auth = None
+        if username:
+            credentials = base64.b64encode(f"{username}:{password or ''}".encode()).decode()
+            self.basic_auth = f"Basic {credentials}"
+        self.scheme = scheme
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.answers: dict[str, bool] = {}
+        self.requests = 0
+        self._checks: dict[str, asyncio.Task] = {}
+        self._tokens: dict[str, str] = {}
+        self._session: aiohttp.ClientSession = None
+        self._loop: asyncio.AbstractEventLoop = None
+
+    @classmethod
+    def from_config(cls, registry_config: DockerRegisteryConfig) -> "RegistryCatalog":
+        """Create the catalog of the registry of a harness registry configuration."""
+        return cls(registry_config['registry_url'], registry_config['registry_user'], registry_config['registry_pass'])
+
+    async def session(self) -> aiohttp.ClientSession:
+        """Get the pooled session, created on first use in the running event loop."""
+        if self._session is not None and self._loop is not asyncio.get_running_loop():
+            try:
+                await self.close()  # Opened in the loop of an earlier run
+            except RuntimeError:
+                pass  # Its loop is closed, and its connections with it
+            self._session = None
+        if self._session is None or self._session.closed:
+            self._loop = asyncio.get_running_loop()
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def close(self) -> None:
+        """Close the session. The answers are kept."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    async def _token(self, challenge: str, repository: str) -> str:
+        """Get a bearer token for pulling `repository` from the realm of a `WWW-Authenticate` challenge."""
+        if repository not in self._tokens:
+            params = dict(BEARER_CHALLENGE.findall(challenge))
+            realm = params.pop("realm")
+            params.setdefault("scope", f"repository:{repository}:pull")
+            headers = {"Authorization": self.basic_auth} if self.basic_auth else {}
+            session = await self.session()
+            async with session.get(realm, params=params, headers=headers) as response:
+                response.raise_for_status()
+                body = await response.json()
+            self._tokens[repository] = body.get("token") or body.get("access_token")
+        return self._tokens[repository]
+
+    async def _head_manifest(self, repository: str, tag: str) -> bool:
+        """HEAD the manifest of `repository`:`tag`."""
+        url = f"{self.scheme}://{self.host}/v2/{repository}/manifests/{tag}"
+        headers = {"Accept": MANIFEST_MEDIA_TYPES}
+        if repository in self._tokens:
+            headers["Authorization"] = f"Bearer {self._tokens[repository]}"
+        elif self.basic_auth:
+            headers["Authorization"] = self.basic_auth
+        self.requests += 1
+        session = await self.session()
+        async with session.head(url, headers=headers) as response:
+            challenge = response.headers.get("WWW-Authenticate", "")
+            if response.status == 401 and challenge.startswith("Bearer") and repository not in self._tokens:
+                await self._token(challenge, repository)
+                return await self._head_manifest(repository, tag)
+            if response.status == 404:
+                return False
+            response.raise_for_status()
+            return True
+
+    async def has_image(self, image_name: str, registry_config: DockerRegisteryConfig) -> bool:
+        """Whether the registry holds an image, or None if the registry could not be asked."""
+        if image_name in self.answers:
+            return self.answers[image_name]
+        if image_name not in self._checks:
+            repository = get_registry_img_name(image_name, registry_config)
+            if repository.startswith(f"{self.host}/"):
+                repository = repository[len(self.host) + 1:]
+            repository, _, tag = repository.partition(":")
+            self._checks[image_name] = asyncio.ensure_future(self._head_manifest(repository, tag or "latest"))
+        try:
+            self.answers[image_name] = await asyncio.shield(self._checks[image_name])
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None  # Unknown, a pull will tell
+        finally:
+            self._checks.pop(image_name, None)
+        return self.answers[image_name]
+
+    async def check(self, image_names: list[str], registry_config: DockerRegisteryConfig) -> dict[str, bool]:
+        """Check images in parallel, returning True/False per image, or None when the registry could not tell."""
+        image_names = list(dict.fromkeys(image_names))
+        answers = await asyncio.gather(*(self.has_image(image_name, registry_config) for image_name in image_names))
+        return dict(zip(image_names, answers))
+
+    def known_missing(self, image_name: str) -> bool:
+        """Whether the registry already answered that it does not hold the image."""
+        return self.answers.get(image_name) is False
+
+# One catalog per registry and user, shared by the whole run
+registry_catalogs: dict[tuple[str, str], RegistryCatalog] = {}
+
+def get_registry_catalog(registry_config: DockerRegisteryConfig) -> RegistryCatalog:
+    """Get the catalog of the registry of a harness registry configuration."""
+    key = (registry_config['registry_url'], registry_config['registry_user'])
+    if key not in registry_catalogs:
+        registry_catalogs[key] = RegistryCatalog.from_config(registry_config)
+    return registry_catalogs[key]
@@ -0,0 +1,217 @@
+"""Git repository cache backed by one bare mirror per repository, updated with incremental fetches."""
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+from uuid import uuid4
+
+import git
+
+from mindforge_harness.utils import GIT_REPO_CACHE_DIR, is_valid_git_repo
+
+GIT_REMOTE_URL = os.environ.get("GIT_REMOTE_URL", "https://github.com/{repo}")
+# Commits of history put into build contexts, 0 keeps the whole history
+MF_CONTEXT_HISTORY_DEPTH = int(os.environ.get("MF_CONTEXT_HISTORY_DEPTH", "0"))
+
+# Only branches and tags are mirrored, e.g. not the pull request refs of GitHub
+MIRROR_REFSPECS = ["+refs/heads/*:refs/heads/*", "+refs/tags/*:refs/tags/*"]
+
+class RepoCache:
+    """Cache of the repositories used in build contexts.
+
+    Each repository is cloned once into a bare mirror in `<cache_dir>/mirrors`, and later runs only
+    fetch the new commits into it. The working copy `<cache_dir>/<owner>__<repo>` is cloned from the
+    mirror with hardlinked objects and refreshed from it, so it costs no network.
+    Git runs in worker threads under a per-repository lock, so concurrent builds of a repository share
+    one clone instead of racing, and the event loop keeps serving the other builds meanwhile.
+
+    Build contexts use snapshots: throwaway checkouts of an exact commit made from the mirror, optionally
+    with a shallow history, so image builds never need the network.
+    """
+
+    def __init__(self, cache_dir: str=GIT_REPO_CACHE_DIR, remote_url: str=GIT_REMOTE_URL):
+        """Create a cache in `cache_dir` of the repositories at `remote_url`, formatted with the `owner/repo` name."""
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.mirrors_dir = os.path.join(self.cache_dir, "mirrors")
+        self.snapshots_dir = os.path.join(self.cache_dir, "snapshots")
+        self.remote_url = remote_url
+        self.fetched: set[str] = set()  # Mirrors already up to date in this run
+        self.stats = {"clones": 0, "fetches": 0, "checkouts": 0, "snapshots": 0}
+        self._locks = defaultdict(asyncio.Lock)
+
+    def mirror_path(self, repo_name: str) -> str:
+        """Path of the bare mirror of a repository."""
+        return os.path.join(self.mirrors_dir, f"{repo_name.replace('/', '__')}.git")
+
+    def repo_path(self, repo_name: str) -> str:
+        """Path of the working copy of a repository."""
+        return os.path.join(self.cache_dir, repo_name.replace('/', '__'))
+
+    def update_mirror(self, repo_name: str, logger: logging.Logger) -> str:
+        """Clone the mirror of a repository, or fetch its new commits once per run, and return its path."""
+        mirror_path = self.mirror_path(repo_name)
+        if repo_name in self.fetched and is_valid_git_repo(mirror_path):
+            return mirror_path
+
+        url = self.remote_url.format(repo=repo_name)
+        if is_valid_git_repo(mirror_path):
+            try:
+                git.Repo(mirror_path).git.fetch("--prune", "--tags", "origin")
+                self.stats["fetches"] += 1
+            except git.exc.GitCommandError as e:
+                # The mirror is still usable for the commits it has, e.g. on hosts without network access
+                logger.warning(f"Failed to fetch {url} into {mirror_path}, using the mirror as is: {e}")
+        else:
+            logger.info(f"Cloning {url} into {mirror_path}...")
+            shutil.rmtree(mirror_path, ignore_errors=True)
+            os.makedirs(self.mirrors_dir, exist_ok=True)
+            tmp_path = f"{mirror_path}.{uuid4()}.tmp"
+            try:
+                mirror = git.Repo.clone_from(url, tmp_path, bare=True)
+                mirror.git.config("--replace-all", "remote.origin.fetch", MIRROR_REFSPECS[0])
+                mirror.git.config("--add", "remote.origin.fetch", MIRROR_REFSPECS[1])
+            except Exception as e:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                raise Exception(f"Failed to clone {url}: {e}") from e
+            os.replace(tmp_path, mirror_path)
+            self.stats["clones"] += 1
+        # Shallow snapshots fetch commits by hash, which the mirror serves even when they are not branch tips
+        git.Repo(mirror_path).git.config("uploadpack.allowAnySHA1InWant", "true")
+        self.fetched.add(repo_name)
+        return mirror_path
+
+    def checkout(self, repo_name: str, clean_cache: bool, logger: logging.Logger) -> str:
+        """Update the mirror and materialize or refresh the working copy from it."""
+        mirror_path = self.update_mirror(repo_name, logger)
+        repo_path = self.repo_path(repo_name)
+
+        if not clean_cache and is_valid_git_repo(repo_path):
+            # Only objects and remote branches are fetched, the checked out tree is left as is
+            git.Repo(repo_path).git.fetch("--tags", mirror_path, "+refs/heads/*:refs/remotes/origin/*")
+            return repo_path
+
+        shutil.rmtree(repo_path, ignore_errors=True)
+        tmp_path = f"{repo_path}.{uuid4()}.tmp"
+        try:
+            # A local clone hardlinks the objects of the mirror instead of copying them
+            repo = git.Repo.clone_from(mirror_path, tmp_path, local=True)
+            repo.remote().set_url(self.remote_url.format(repo=repo_name))
+            if os.path.exists(os.path.join(tmp_path, ".gitmodules")):
+                repo.git.submodule("update", "--init", "--recursive")
+        except Exception as e:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise Exception(f"Failed to check out {repo_name} from {mirror_path}: {e}") from e
+        os.replace(tmp_path, repo_path)
+        self.stats["checkouts"] += 1
+        return repo_path
+
+    def resolve_commit(self, repo_name: str, commit: str, logger: logging.Logger) -> str:
+        """Get the full hash of a commit of the mirror, fetching again if it is not there, e.g. a commit pushed during the run."""
+        mirror_path = self.update_mirror(repo_name, logger)
+        try:
+            return git.Repo(mirror_path).git.rev_parse("--verify", f"{commit or 'HEAD'}^{{commit}}")
+        except git.exc.GitCommandError:
+            self.fetched.discard(repo_name)
+            mirror_path = self.update_mirror(repo_name, logger)
+        try:
+            return git.Repo(mirror_path).git.rev_parse("--verify", f"{commit or 'HEAD'}^{{commit}}")
+        except git.exc.GitCommandError as e:
+            raise Exception(f"Commit {commit} not found in {self.remote_url.format(repo=repo_name)}") from e
+
+    def snapshot_revision(self, repo_name: str, commit: str, depth: int) -> str:
+        """Identify the content of a snapshot. A full history also depends on the branches and tags of the mirror."""
+        if depth:
+            return f"{commit}-depth{depth}"
+        refs = git.Repo(self.mirror_path(repo_name)).git.for_each_ref("--format=%(objectname) %(refname)")
+        return f"{commit}-{hashlib.sha256(refs.encode()).hexdigest()}"
+
+    def snapshot_path(self, repo_name: str) -> str:
+        """Path of a new snapshot directory, named like the working copy."""
+        return os.path.join(self.snapshots_dir, uuid4().hex, repo_name.replace('/', '__'))
+
+    def create_snapshot(self, repo_name: str, commit: str, depth: int, snapshot_path: str=None) -> str:
+        """Check out a resolved commit from the mirror into a snapshot directory, a new one unless `snapshot_path` is given."""
+        mirror_path = self.mirror_path(repo_name)
+        snapshot_path = snapshot_path or self.snapshot_path(repo_name)
+        try:
+            if depth:
+                repo = git.Repo.init(snapshot_path)
+                repo.git.fetch(f"--depth={depth}", f"file://{mirror_path}", commit)
+                repo.create_remote("origin", self.remote_url.format(repo=repo_name))
+            else:
+                repo = git.Repo.clone_from(mirror_path, snapshot_path, local=True, no_checkout=True)
+                repo.remote().set_url(self.remote_url.format(repo=repo_name))
+            repo.git.checkout("--detach", commit)
+            if os.path.exists(os.path.join(snapshot_path, ".gitmodules")):
+                repo.git.submodule("update", "--init", "--recursive")
+        except Exception as e:
+            shutil.rmtree(os.path.dirname(snapshot_path), ignore_errors=True)
+            raise Exception(f"Failed to check out {repo_name} at {commit}: {e}") from e
+        self.stats["snapshots"] += 1
+        return snapshot_path
+
+    @asynccontextmanager
+    async def snapshot(
+        self,
+        repo_name: str,
+        commit: str=None,
+        depth: int=MF_CONTEXT_HISTORY_DEPTH,
+        logger: logging.Logger=None,
+    ) -> AsyncIterator["RepoSnapshot"]:
+        """Resolve a repository at `commit`, by default the tip of its default branch, removing its checkout on exit.
+
+        Yields a `RepoSnapshot`, whose revision identifies its content and which is only checked out when it is used,
+        e.g. not when the build context of the revision is cached. With a `depth`, only that many commits of history
+        are kept, so the evaluation can only check out `commit` and its recent parents.
+        """
+        logger = logger or logging.getLogger(__name__)
+        # Only the mirror update is exclusive, snapshots of a repository are checked out concurrently
+        async with self._locks[repo_name]:
+            commit = await asyncio.to_thread(self.resolve_commit, repo_name, commit, logger)
+            revision = await asyncio.to_thread(self.snapshot_revision, repo_name, commit, depth)
+        snapshot = RepoSnapshot(self, repo_name, commit, depth, revision)
+        try:
+            yield snapshot
+        finally:
+            if snapshot.checked_out:
+                await asyncio.to_thread(shutil.rmtree, os.path.dirname(snapshot.path), True)
+
+    async def get_repo(self, repo_name: str, clean_cache: bool=False, logger: logging.Logger=None) -> str:
+        """Get the path of the up to date working copy of a repository, cloning or fetching it off the event loop."""
+        async with self._locks[repo_name]:
+            return await asyncio.to_thread(self.checkout, repo_name, clean_cache, logger or logging.getLogger(__name__))
+
+class RepoSnapshot:
+    """A commit of a repository resolved in the mirror, checked out into `path` on first use."""
+
+    def __init__(self, repo_cache: RepoCache, repo_name: str, commit: str, depth: int, revision: str):
+        """Describe the snapshot of `commit`, without checking it out."""
+        self.repo_cache = repo_cache
+        self.repo_name = repo_name
+        self.commit = commit
+        self.depth = depth
+        self.revision = revision
+        self.path = repo_cache.snapshot_path(repo_name)
+        self.checked_out = False
+        self._lock = asyncio.Lock()
+
+    def read_file(self, path: str) -> str:
+        """Read a file of the commit from the mirror, or None if the commit does not have it."""
+        try:
+            return git.Repo(self.repo_cache.mirror_path(self.repo_name)).git.show(f"{self.commit}:{path}", strip_newline_in_stdout=False)
+        except git.exc.GitCommandError:
+            return None
+
+    async def checkout(self) -> str:
+        """Check out the commit, once, and return the path of the checkout."""
+        async with self._lock:
+            if not self.checked_out:
+                await asyncio.to_thread(self.repo_cache.create_snapshot, self.repo_name, self.commit, self.depth, self.path)
+                self.checked_out = True
+        return self.path
+
+GLOBAL_REPO_CACHE = RepoCache()
@@ -0,0 +1,43 @@
+"""CPU and memory requests of the runs, and the capacity of the Docker hosts they are admitted against."""
+import logging
+import os
+
+import aiodocker
+
+from mindforge_harness.utils import parse_size
+
+MF_RESOURCE_ADMISSION = os.environ.get("MF_RESOURCE_ADMISSION", "false").lower() in ["true", "1"]
+# The limits the server applied to every container so far, enough for most specs
+MF_DEFAULT_CPUS = float(os.environ.get("MF_DEFAULT_CPUS", "2"))
+MF_DEFAULT_MEMORY = parse_size(os.environ.get("MF_DEFAULT_MEMORY", "2G"))
+MF_HOST_CPUS = float(os.environ.get("MF_HOST_CPUS", "0"))
+MF_HOST_MEMORY = parse_size(os.environ.get("MF_HOST_MEMORY", "0"))
+# Memory of a host kept for the daemon, the build and the harness when its capacity is read from the host
+HOST_MEMORY_RESERVE = 0.1
+
+def get_resource_request(spec_dict: dict) -> tuple[float, int]:
+    """Get the CPUs and memory bytes a run of a spec needs, from its "resources" entry, e.g. {"cpus": 4, "memory": "8G"}."""
+    resources = (spec_dict or {}).get("resources") or {}
+    cpus = float(resources.get("cpus") or MF_DEFAULT_CPUS)
+    memory = parse_size(resources["memory"]) if resources.get("memory") else MF_DEFAULT_MEMORY
+    return cpus, memory
+
+def get_resource_limits(request: tuple[float, int]) -> dict:
+    """Get the container host config limiting a run to its request."""
+    cpus, memory = request
+    return {"NanoCpus": int(cpus * 1e9), "Memory": memory}
+
+async def get_host_capacity(client: aiodocker.Docker, logger: logging.Logger) -> tuple[float, int]:
+    """Get the CPUs and memory bytes runs may use on the host of a daemon, MF_HOST_CPUS and MF_HOST_MEMORY if they are set."""
+    cpus, memory = MF_HOST_CPUS, MF_HOST_MEMORY
+    if not cpus or not memory:
+        try:
+            info = await client.system.info()
+            host_cpus, host_memory = info["NCPU"], info["MemTotal"]
+        except Exception as e:
+            # Assume the daemon runs on this host
+            logger.warning(f"Failed to read the capacity of the Docker host, using the capacity of this host: {e}")
+            host_cpus, host_memory = os.cpu_count(), os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        cpus = cpus or float(host_cpus)
+        memory = memory or int(host_memory * (1 - HOST_MEMORY_RESERVE))
+    return cpus, memory
@@ -1,20 +1,29 @@
 """Evaluation module for the MindForge harness."""
 import asyncio
+import math
 import os
 import tempfile
 import time
 import traceback
-from pathlib import Path
+from typing import Callable
 
-import aiodocker
 import orjson
-from aiohttp import ClientSession, ClientTimeout, UnixConnector
 from tqdm.asyncio import tqdm
 
 from mindforge_harness.docker.image_builder import (
-    build_docker_image_from_specs,
+    BuildScheduler,
     GLOBAL_REGISTRY_CONFIG,
+    get_image_name,
 )
+from mindforge_harness.docker.backends import BackendPool, DockerBackend
+from mindforge_harness.docker.container_pool import ContainerPool
+from mindforge_harness.docker.docker_utils import pull_stats
+from mindforge_harness.docker.image_gc import GLOBAL_IMAGE_GC
+from mindforge_harness.docker.package_cache import GLOBAL_PACKAGE_CACHE
+from mindforge_harness.docker.push_queue import GLOBAL_PUSH_QUEUE
+from mindforge_harness.docker.registry_client import get_registry_catalog
+from mindforge_harness.docker.resources import get_resource_request
+from mindforge_harness.scheduling import AdaptiveLimiter, group_by_affinity
 from mindforge_harness.run_instance import EvaluationPipelineInterface, run_instance, DEFAULT_PIPELINE
 from mindforge_harness.logger import MindForgeHarnessLogger, TQDMLogger
 from mindforge_harness.utils import (
@@ -33,100 +42,229 @@ async def evaluate(
     batch_mode: bool=False,
     short: bool=True,
     failfast: bool=False,
-    pipeline: EvaluationPipelineInterface=DEFAULT_PIPELINE
+    pipeline: EvaluationPipelineInterface=DEFAULT_PIPELINE,
+    max_build_workers: int=4,
+    container_pool: bool=False,
+    checkpoint_installs: bool=False,
+    scheduling: str="fifo",
+    docker_hosts: str="",
+    resource_admission: bool=False,
+    adaptive_workers: bool=False,
+    min_workers: int=1,
 ) -> dict[str, dict]:
-    """Evaluate the dataset."""
+    """Evaluate the dataset.
+
+    Args:
+        log_dir: The log directory to save the logs.
+        dataset: The instances to evaluate, by instance ID.
+        max_workers: The maximum number of concurrent runs.
+        timeout: The timeout of each run.
+        ignore_collector_errors: Set test results to failed if there are errors in collecting tests. EXCEPT ImportError!
+        green_zone: Is the evaluate environment under the Green zone.
+        no_network: Whether the containers run without network.
+        batch_mode: Run `max_workers` instances at a time, stopping once a whole batch errors.
+        short: Whether to return a short version of the results.
+        failfast: Whether to stop on the first failure.
+        pipeline: The evaluation pipeline interface.
+        max_build_workers: The maximum number of concurrent image builds.
+        container_pool: Run the instances in reused containers of a pool.
+        checkpoint_installs: Run the instances from post-install checkpoint images of their commit.
+        scheduling: "fifo", or "affinity" to run the instances sharing an image, a commit and an install
+            command in turn in one container, set up once and reset between them.
+        docker_hosts: Comma-separated Docker endpoints to spread the runs over, the local daemon if empty.
+        resource_admission: Start a run once the CPUs and memory of its spec are free on its host, and limit its container to them.
+        adaptive_workers: Adjust the concurrent runs between `min_workers` and `max_workers` from the Docker API latency,
+            the timeout rate and the host load.
+        min_workers: The concurrent runs `adaptive_workers` starts at and never goes below.
+    """
     with TQDMLogger("evaluate", os.path.join(log_dir, "evaluation.log")) as logger:
         
         logger.info(f"Logs saved to {os.path.join(log_dir, 'evaluation.log')}")
-        socket_path = '/var/run/docker.sock'
-        if os.path.exists(socket_path) and Path(socket_path).is_socket():
-            client = aiodocker.Docker(
-                session=ClientSession(
-                    connector=UnixConnector(socket_path),
-                    timeout=ClientTimeout(total=timeout, sock_connect=30) # sock_connect=30 is the default value
-                )
+        backends = BackendPool.from_hosts(docker_hosts, max_workers, timeout, logger)
+        # The builds planned upfront, the garbage collection and the pushes use the primary daemon
+        client = backends.primary.client
+        async with backends:
+            limiter = AdaptiveLimiter(min_workers, max_workers) if adaptive_workers else None
+            sem = limiter or asyncio.Semaphore(max_workers)
+            # Builds have their own budget, so they never hold a test run slot
+            scheduler = BuildScheduler(
+                client,
+                os.path.join(log_dir, "build_logs"),
+                max_build_workers=max_build_workers,
+                force_rebuild=False,
+                green_zone=green_zone,
+                registry_config=GLOBAL_REGISTRY_CONFIG,
             )
-        else:
-            logger.debug("Timeout for building is not applied.")
-            client = aiodocker.Docker()
-        async with client:
-            sem = asyncio.Semaphore(max_workers)
             queue = asyncio.Queue()
             results = {}
+            protected_images = {}  # Images protected from the garbage collector until their instance ran
+            pools = {backend.url: ContainerPool(backend.client) for backend in backends.backends} if container_pool else {}
+            affinity_stats = {"created": 0, "reused": 0}
             
             instance_datas = list(dataset.values())
                     
             with tqdm(total=len(dataset), desc="Evaluating", dynamic_ncols=True) as pbar:
                 
+                def shared_pool(backend: DockerBackend) -> ContainerPool:
+                    """The container pool of a daemon, if `container_pool` is set."""
+                    return pools.get(backend.url)
+
+                async def evaluate_instance(
+                    instance_args: dict,
+                    get_pool: Callable[[DockerBackend], ContainerPool]=shared_pool,
+                    setup_in_container: bool=False,
+                    prefer: DockerBackend=None,
+                ) -> DockerBackend:
+                    """Evaluate an instance holding a run slot, record its result, and return the daemon it ran on."""
+                    backend = None
+                    try:
+                        if not instance_args['tests']:
+                            logger.warning(f"There is no test in {instance_args['instance_id']}. Is this expected?")
+
+                        await scheduler.get(instance_args["repo"], instance_args.get("spec_dict", None), instance_args.get("image_name"))
+                        start_time = time.perf_counter()
+                        assert instance_args.get("spec_dict"), "The function 'get_spec_from_hardcode()' is deprecated and removed in future versions." \
+                            "Please specify your specs directly in the dataset using the 'spec_dict' entry."
+                        image_name = instance_args.get("image_name") or get_image_name(instance_args["repo"], instance_args["spec_dict"])
+                        request = get_resource_request(instance_args["spec_dict"]) if resource_admission else None
+                        host_config = {"NetworkMode": "none"} if no_network else {}
+                        backend, result = await backends.run(image_name, lambda backend: run_instance(
+                            client=backend.client,
+                            repo=instance_args["repo"],
+                            instance_id=instance_args["instance_id"],
+                            base_commit=instance_args["base_commit"],
+                            patches=instance_args["patches"],
+                            tests=instance_args["tests"],
+                            root_log_dir=log_dir,
+                            spec_dict=instance_args["spec_dict"],
+                            timeout=instance_args.get("timeout") or timeout,
+                            verbose=False,
+                            short=short,
+                            skipped_ok=True,
+                            # The limits of the request as admitted on the daemon, a host cannot give more than it has
+                            host_config={**host_config, **backend.resource_limits(request)} if request else host_config or None,
+                            ignore_collector_errors=ignore_collector_errors,
+                            failfast=failfast,
+                            green_zone=green_zone,
+                            pipeline=pipeline,
+                            container_pool=get_pool(backend),
+                            checkpoint=checkpoint_installs,
+                            setup_in_container=setup_in_container,
+                            transfer_files=backend.remote,
+                        ), logger, prefer, request)
+                        if limiter:
+                            limiter.record(timed_out=False)
+
+                        if short:
+                            logger.info(f"Evaluated instance {instance_args['instance_id']} in {time.perf_counter() - start_time:.2f} seconds. \
+                            Resolved: {all([code for code in result.values()])}")
+                            results[instance_args["instance_id"]] = {
+                                "tests": result,
+                                "time": time.perf_counter() - start_time,
+                                "phases": pipeline.gather_phases(os.path.join(log_dir, "evaluate_logs", instance_args["instance_id"])),
+                            }
+                        else:
+                            logger.info(f"Evaluated instance {instance_args['instance_id']} in {time.perf_counter() - start_time:.2f} seconds.")
+                            results[instance_args["instance_id"]] = result
+                    except Exception as e:
+                        tb = traceback.format_exc()
+                        logger.debug(tb)
+                        logger.debug(f"Error evaluating instance {instance_args['instance_id']}: {e}")
+                        logger.info(f"Evaluated instance {instance_args['instance_id']}. Resolved: {f'Timeout after {timeout} seconds.' if isinstance(e, TimeoutError) else 'Error'}")
+                        results[instance_args["instance_id"]] = {
+                            "error": str(e),
+                            "traceback": tb,
+                            # e.g. the install that was running when the instance timed out
+                            "phases": pipeline.gather_phases(os.path.join(log_dir, "evaluate_logs", instance_args["instance_id"])),
+                        }
+                        if limiter:
+                            limiter.record(timed_out=isinstance(e, TimeoutError))
+                    finally:
+                        if instance_args["instance_id"] in protected_images:
+                            GLOBAL_IMAGE_GC.release(protected_images.pop(instance_args["instance_id"]))
+                        pbar.update(1)
+                    return backend
+
+                async def evaluate_group(group: list[dict]):
+                    """Evaluate the instances of an affinity group in turn, in one container set up once for the group."""
+                    group_pools = {}
+
+                    def group_pool(backend: DockerBackend) -> ContainerPool:
+                        """The container of the group on a daemon, a group only moves to another daemon when the busy one fails."""
+                        if backend.url not in group_pools:
+                            group_pools[backend.url] = ContainerPool(backend.client, max_reuse=len(group), max_idle=1)
+                        return group_pools[backend.url]
+
+                    backend = None
+                    try:
+                        for instance_args in group:
+                            backend = await evaluate_instance(instance_args, group_pool, setup_in_container=True, prefer=backend) or backend
+                    finally:
+                        for group_pool_of_backend in group_pools.values():
+                            await group_pool_of_backend.close(logger)
+                            for stat in affinity_stats:
+                                affinity_stats[stat] += group_pool_of_backend.stats[stat]
+
                 async def evaluate_worker():
-                    """Worker function to evaluate the instances."""
+                    """Worker function to evaluate the instances, or the affinity groups of instances."""
                     while True:
-                        instance_args = await queue.get()
+                        item = await queue.get()
                         try:
-                            if instance_args is None: # Sentinel value to break the loop
+                            if item is None: # Sentinel value to break the loop
                                 break
                             async with sem: # Controls the concurrency
-                                if not instance_args['tests']:
-                                    logger.warning(f"There is no test in {instance_args['instance_id']}. Is this expected?")
+                                if isinstance(item, list):
+                                    await evaluate_group(item)
+                                else:
+                                    await evaluate_instance(item)
+                        finally:
+                            queue.task_done()
 
-                                await build_docker_image_from_specs(
-                                    client=client,
-                                    repo_name=instance_args["repo"],
-                                    spec_dict=instance_args.get("spec_dict", None),
-                                    docker_work_dir=os.path.join(log_dir, "build_logs"),
-                                    force_rebuild=False,
-                                    green_zone=green_zone,
-                                    registry_config=GLOBAL_REGISTRY_CONFIG,
-                                )
-                                start_time = time.perf_counter()
-                                assert instance_args.get("spec_dict"), "The function 'get_spec_from_hardcode()' is deprecated and removed in future versions." \
-                                    "Please specify your specs directly in the dataset using the 'spec_dict' entry."
-                                result = await run_instance(
-                                    client=client,
-                                    repo=instance_args["repo"],
-                                    instance_id=instance_args["instance_id"],
-                                    base_commit=instance_args["base_commit"],
-                                    patches=instance_args["patches"],
-                                    tests=instance_args["tests"],
-                                    root_log_dir=log_dir,
-                                    spec_dict=instance_args["spec_dict"],
-                                    timeout=instance_args.get("timeout") or timeout,
-                                    verbose=False,
-                                    short=short,
-                                    skipped_ok=True,
-                                    host_config={"NetworkMode": "none"} if no_network else None,
-                                    ignore_collector_errors=ignore_collector_errors,
-                                    failfast=failfast,
-                                    green_zone=green_zone,
-                                    pipeline=pipeline
-                                )
+                def fail_instance(instance_data: dict, e: Exception):
+                    """Record an instance whose image cannot be prepared, it never takes a worker."""
+                    logger.info(f"Evaluated instance {instance_data['instance_id']}. Resolved: Error")
+                    results[instance_data["instance_id"]] = {"error": str(e), "traceback": traceback.format_exc()}
+                    if instance_data["instance_id"] in protected_images:
+                        GLOBAL_IMAGE_GC.release(protected_images.pop(instance_data["instance_id"]))
+                    pbar.update(1)
 
-                                if short:
-                                    logger.info(f"Evaluated instance {instance_args['instance_id']} in {time.perf_counter() - start_time:.2f} seconds. \
-                                    Resolved: {all([code for code in result.values()])}")
-                                    results[instance_args["instance_id"]] = {
-                                        "tests": result,
-                                        "time": time.perf_counter() - start_time,
-                                    }
-                                else:
-                                    logger.info(f"Evaluated instance {instance_args['instance_id']} in {time.perf_counter() - start_time:.2f} seconds.")
-                                    results[instance_args["instance_id"]] = result
+                async def enqueue_when_ready(item: dict | list[dict]):
+                    """Put an instance, or an affinity group, in the run queue once its image is ready, so run slots never wait on a build."""
+                    group = item if isinstance(item, list) else [item]
+                    instance_data = group[0]
+                    if instance_data.get("spec_dict"):
+                        try:
+                            await scheduler.get(instance_data["repo"], instance_data["spec_dict"], instance_data.get("image_name"))
                         except Exception as e:
-                            tb = traceback.format_exc()
-                            logger.debug(tb)
-                            logger.debug(f"Error evaluating instance {instance_args['instance_id']}: {e}")
-                            logger.info(f"Evaluated instance {instance_args['instance_id']}. Resolved: {f'Timeout after {timeout} seconds.' if isinstance(e, TimeoutError) else 'Error'}")
-                            results[instance_args["instance_id"]] = {"error": str(e), "traceback": tb}
-                        finally:
-                            pbar.update(1)
-                            queue.task_done()  
+                            for instance_data in group:
+                                fail_instance(instance_data, e)
+                            return
+                    await queue.put(group if len(group) > 1 else instance_data)
+
+                def schedule(instance_datas: list[dict]) -> list:
+                    """Order the queue items of the instances according to the scheduling policy."""
+                    if scheduling == "affinity":
+                        return group_by_affinity(instance_datas)
+                    return instance_datas
+
+                # Plan the images and prepare all of them in the background
+                plan = await scheduler.plan(instance_datas)
+                logger.info(f"Dataset needs {plan['images']} distinct images, {plan['existing']} already exist locally"
+                            + (f", {plan['in_registry']} will be pulled from the registry." if scheduler.registry_config['pull_from_registry'] else "."))
+                if plan['known_failed']:
+                    logger.info(f"{plan['known_failed']} images failed to build in a previous run, their instances are skipped.")
+                for instance_data in instance_datas:
+                    if instance_data.get("spec_dict"):
+                        image_name = instance_data.get("image_name") or get_image_name(instance_data["repo"], instance_data["spec_dict"])
+                        protected_images[instance_data["instance_id"]] = image_name
+                        GLOBAL_IMAGE_GC.protect(image_name)
+                gc_task = asyncio.create_task(GLOBAL_IMAGE_GC.run(client, logger)) if GLOBAL_IMAGE_GC.enabled else None
+                limiter_task = asyncio.create_task(limiter.run([backend.client for backend in backends.backends], logger)) if limiter else None
 
                 workers = [asyncio.create_task(evaluate_worker()) for _ in range(max_workers)]
                 
                 if not batch_mode:
-                    for instance_data in instance_datas:
-                        await queue.put(instance_data)
+                    await asyncio.gather(*(enqueue_when_ready(item) for item in schedule(instance_datas)))
 
                     await queue.join()
                 else:
@@ -136,7 +274,7 @@ async def evaluate(
                         batch = instance_datas[i:i+max_workers]
                         instance_ids = [instance_data['instance_id'] for instance_data in batch]
                         
-                        await asyncio.gather(*(queue.put(data) for data in batch))
+                        await asyncio.gather(*(enqueue_when_ready(item) for item in schedule(batch)))
                         await queue.join()
                         
                         # If all instances in the branch are error, then stop the evaluation
@@ -149,9 +287,85 @@ async def evaluate(
                     await queue.put(None)
             
                 await asyncio.gather(*workers, return_exceptions=True)
+
+                # Instances skipped by batch mode no longer need their images
+                for image_name in protected_images.values():
+                    GLOBAL_IMAGE_GC.release(image_name)
+                if limiter_task:
+                    limiter_task.cancel()
+                    await asyncio.gather(limiter_task, return_exceptions=True)
+                    summary = limiter.summary()
+                    logger.info(f"Adaptive workers: {summary['average']:.1f} concurrent runs on average, between {summary['min']} and "
+                                f"{summary['max']}, {summary['final']} at the end. The limits over time are in adaptive_workers.json.")
+                    os.makedirs(log_dir, exist_ok=True)
+                    with open(os.path.join(log_dir, "adaptive_workers.json"), "wb") as f:
+                        f.write(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
+                if gc_task:
+                    gc_task.cancel()
+                    await asyncio.gather(gc_task, return_exceptions=True)
+                    await GLOBAL_IMAGE_GC.collect(client, logger)
+                    logger.info(f"Image garbage collection evicted {len(GLOBAL_IMAGE_GC.evicted)} images.")
+                else:
+                    GLOBAL_IMAGE_GC.save()
+
+                for url, pool in pools.items():
+                    await pool.close(logger)
+                    report = pool.report()
+                    logger.info(f"Container pool{f' of {url}' if len(pools) > 1 else ''}: {report['created']} containers served "
+                                f"{report['created'] + report['reused']} runs, {report['reset_seconds_per_run']:.2f}s per reset instead of "
+                                f"{report['fresh_container_seconds']:.2f}s per fresh container, {report['saved_seconds']:.1f}s saved in total.")
+                if len(backends.backends) > 1:
+                    for url, report in backends.report().items():
+                        logger.info(f"Docker daemon {url}: {report['runs']} runs, {report['image_hits']} on a held image, "
+                                    f"{report['rerouted']} rerouted{'' if report['healthy'] else ', drained after a failure'}.")
+
+                if scheduling == "affinity":
+                    logger.info(f"Affinity scheduling: {affinity_stats['created']} containers served "
+                                f"{affinity_stats['created'] + affinity_stats['reused']} grouped runs.")
+
+                build_summary = scheduler.summary()
+                logger.info(f"Prepared {build_summary['images']} distinct images, {build_summary['failed']} failed.")
+                for image_name, build_time in build_summary['build_times'].items():
+                    logger.debug(f"Image {image_name} ready in {build_time:.2f} seconds.")
+                if GLOBAL_REGISTRY_CONFIG['pull_from_registry']:
+                    await get_registry_catalog(GLOBAL_REGISTRY_CONFIG).close()
+                # The client must stay open until the background pushes are over
+                await GLOBAL_PUSH_QUEUE.join(logger)
+                if pull_stats:
+                    pulled = sum(stats['size'] for stats in pull_stats.values())
+                    pull_time = sum(stats['seconds'] for stats in pull_stats.values())
+                    logger.info(f"Pulled {len(pull_stats)} images ({pulled / 1024 ** 3:.2f} GiB) from the registry, "
+                                f"{pulled / pull_time / 1024 ** 2 if pull_time else 0:.1f} MiB/s on average per pull.")
+                if GLOBAL_PACKAGE_CACHE.enabled:
+                    logger.info(f"Wheelhouse hit ratio: {GLOBAL_PACKAGE_CACHE.hit_ratio:.0%} "
+                                f"({GLOBAL_PACKAGE_CACHE.hits} hits, {GLOBAL_PACKAGE_CACHE.misses} downloads).")
             
                 return results
 
+def summarize_phases(results: dict[str, dict]) -> dict[str, dict]:
+    """Summarize the seconds of each phase of the evaluation script over the instances, with their p50 and p95."""
+    seconds, failures = {}, {}
+    for result in results.values():
+        for name, phase in (result.get("phases") or {}).items():
+            if "seconds" in phase:
+                seconds.setdefault(name, []).append(phase["seconds"])
+                failures[name] = failures.get(name, 0) + (phase["exit_code"] != 0)
+
+    def percentile(values: list[float], q: float) -> float:
+        """Nearest-rank percentile."""
+        return values[max(math.ceil(q * len(values)) - 1, 0)]
+
+    return {
+        name: {
+            "count": len(values),
+            "failures": failures[name],
+            "p50": percentile(sorted(values), 0.5),
+            "p95": percentile(sorted(values), 0.95),
+            "total": sum(values),
+        }
+        for name, values in seconds.items()
+    }
+
 def run_evaluate(
     dataset_name: str,
     max_workers: int,
@@ -164,6 +378,14 @@ def run_evaluate(
     failfast: bool=False,
     green_zone: bool=False,
     use_tmp_dir: bool=False,
+    max_build_workers: int=4,
+    container_pool: bool=False,
+    checkpoint_installs: bool=False,
+    scheduling: str="fifo",
+    docker_hosts: str="",
+    resource_admission: bool=False,
+    adaptive_workers: bool=False,
+    min_workers: int=1,
     ):
     """Run the evaluation."""
     with MindForgeHarnessLogger("evaluate-top", log_file=None, add_stdout=True) as logger:
@@ -180,7 +402,8 @@ def run_evaluate(
         dataset = prepare_dataset_for_evaluation(
             raw_dataset,
             instance_ids.split() if instance_ids else None,
-            predictions_path if predictions_path != "gold" else None
+            predictions_path if predictions_path != "gold" else None,
+            logger=logger,
         )
         run_id = run_id or f"evaluate-{time.strftime('%Y%m%d-%H%M%S')}"
         temp_dir = None
@@ -203,6 +426,14 @@ def run_evaluate(
                 ignore_collector_errors=False, 
                 failfast=failfast,
                 green_zone=green_zone,
+                max_build_workers=max_build_workers,
+                container_pool=container_pool,
+                checkpoint_installs=checkpoint_installs,
+                scheduling=scheduling,
+                docker_hosts=docker_hosts,
+                resource_admission=resource_admission,
+                adaptive_workers=adaptive_workers,
+                min_workers=min_workers,
             ))
         finally:
             if use_tmp_dir:
@@ -218,7 +449,8 @@ def run_evaluate(
             'total': len(results),
             'resolved_instances': {},
             'unresolved_instances': {},
-            'errors_instances': []
+            'errors_instances': [],
+            'phases': summarize_phases(results),
         }
         # Compose a orjson report
         for iid, result in results.items():
@@ -239,6 +471,8 @@ def run_evaluate(
         logger.info(f"Instances resolved: {json_output['resolved']}")
         logger.info(f"Instances unresolved: {json_output['unresolved']}")
         logger.info(f"Errors: {json_output['errors']}")
+        for name, phase in json_output['phases'].items():
+            logger.info(f"Phase {name}: p50 {phase['p50']:.2f}s, p95 {phase['p95']:.2f}s over {phase['count']} instances, {phase['failures']} failed.")
         
         if use_tmp_dir:  # If the temporary directory is used, return the results
             return results
@@ -5,18 +5,31 @@ import json
 
 from mindforge_harness.evaluate import run_evaluate
 from mindforge_harness.produce import run_produce
+from mindforge_harness.scheduling import MF_ADAPTIVE_MIN_WORKERS, MF_ADAPTIVE_WORKERS, MF_SCHEDULING, SCHEDULING_POLICIES
+from mindforge_harness.docker.backends import MF_DOCKER_HOSTS
+from mindforge_harness.docker.build_failures import GLOBAL_BUILD_FAILURES
+from mindforge_harness.docker.checkpoints import MF_CHECKPOINT_INSTALLS
+from mindforge_harness.docker.consts import DOCKER_TEMPLATE
+from mindforge_harness.docker.container_pool import MF_CONTAINER_POOL
 from mindforge_harness.docker.docker_utils import GLOBAL_REGISTRY_CONFIG
+from mindforge_harness.docker.image_archive import IMAGE_ARCHIVE_DIR, export_images, import_images
+from mindforge_harness.docker.image_gc import GLOBAL_IMAGE_GC, run_gc
+from mindforge_harness.docker.package_cache import GLOBAL_PACKAGE_CACHE
+from mindforge_harness.docker.resources import MF_RESOURCE_ADMISSION
+from mindforge_harness.utils import parse_size
 
 parser = argparse.ArgumentParser(description="An autonomous harness system to produce high-quality SE-LLM training data collection at scale.")
 
 parser.add_argument("--dataset_name", type=str, help="Path to the dataset file.")
 
-parser.add_argument("--mode", type=str, help="Mode of operation: 'produce' or 'evaluate'.")
+parser.add_argument("--mode", type=str, help="Mode of operation: 'produce', 'evaluate', 'gc', 'export_images' or 'import_images'.")
 
 parser.add_argument("--output_path", type=str, default="", help="Path to the output directory.")
 
 parser.add_argument("--max_workers", type=int, default=1, help="Maximum number of workers to use for parallel processing.")
 
+parser.add_argument("--max_build_workers", type=int, default=4, help="Maximum number of images to build concurrently. Builds do not take the slots of --max_workers.")
+
 parser.add_argument("--run_id", type=str, default="", help="Run ID for the current execution. Automatically generated if not provided.")
 
 parser.add_argument("--instance_ids", type=str, default="", help="Space-separated list of instance IDs to run. Run all instances if not provided.")
@@ -43,6 +56,30 @@ parser.add_argument("--registry_user", type=str, default=None, help="Username to
 
 parser.add_argument("--registry_pass", type=str, default=None, help="Password to authenticate to the registry.")
 
+parser.add_argument("--use_wheelhouse", action='store_true', default=False, help="Download the packages of each spec once into a persistent host wheelhouse and install from it during image builds.")
+
+parser.add_argument("--offline_builds", action='store_true', default=False, help="Only install packages from the wheelhouse during image builds. Requires every needed wheel to be cached already.")
+
+parser.add_argument("--retry_failed_builds", action='store_true', default=False, help="Retry the image builds that failed in previous runs, instead of skipping their instances until the failure expires.")
+
+parser.add_argument("--image_disk_budget", type=str, default=None, help="Disk budget of the harness images, e.g. 200G. The least recently used images are removed when it is exceeded, in the background during a run or once in 'gc' mode.")
+
+parser.add_argument("--archive_dir", type=str, default=IMAGE_ARCHIVE_DIR, help="Archive directory of the 'export_images' and 'import_images' modes, to move the images of --dataset_name (or all of them) between hosts without a registry.")
+
+parser.add_argument("--container_pool", action='store_true', default=False, help="Run the instances of an image in reused containers, reset between runs, instead of a fresh container per instance.")
+
+parser.add_argument("--checkpoint_installs", action='store_true', default=False, help="Commit the container after the checkout and install of a commit into a derived image, and run later evaluations of that commit from it, only applying the patches and running the tests.")
+
+parser.add_argument("--scheduling", type=str, choices=SCHEDULING_POLICIES, default=MF_SCHEDULING, help="Order of the instance runs: 'fifo', or 'affinity' to run the instances sharing an image, a commit and an install command in turn in one container, installed once.")
+
+parser.add_argument("--docker_hosts", type=str, default=MF_DOCKER_HOSTS, help="Comma-separated Docker endpoints to spread the runs over, e.g. 'unix:///var/run/docker.sock=8,tcp://10.0.0.2:2375=16', each optionally followed by '=<capacity>'. Use the local daemon if not provided.")
+
+parser.add_argument("--resource_admission", action='store_true', default=False, help="Start a run once the CPUs and memory requested by its spec are free on the Docker host, and limit its container to them, instead of only bounding the concurrent runs by --max_workers.")
+
+parser.add_argument("--adaptive_workers", action='store_true', default=False, help="Start with --min_workers concurrent runs and adjust them up to --max_workers during the run, from the Docker API latency, the timeout rate and the host load.")
+
+parser.add_argument("--min_workers", type=int, default=MF_ADAPTIVE_MIN_WORKERS, help="Lower bound, and start, of the concurrent runs with --adaptive_workers.")
+
 parser.add_argument("--batch_mode", action='store_true', default=False, help="Whether to run in batch mode or not.")
 
 parser.add_argument("--failfast", action='store_true', default=False, help="Whether to stop the evaluation on the first failure.")
@@ -60,6 +97,18 @@ def main(mode: str, spec_dict: str = None, **kwargs):
     GLOBAL_REGISTRY_CONFIG['registry_user'] = kwargs.pop("registry_user") or GLOBAL_REGISTRY_CONFIG['registry_user']
     GLOBAL_REGISTRY_CONFIG['registry_pass'] = kwargs.pop("registry_pass") or GLOBAL_REGISTRY_CONFIG['registry_pass']
 
+    GLOBAL_PACKAGE_CACHE.enabled = kwargs.pop("use_wheelhouse") or GLOBAL_PACKAGE_CACHE.enabled
+    GLOBAL_PACKAGE_CACHE.offline = kwargs.pop("offline_builds") or GLOBAL_PACKAGE_CACHE.offline
+    GLOBAL_PACKAGE_CACHE.enabled = GLOBAL_PACKAGE_CACHE.enabled or GLOBAL_PACKAGE_CACHE.offline
+    if GLOBAL_PACKAGE_CACHE.offline and DOCKER_TEMPLATE == "r2e":
+        # Its install.sh installs interpreters with apt-get and pinned packages the spec does not list
+        raise ValueError("Offline builds need the slim Docker template, the install.sh of the r2e template needs network access.")
+
+    GLOBAL_BUILD_FAILURES.retry = kwargs.pop("retry_failed_builds") or GLOBAL_BUILD_FAILURES.retry
+
+    if image_disk_budget := kwargs.pop("image_disk_budget"):
+        GLOBAL_IMAGE_GC.disk_budget = parse_size(image_disk_budget)
+
     if mode == "produce":
         asyncio.run(run_produce(
             dataset_name=kwargs.pop("dataset_name"),
@@ -73,6 +122,7 @@ def main(mode: str, spec_dict: str = None, **kwargs):
             black_list=kwargs.pop("black_list"),
             batch_mode=kwargs.pop("batch_mode"),
             green_zone=kwargs.pop("green_zone"),
+            max_build_workers=kwargs.pop("max_build_workers"),
         ))
     elif mode == "evaluate":
         run_evaluate(
@@ -87,7 +137,21 @@ def main(mode: str, spec_dict: str = None, **kwargs):
             failfast=kwargs.pop("failfast"),
             green_zone=kwargs.pop("green_zone"),
             use_tmp_dir=kwargs.pop("use_tmp_dir"),
+            max_build_workers=kwargs.pop("max_build_workers"),
+            container_pool=kwargs.pop("container_pool") or MF_CONTAINER_POOL,
+            checkpoint_installs=kwargs.pop("checkpoint_installs") or MF_CHECKPOINT_INSTALLS,
+            scheduling=kwargs.pop("scheduling"),
+            docker_hosts=kwargs.pop("docker_hosts"),
+            resource_admission=kwargs.pop("resource_admission") or MF_RESOURCE_ADMISSION,
+            adaptive_workers=kwargs.pop("adaptive_workers") or MF_ADAPTIVE_WORKERS,
+            min_workers=kwargs.pop("min_workers"),
         )
+    elif mode == "gc":
+        asyncio.run(run_gc())
+    elif mode == "export_images":
+        asyncio.run(export_images(kwargs.pop("archive_dir"), kwargs.pop("dataset_name")))
+    elif mode == "import_images":
+        asyncio.run(import_images(kwargs.pop("archive_dir"), kwargs.pop("dataset_name")))
     else:
         raise ValueError(f"Invalid mode: {mode}")
     
@@ -158,6 +158,7 @@ async def run_produce(
     green_zone: bool=False,
     spec_dict: dict=None,
     batch_mode=True,
+    max_build_workers: int=4,
     ):
     """Run the evaluation."""
     with MindForgeHarnessLogger("produce-top", log_file=None, add_stdout=True) as logger:
@@ -178,16 +179,21 @@ async def run_produce(
         
         dataset = prepare_dataset_for_evaluation(
             raw_dataset,
-            instance_ids.split() if instance_ids else None
+            instance_ids.split() if instance_ids else None,
+            logger=logger,
         )
+        produce_specs = {}  # Specs are shared by their instances, derive each of them once
         for _, instance_data in dataset.items():
             test_patch = instance_data['patches'][0]
             instance_data["tests"] = extract_modified_test_files(test_patch, black_list)
-            instance_data['spec_dict']['test_cmd'] = instance_data['spec_dict']['test_cmd'] + " --continue-on-collection-errors"
+            spec_dict = instance_data['spec_dict']
+            if id(spec_dict) not in produce_specs:  # Keep the shared spec alive, so its id is not reused
+                produce_specs[id(spec_dict)] = (spec_dict, {**spec_dict, 'test_cmd': spec_dict['test_cmd'] + " --continue-on-collection-errors"})
+            instance_data['spec_dict'] = produce_specs[id(spec_dict)][1]
 
         logger.info("Run produce golden round")
         log_dir = os.path.join("logs", f"produce-golden-eval-{run_id}" if run_id else f"produce-golden-eval-{time.strftime('%Y%m%d-%H%M%S')}")
-        golden_round_results = await evaluate(log_dir, dataset, max_workers, timeout=timeout, ignore_collector_errors=True, green_zone=green_zone, batch_mode=batch_mode, short=False)
+        golden_round_results = await evaluate(log_dir, dataset, max_workers, timeout=timeout, ignore_collector_errors=True, green_zone=green_zone, batch_mode=batch_mode, short=False, max_build_workers=max_build_workers)
         
         for _, instance_data in dataset.items():
             instance_data['patches'] = [instance_data['patches'][0]]
@@ -195,7 +201,7 @@ async def run_produce(
         log_dir = os.path.join("logs", f"produce-pre-golden-eval-{run_id}" if run_id else f"produce-pre-golden-eval-{time.strftime('%Y%m%d-%H%M%S')}")
         
         logger.info("Run produce pre-golden round")
-        pre_golden_round_results = await evaluate(log_dir, dataset, max_workers, timeout=timeout, ignore_collector_errors=True, green_zone=green_zone, batch_mode=batch_mode, short=False)
+        pre_golden_round_results = await evaluate(log_dir, dataset, max_workers, timeout=timeout, ignore_collector_errors=True, green_zone=green_zone, batch_mode=batch_mode, short=False, max_build_workers=max_build_workers)
 
         instance_id2results = gather_results(pre_golden_round_results, golden_round_results)
     
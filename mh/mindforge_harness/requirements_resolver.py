@@ -0,0 +1,164 @@
+"""Resolve the requirements files of a repository at a commit, from the local git mirror or over HTTP."""
+import asyncio
+import hashlib
+import os
+import posixpath
+import re
+from uuid import uuid4
+
+import aiohttp
+import git
+
+from mindforge_harness.docker.repo_cache import GLOBAL_REPO_CACHE, RepoCache
+from mindforge_harness.utils import is_valid_git_repo
+
+REQUIREMENTS_CACHE_DIR = os.environ.get("REQUIREMENTS_CACHE_DIR", "requirements_caches")
+REQUIREMENTS_URL = os.environ.get("REQUIREMENTS_URL", "https://raw.githubusercontent.com/{repo}/{commit}/{path}")
+MF_REQUIREMENTS_MAX_CONNECTIONS = int(os.environ.get("MF_REQUIREMENTS_MAX_CONNECTIONS", "16"))
+
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36"
+# Files are only cached for full commit hashes, branches and tags move
+FULL_COMMIT = re.compile(r"^[0-9a-f]{40}$")
+
+def exclude_line(line: str) -> bool:
+    """Exclude lines that are not requirements."""
+    return any([line.strip().startswith(x) for x in ["-e .", "#", ".[test"]])
+
+class RequirementsResolver:
+    """Read requirements files and follow their `-r` includes, level by level and in parallel.
+
+    A file is read from the bare mirror of the repository cache when the mirror has the commit, and
+    downloaded otherwise, with one pooled HTTP session. Files of full commit hashes never change, so
+    they are cached on disk by (repository, commit, path) and read at most once per run.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str=REQUIREMENTS_CACHE_DIR,
+        repo_cache: RepoCache=GLOBAL_REPO_CACHE,
+        url: str=REQUIREMENTS_URL,
+        max_connections: int=MF_REQUIREMENTS_MAX_CONNECTIONS,
+        timeout: float=30,
+    ):
+        """Create a resolver caching files in `cache_dir` and downloading them from `url`."""
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.repo_cache = repo_cache
+        self.url = url
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.stats = {"cache": 0, "mirror": 0, "http": 0}
+        self._reads: dict[tuple[str, str, str], asyncio.Task] = {}
+        self._session: aiohttp.ClientSession = None
+        self._loop: asyncio.AbstractEventLoop = None
+
+    def session(self) -> aiohttp.ClientSession:
+        """Get the pooled session, created on first use in the running event loop."""
+        if self._session is None or self._session.closed or self._loop is not asyncio.get_running_loop():
+            self._loop = asyncio.get_running_loop()
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": USER_AGENT},
+            )
+        return self._session
+
+    async def close(self) -> None:
+        """Close the session."""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def cache_path(self, repo_name: str, commit: str, path: str) -> str:
+        """Path of the cached content of a file."""
+        return os.path.join(self.cache_dir, hashlib.sha256(f"{repo_name}\0{commit}\0{path}".encode()).hexdigest())
+
+    def _read_cache(self, repo_name: str, commit: str, path: str) -> str:
+        """Read a file from the disk cache, or None."""
+        try:
+            with open(self.cache_path(repo_name, commit, path), encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_cache(self, repo_name: str, commit: str, path: str, content: str) -> None:
+        """Write a file to the disk cache, atomically."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_path = self.cache_path(repo_name, commit, path)
+        tmp_path = f"{cache_path}.{uuid4()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, cache_path)
+
+    def _read_mirror(self, repo_name: str, commit: str, path: str) -> str:
+        """Read a file at a commit from the local mirror, or None if there is no mirror or it lacks the file."""
+        mirror_path = self.repo_cache.mirror_path(repo_name)
+        if not is_valid_git_repo(mirror_path):
+            return None
+        try:
+            return git.Repo(mirror_path).git.show(f"{commit}:{path}", strip_newline_in_stdout=False)
+        except git.exc.GitCommandError:
+            return None
+
+    async def _download(self, repo_name: str, commit: str, path: str) -> str:
+        """Download a file at a commit."""
+        url = self.url.format(repo=repo_name, commit=commit, path=path)
+        async with self.session().get(url) as response:
+            if response.status != 200:
+                raise ValueError(f"Could not find requirements.txt at path {url}")
+            return await response.text()
+
+    async def _read(self, repo_name: str, commit: str, path: str) -> str:
+        """Read a file from the disk cache, the mirror or over HTTP."""
+        cacheable = FULL_COMMIT.match(commit)
+        if cacheable and (content := await asyncio.to_thread(self._read_cache, repo_name, commit, path)) is not None:
+            self.stats["cache"] += 1
+            return content
+        if (content := await asyncio.to_thread(self._read_mirror, repo_name, commit, path)) is not None:
+            self.stats["mirror"] += 1
+        else:
+            content = await self._download(repo_name, commit, path)
+            self.stats["http"] += 1
+        if cacheable:
+            await asyncio.to_thread(self._write_cache, repo_name, commit, path, content)
+        return content
+
+    async def read(self, repo_name: str, commit: str, path: str) -> str:
+        """Read a file at a commit, sharing the read with concurrent callers asking for the same file."""
+        key = (repo_name, commit, posixpath.normpath(path))
+        if key not in self._reads:
+            self._reads[key] = asyncio.ensure_future(self._read(*key))
+        try:
+            return await asyncio.shield(self._reads[key])
+        finally:
+            self._reads.pop(key, None)
+
+    async def resolve(self, repo_name: str, requirements_txts: list[str], commit: str) -> list[str]:
+        """Get the requirements of files at a commit, following `-r` includes in the same order as a sequential read."""
+        requirements = []
+        seen = set()
+        level = list(requirements_txts)
+        while level:
+            # Files included several times, or in a cycle, are read once
+            unique = {}
+            for path in level:
+                if posixpath.normpath(path) not in seen:
+                    unique.setdefault(posixpath.normpath(path), path)
+            seen.update(unique)
+            level = list(unique.values())
+            contents = await asyncio.gather(*(self.read(repo_name, commit, path) for path in level))
+            next_level = []
+            for req_file, lines in zip(level, contents):
+                req_dir = "/".join(req_file.split("/")[:-1])  # Some requirements.txt files have relative paths like ./tests/requirements.txt
+                for line in lines.split("\n"):
+                    if line.strip().startswith("-r"):
+                        # Handle recursive requirements
+                        next_level.append(posixpath.join(req_dir, line.strip()[len("-r"):].strip()))
+                    elif line and not exclude_line(line):
+                        requirements.append(line)
+            level = next_level
+        return requirements
+
+    async def resolve_many(self, requests: list[tuple[str, list[str], str]]) -> list[list[str]]:
+        """Resolve (repo_name, requirements_txts, commit) requests concurrently, over one session."""
+        return await asyncio.gather(*(self.resolve(repo_name, requirements_txts, commit) for repo_name, requirements_txts, commit in requests))
+
+GLOBAL_REQUIREMENTS_RESOLVER = RequirementsResolver()
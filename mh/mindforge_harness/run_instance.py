@@ -4,6 +4,7 @@ import logging
 import os
 import shlex
 import time
+import traceback
 
 from pathlib import Path
 from uuid import uuid4
@@ -15,8 +16,12 @@ import orjson
 # CHANGES: We removed double prefixing from the push code.
 # ------------------------
 from mindforge_harness.docker.consts import (
+    CHECKPOINT_SCRIPT,
     EVAL_SCRIPT,
+    EVAL_SCRIPT_FROM_CHECKPOINT,
 )
+from mindforge_harness.docker.checkpoints import get_or_create_checkpoint
+from mindforge_harness.docker.container_pool import ContainerPool, ContainerSession
 from mindforge_harness.consts import (
     UNITEST_TIMEOUT_MAX,
 )
@@ -27,6 +32,7 @@ from mindforge_harness.docker.docker_utils import (
 from mindforge_harness.docker.image_builder import (
     build_docker_image_from_specs,
 )
+from mindforge_harness.docker.image_gc import GLOBAL_IMAGE_GC
 from mindforge_harness.logger import MindForgeHarnessLogger
 
 class EvaluationPipelineInterface:
@@ -42,7 +48,7 @@ class EvaluationPipelineInterface:
 
     """
 
-    def format_eval_script(
+    def format_template_vars(
         self,
         tests: list[str],
         test_cmd: str,
@@ -51,8 +57,8 @@ class EvaluationPipelineInterface:
         timeout: int,
         pyversion: str,
         failfast: bool,
-    ) -> str:
-        """Format the evaluation script."""
+    ) -> dict[str, str]:
+        """Format the variables of the evaluation script templates."""
         # FIXME: Ideally, this should be copied during the docker build.
         # However, I don't know how to properly format the environment variables to pass the test names
         if not tests:
@@ -63,16 +69,70 @@ class EvaluationPipelineInterface:
             test_cmd = test_cmd if 'json-report' in test_cmd else test_cmd + " " + "--tb=short --json-report --json-report-file=/pass_report.json -W ignore::DeprecationWarning"
             test_cmd = test_cmd + f" --timeout {timeout} " + ' '.join([shlex.quote(x) for x in tests])
         install_cmd = install.replace('pip install', 'pip install --no-deps --no-build-isolation')
-        template_vars_entrypoint = {
+        return {
             "install": install_cmd,
             "test_cmd": test_cmd,
-            "eval_commands": "\n".join(eval_commands),
+            # The phase exits with the status of the first failed command
+            "eval_commands": "\n".join(f'{command} || {{ rc=$?; [ "$eval_rc" != 0 ] || eval_rc=$rc; }}' for command in eval_commands),
             "pyversion": pyversion,
         }
+
+    def format_eval_script(
+        self,
+        tests: list[str],
+        test_cmd: str,
+        eval_commands: list[str],
+        install: str,
+        timeout: int,
+        pyversion: str,
+        failfast: bool,
+    ) -> str:
+        """Format the evaluation script."""
+        template_vars_entrypoint = self.format_template_vars(tests, test_cmd, eval_commands, install, timeout, pyversion, failfast)
         return EVAL_SCRIPT.format(**template_vars_entrypoint)
 
+    def format_checkpoint_scripts(
+        self,
+        tests: list[str],
+        test_cmd: str,
+        eval_commands: list[str],
+        install: str,
+        timeout: int,
+        pyversion: str,
+        failfast: bool,
+    ) -> tuple[str, str]:
+        """Format the setup script committed into a post-install checkpoint, and the evaluation script run from the checkpoint."""
+        template_vars_entrypoint = self.format_template_vars(tests, test_cmd, eval_commands, install, timeout, pyversion, failfast)
+        return CHECKPOINT_SCRIPT.format(**template_vars_entrypoint), EVAL_SCRIPT_FROM_CHECKPOINT.format(**template_vars_entrypoint)
+
+    def gather_phases(self, log_dir: str) -> dict[str, dict]:
+        """Gather the start, end, exit code and seconds of the phases marked by the evaluation script.
+
+        A phase that never ended, e.g. after a timeout, only has its start.
+        """
+        phases = {}
+        phase_file = os.path.join(log_dir, "results", "phases.txt")
+        if not os.path.exists(phase_file):
+            return phases
+        with open(phase_file) as f:
+            for line in f:
+                marker = line.split()
+                if len(marker) == 3 and marker[1] == "start":
+                    phases[marker[0]] = {"start": float(marker[2])}
+                elif len(marker) == 4 and marker[1] == "end" and marker[0] in phases:
+                    phase = phases[marker[0]]
+                    phase.update(end=float(marker[2]), exit_code=int(marker[3]))
+                    phase["seconds"] = phase["end"] - phase["start"]
+        return phases
+
     def gather_results(self, log_dir: str, logger: logging.Logger, tests: list[str], skipped_ok=True, short=True, ignore_collector_errors=True) -> dict:
-        """Gather results from the test logs."""
+        """Gather results from the test logs, with the phases of the evaluation script in the full results."""
+        phases = self.gather_phases(log_dir)
+        if phases:
+            logger.info("Phases: " + ", ".join(
+                f"{name} {phase['seconds']:.2f}s (exit code {phase['exit_code']})" if "seconds" in phase else f"{name} unfinished"
+                for name, phase in phases.items()
+            ))
         # Load results
         result_file = os.path.join(log_dir, "results", "pytest_report.json")
         with open(result_file) as f:
@@ -127,7 +187,10 @@ class EvaluationPipelineInterface:
                     results['tests'].append(compose_a_report_for_missing_test(test, longrepr))
 
         logger.info(f"Results: {short_results}")
-        return short_results if short else results
+        if short:
+            return short_results
+        results["phases"] = phases
+        return results
 
 DEFAULT_PIPELINE = EvaluationPipelineInterface()
 
@@ -160,6 +223,77 @@ def compose_a_report_for_missing_test(test: str, longrepr: str=None) -> dict:
         },
     }
 
+async def copy_phases(session: ContainerSession, log_dir: str, logger: logging.Logger) -> None:
+    """Copy the phase markers of an unfinished run into `log_dir`/results, showing where it stalled."""
+    try:
+        phases = await session.get_file("/results/phases.txt")
+    except Exception as e:
+        logger.warning(f"Failed to copy the phases of the run: {e}")
+        return
+    if phases is not None:
+        os.makedirs(os.path.join(log_dir, "results"), exist_ok=True)
+        Path(log_dir, "results", "phases.txt").write_bytes(phases)
+
+class SetupError(Exception):
+    """The checkout or install of a commit failed in a container, so no run of the commit can succeed in it."""
+
+async def run_in_pooled_container(
+    container_pool: ContainerPool,
+    image_name: str,
+    host_config: dict,
+    files: dict[str, str],
+    environment: list[str],
+    log_dir: str,
+    timeout: int,
+    logger: logging.Logger,
+    setup_script: str=None,
+) -> None:
+    """Run the evaluation script in a container of the pool and copy its results into `log_dir`/results.
+
+    A `setup_script` runs first in every new container of the pool, e.g. the checkout and install of a commit.
+    The setup counts against the `timeout` of the run it precedes, and the state after it is what the container
+    is reset to between runs.
+    """
+    eval_start = time.perf_counter()
+    session = await container_pool.acquire(image_name, host_config, logger)
+    reusable = False
+    try:
+        if setup_script and session.uses == 1:
+            try:
+                exit_code, logs = await session.exec(["bash", "-c", setup_script], environment, timeout)
+            except TimeoutError as e:
+                logger.error(f"Setup of the container: {e}")
+                raise SetupError(f"Setup of the container timed out after {timeout} seconds.") from e
+            if exit_code != 0:
+                logger.error(logs)
+                raise SetupError(f"Setup of the container failed with exit code {exit_code}.")
+            logger.info(f"Set up container in {time.perf_counter() - eval_start:.2f} seconds.")
+            logger.debug(logs)
+            await session.snapshot()
+        remaining = timeout - (time.perf_counter() - eval_start)
+        if remaining <= 0:
+            error = f"Container timed out after {timeout} seconds."
+            logger.error(error)
+            raise TimeoutError(error)
+        await session.put_files(files)
+        try:
+            exit_code, logs = await session.exec(["sh", "-c", "chmod +x /eval.sh && /eval.sh"], environment, remaining)
+        except TimeoutError as e:
+            logger.error(str(e))
+            await copy_phases(session, log_dir, logger)
+            raise e
+        logger.info(f"Evaluation script exited with code {exit_code} in {time.perf_counter() - eval_start:.2f} seconds, "
+                    f"in a container used {session.uses} times.")
+        logger.debug(logs)
+
+        # The same files as the bind mounts of a fresh container
+        await session.get_dir("/results", log_dir)
+        report = await session.get_file("/pass_report.json")
+        Path(log_dir, "results/pytest_report.json").write_bytes(report or b"")
+        reusable = True
+    finally:
+        await container_pool.release(session, logger, reusable)
+
 async def run_instance(
     client: aiodocker.Docker,
     repo: str,
@@ -179,6 +313,10 @@ async def run_instance(
     green_zone: bool=False,
     registry_config: DockerRegisteryConfig=GLOBAL_REGISTRY_CONFIG,
     pipeline: EvaluationPipelineInterface=DEFAULT_PIPELINE,
+    container_pool: ContainerPool=None,
+    checkpoint: bool=False,
+    setup_in_container: bool=False,
+    transfer_files: bool=False,
 ) -> dict:
     """Run a single instance test.
 
@@ -201,6 +339,11 @@ async def run_instance(
         green_zone: Is the evaluate environment under the Green zone.
         registry_config: The Docker registry configuration.
         pipeline: The evaluation pipeline interface.
+        container_pool: Run in a reused container of this pool instead of a fresh container.
+        checkpoint: Run from a post-install checkpoint image of the commit, created on first use.
+        setup_in_container: Check out and install the commit once per container of `container_pool` instead of
+            in every run. The pool must only serve runs of this commit and install command.
+        transfer_files: Copy the run files in and out of the container instead of bind mounting them, for remote daemons.
 
     Returns:
         The test results.
@@ -240,12 +383,13 @@ async def run_instance(
 
         # The test report
         Path(abs_log_dir, "results/pytest_report.json").write_text("")
+        Path(abs_log_dir, "results/phases.txt").unlink(missing_ok=True)
         volumes.append(f"{abs_log_dir}/results/pytest_report.json:/pass_report.json:rw")
 
         # Format the entrypoint shell script
         if not tests:
             logger.warning(f"There is no test in {instance_id}. Is this expected?")
-        formatted_entry = pipeline.format_eval_script(
+        script_args = dict(
             tests=tests,
             test_cmd=spec_dict["test_cmd"],
             eval_commands=spec_dict.get("eval_commands", []),
@@ -254,59 +398,219 @@ async def run_instance(
             pyversion = f"python{'.'.join(spec_dict['python'].replace('python','').split('.')[:2])}", # Agent typically includes the patch in python version (e.g., python x.y.z)  
             failfast=failfast,
         )
-        eval_file = Path(docker_work_dir) / "eval.sh"
-        eval_file.write_text(formatted_entry)
-        volumes.append(f"{eval_file.resolve()}:/eval.sh:rw")
-
-        container_config = {
-            "Image": image_name,
-            "HostConfig": {
-                "Privileged": False,
-                "Binds": volumes
-            },
-            "Cmd": ["sh", "-c", "chmod +x /eval.sh && /eval.sh"],
-            "Env": [
-                f"GIT_COMMIT={base_commit}",
-                f"REPO={repo}",
-                f"INSTANCE_ID={instance_id}"
-            ],
-            "Tty": True,
-        }
-        if host_config:
-            container_config["HostConfig"].update(host_config)
+        environment = [
+            f"GIT_COMMIT={base_commit}",
+            f"REPO={repo}",
+            f"INSTANCE_ID={instance_id}"
+        ]
+        setup_script = None
+        if checkpoint:
+            # Checkout and install run once per (image, commit, install), the run only patches and tests
+            checkpoint_script, formatted_entry = pipeline.format_checkpoint_scripts(**script_args)
+            image_name = await get_or_create_checkpoint(
+                client, image_name, base_commit, checkpoint_script, environment, host_config, timeout, logger,
+            )
+        elif container_pool is not None and setup_in_container:
+            setup_script, formatted_entry = pipeline.format_checkpoint_scripts(**script_args)
+        else:
+            formatted_entry = pipeline.format_eval_script(**script_args)
+        try:
+            eval_file = Path(docker_work_dir) / "eval.sh"
+            eval_file.write_text(formatted_entry)
+            volumes.append(f"{eval_file.resolve()}:/eval.sh:rw")
 
-        eval_start = time.perf_counter()
-        container_name = f"{image_name.replace('/', '-').replace(':', '-')}-{uuid4()}"
-        container = await client.containers.create_or_replace(name=container_name, config=container_config)
-        await container.start()
+            run_files = {
+                **{f"/patches/patch_{i}.patch": patch for i, patch in enumerate(patches)},
+                "/eval.sh": formatted_entry,
+            }
+
+            if container_pool is not None:
+                await run_in_pooled_container(
+                    container_pool,
+                    image_name,
+                    host_config,
+                    run_files,
+                    environment,
+                    abs_log_dir,
+                    timeout,
+                    logger,
+                    setup_script=setup_script,
+                )
+                return pipeline.gather_results(abs_log_dir, logger, tests, skipped_ok, short, ignore_collector_errors)
+
+            container_config = {
+                "Image": image_name,
+                "HostConfig": {
+                    "Privileged": False,
+                    "Binds": volumes
+                },
+                "Cmd": ["sh", "-c", "chmod +x /eval.sh && /eval.sh"],
+                "Env": environment,
+                "Tty": True,
+            }
+            if host_config:
+                container_config["HostConfig"].update(host_config)
+            if transfer_files:
+                # The daemon cannot see the files of this host, they are copied into the created container instead
+                del container_config["HostConfig"]["Binds"]
+                container_config["Cmd"] = ["sh", "-c", "mkdir -p /results && chmod +x /eval.sh && /eval.sh"]
+
+            eval_start = time.perf_counter()
+            container_name = f"{image_name.replace('/', '-').replace(':', '-')}-{uuid4()}"
+            container = await client.containers.create_or_replace(name=container_name, config=container_config)
+            session = ContainerSession(container, None)
+            if transfer_files:
+                await session.put_files(run_files)
+            await container.start()
 
-        try:
-            # Wait for container completion or timeout
             try:
-                await asyncio.wait_for(container.wait(), timeout=timeout)
-            except TimeoutError:
-                await container.kill()
+                # Wait for container completion or timeout
+                try:
+                    await asyncio.wait_for(container.wait(), timeout=timeout)
+                except TimeoutError:
+                    await container.kill()
+                    # Fetch logs
+                    logs = await container.log(stdout=True, stderr=True)
+                    logger.debug("\n".join(logs))
+                    if transfer_files:
+                        await copy_phases(session, abs_log_dir, logger)
+                    error = f"Container timed out after {timeout} seconds."
+                    logger.error(error)
+                    raise TimeoutError(error)
+
                 # Fetch logs
                 logs = await container.log(stdout=True, stderr=True)
+                logger.info(f"Container {instance_id} exited in {time.perf_counter() - eval_start:.2f} seconds.")
                 logger.debug("\n".join(logs))
-                error = f"Container timed out after {timeout} seconds."
-                logger.error(error)
-                raise TimeoutError(error)
+                if transfer_files:
+                    await session.get_dir("/results", abs_log_dir)
+                    report = await session.get_file("/pass_report.json")
+                    Path(abs_log_dir, "results/pytest_report.json").write_bytes(report or b"")
 
-            # Fetch logs
-            logs = await container.log(stdout=True, stderr=True)
-            logger.info(f"Container {instance_id} exited in {time.perf_counter() - eval_start:.2f} seconds.")
-            logger.debug("\n".join(logs))
+                return pipeline.gather_results(abs_log_dir, logger, tests, skipped_ok, short, ignore_collector_errors)
 
-            return pipeline.gather_results(abs_log_dir, logger, tests, skipped_ok, short, ignore_collector_errors)
+            except KeyboardInterrupt as e:
+                logger.warning("KeyboardInterrupt: Stopping the container...")
+                await container.delete(force=True)
+                raise e
+            finally:
+                # Cleanup container
+                try:
+                    await container.delete(force=True)
+                except Exception as e:
+                    logger.error(f"Failed to delete container: {e}")
+        finally:
+            if checkpoint:
+                GLOBAL_IMAGE_GC.release(image_name)
 
-        except KeyboardInterrupt as e:
-            logger.warning("KeyboardInterrupt: Stopping the container...")
-            await container.delete(force=True)
-            raise e
+
+async def run_instance_multi(
+    client: aiodocker.Docker,
+    repo: str,
+    instance_id: str,
+    base_commit: str,
+    patch_sets: list[list[str]],
+    tests: list[str],
+    root_log_dir: str,
+    spec_dict: dict,
+    timeout: int=300,
+    verbose: bool=False,
+    short: bool=True,
+    skipped_ok: bool=True,
+    host_config: dict=None,
+    ignore_collector_errors: bool=False,
+    failfast: bool=False,
+    green_zone: bool=False,
+    registry_config: DockerRegisteryConfig=GLOBAL_REGISTRY_CONFIG,
+    pipeline: EvaluationPipelineInterface=DEFAULT_PIPELINE,
+    checkpoint: bool=False,
+) -> list[dict]:
+    """Run the tests of an instance once per set of patches, e.g. for many predictions, in a single container.
+
+    The commit is checked out and installed once, then each set of patches is applied, tested and reverted
+    in turn, so every set starts from the installed tree. Since the install runs before the patches, the install
+    must not depend on the patched sources. A run that times out or fails replaces the container, and when the
+    checkout or install fails, every run that has not run yet gets its error.
+
+    Args:
+        patch_sets: The patches of each run, e.g. [prediction, test patch] for every prediction.
+        checkpoint: Start the container from a post-install checkpoint image instead of installing in it.
+        See `run_instance` for the other arguments.
+
+    Returns:
+        The test results of each set of patches, in order, or a dict with the "error" of the run.
+    """
+    image_name = await build_docker_image_from_specs(
+        client,
+        repo,
+        spec_dict,
+        os.path.join(root_log_dir, 'build_logs'),
+        force_rebuild=False,
+        green_zone=green_zone,
+        registry_config=registry_config,
+    )
+
+    log_dir = os.path.join(root_log_dir, 'evaluate_logs', instance_id)
+    os.makedirs(log_dir, exist_ok=True)
+    with MindForgeHarnessLogger(instance_id, os.path.join(log_dir, "run_instance_multi.log"), add_stdout=verbose) as logger:
+        logger.info(f"Running {len(patch_sets)} patch sets of instance {instance_id} for {repo} with commit {base_commit}")
+        setup_script, eval_script = pipeline.format_checkpoint_scripts(
+            tests=tests,
+            test_cmd=spec_dict["test_cmd"],
+            eval_commands=spec_dict.get("eval_commands", []),
+            install=spec_dict.get("install", ""),
+            timeout=min(int(timeout / 2), UNITEST_TIMEOUT_MAX),
+            pyversion=f"python{'.'.join(spec_dict['python'].replace('python','').split('.')[:2])}",
+            failfast=failfast,
+        )
+        environment = [
+            f"GIT_COMMIT={base_commit}",
+            f"REPO={repo}",
+            f"INSTANCE_ID={instance_id}"
+        ]
+        if checkpoint:
+            image_name = await get_or_create_checkpoint(
+                client, image_name, base_commit, setup_script, environment, host_config, timeout, logger,
+            )
+            setup_script = None
+
+        # One container, reset between the runs, and replaced after a failed run
+        container_pool = ContainerPool(client, max_reuse=len(patch_sets), max_idle=1)
+        results = []
+        try:
+            for i, patches in enumerate(patch_sets):
+                run_start = time.perf_counter()
+                run_log_dir = Path(log_dir, f"run_{i}").resolve()
+                os.makedirs(run_log_dir / "results", exist_ok=True)
+                try:
+                    await run_in_pooled_container(
+                        container_pool,
+                        image_name,
+                        host_config,
+                        {
+                            **{f"/patches/patch_{j}.patch": patch for j, patch in enumerate(patches)},
+                            "/eval.sh": eval_script,
+                        },
+                        environment,
+                        run_log_dir,
+                        timeout,
+                        logger,
+                        setup_script=setup_script,
+                    )
+                    results.append(pipeline.gather_results(run_log_dir, logger, tests, skipped_ok, short, ignore_collector_errors))
+                except SetupError as e:
+                    logger.error(f"Setup of instance {instance_id} failed, failing its {len(patch_sets) - i} remaining runs: {e}")
+                    error = {"error": str(e), "traceback": traceback.format_exc()}
+                    results.extend(dict(error) for _ in patch_sets[i:])
+                    break
+                except Exception as e:
+                    logger.error(f"Run {i} of instance {instance_id} failed: {e}")
+                    results.append({"error": str(e), "traceback": traceback.format_exc()})
+                logger.info(f"Run {i} of instance {instance_id} done in {time.perf_counter() - run_start:.2f} seconds.")
         finally:
-            # Cleanup container
-            try:
-                await container.delete(force=True)
-            except Exception as e:
-                logger.error(f"Failed to delete container: {e}")
+            await container_pool.close(logger)
+            if checkpoint:
+                GLOBAL_IMAGE_GC.release(image_name)
+        report = container_pool.report()
+        logger.info(f"Ran {len(patch_sets)} patch sets in {report['created']} containers.")
+        return results
@@ -0,0 +1,171 @@
+"""Scheduling policies of the instances of an evaluation, and the adaptive bound of their concurrency."""
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+
+import aiodocker
+
+from mindforge_harness.docker.image_builder import get_image_name
+
+SCHEDULING_POLICIES = ["fifo", "affinity"]
+MF_SCHEDULING = os.environ.get("MF_SCHEDULING", "fifo")
+MF_AFFINITY_GROUP_SIZE = int(os.environ.get("MF_AFFINITY_GROUP_SIZE", "8"))
+
+MF_ADAPTIVE_WORKERS = os.environ.get("MF_ADAPTIVE_WORKERS", "false").lower() in ["true", "1"]
+MF_ADAPTIVE_MIN_WORKERS = int(os.environ.get("MF_ADAPTIVE_MIN_WORKERS", "1"))
+MF_ADAPTIVE_INTERVAL = float(os.environ.get("MF_ADAPTIVE_INTERVAL", "10"))
+MF_ADAPTIVE_MAX_LATENCY = float(os.environ.get("MF_ADAPTIVE_MAX_LATENCY", "2"))
+MF_ADAPTIVE_MAX_TIMEOUT_RATE = float(os.environ.get("MF_ADAPTIVE_MAX_TIMEOUT_RATE", "0.05"))
+MF_ADAPTIVE_MAX_LOAD = float(os.environ.get("MF_ADAPTIVE_MAX_LOAD", "1.5"))
+
+def get_affinity_key(instance_data: dict) -> tuple:
+    """Get the key of the instances that can share a container: same image, commit and install command."""
+    if not instance_data.get("spec_dict"):
+        return (instance_data["instance_id"],)
+    image_name = instance_data.get("image_name") or get_image_name(instance_data["repo"], instance_data["spec_dict"])
+    return (image_name, instance_data["base_commit"], instance_data["spec_dict"].get("install", ""))
+
+def group_by_affinity(instance_datas: list[dict], max_group_size: int=MF_AFFINITY_GROUP_SIZE) -> list[list[dict]]:
+    """Group the instances sharing an image, a commit and an install command, in groups of at most `max_group_size`.
+
+    The largest groups come first, so the long groups do not start last and leave the other workers idle.
+    The instances of a group keep their order in the dataset.
+    """
+    max_group_size = max(max_group_size, 1)
+    groups = defaultdict(list)
+    for instance_data in instance_datas:
+        groups[get_affinity_key(instance_data)].append(instance_data)
+    chunks = [
+        group[i:i + max_group_size]
+        for group in groups.values()
+        for i in range(0, len(group), max_group_size)
+    ]
+    return sorted(chunks, key=len, reverse=True)
+
+def get_host_load() -> float:
+    """Get the load average of this host per CPU, or None where it is not available."""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return None
+
+class AdaptiveLimiter:
+    """Bound the concurrent runs by a limit adjusted while the evaluation goes, used like a semaphore.
+
+    The limit starts at `min_limit`. Every `interval` seconds it grows by one if runs waited for it and
+    the daemons are healthy, and it is halved when the Docker API is slower than `max_latency`, when more
+    than `max_timeout_rate` of the runs finished since the last adjustment timed out, or when the load
+    average per CPU of this host is above `max_load`. It always stays within [`min_limit`, `max_limit`],
+    and running runs are never interrupted when it shrinks.
+    """
+
+    def __init__(
+        self,
+        min_limit: int,
+        max_limit: int,
+        interval: float=MF_ADAPTIVE_INTERVAL,
+        max_latency: float=MF_ADAPTIVE_MAX_LATENCY,
+        max_timeout_rate: float=MF_ADAPTIVE_MAX_TIMEOUT_RATE,
+        max_load: float=MF_ADAPTIVE_MAX_LOAD,
+    ):
+        """Create a limiter starting at `min_limit` concurrent runs."""
+        self.min_limit = max(min(min_limit, max_limit), 1)
+        self.max_limit = max(max_limit, self.min_limit)
+        self.interval = interval
+        self.max_latency = max_latency
+        self.max_timeout_rate = max_timeout_rate
+        self.max_load = max_load
+        self.limit = self.min_limit
+        self.active = 0
+        self.waiting = 0
+        self.condition = asyncio.Condition()
+        # Observations since the last adjustment
+        self.runs = 0
+        self.timeouts = 0
+        self.waited = False
+        self.start = time.perf_counter()
+        self.history: list[dict] = [{"seconds": 0.0, "limit": self.limit, "reason": "start"}]
+
+    async def __aenter__(self) -> "AdaptiveLimiter":
+        async with self.condition:
+            if self.active >= self.limit:
+                self.waited = True
+                self.waiting += 1
+                try:
+                    await self.condition.wait_for(lambda: self.active < self.limit)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def record(self, timed_out: bool) -> None:
+        """Record the end of a run, and whether it timed out."""
+        self.runs += 1
+        self.timeouts += timed_out
+
+    async def measure_latency(self, clients: list[aiodocker.Docker]) -> float:
+        """Time a cheap call to every daemon and return the slowest, infinite if one fails."""
+        async def measure(client: aiodocker.Docker) -> float:
+            call_start = time.perf_counter()
+            try:
+                await asyncio.wait_for(client.containers.list(), timeout=self.max_latency * 5)
+            except Exception:
+                return float("inf")
+            return time.perf_counter() - call_start
+        return max(await asyncio.gather(*(measure(client) for client in clients)), default=0.0)
+
+    async def adjust(self, latency: float, logger: logging.Logger) -> int:
+        """Apply one AIMD step from the observations since the last one, and return the new limit."""
+        load = get_host_load()
+        timeout_rate = self.timeouts / self.runs if self.runs else 0.0
+        if latency > self.max_latency:
+            reason = f"Docker API latency {latency:.2f}s"
+        elif timeout_rate > self.max_timeout_rate:
+            reason = f"{self.timeouts} of {self.runs} runs timed out"
+        elif load is not None and load > self.max_load:
+            reason = f"load {load:.2f} per CPU"
+        else:
+            reason = None
+
+        if reason:
+            limit = max(self.limit // 2, self.min_limit)
+        elif self.waited or self.waiting:
+            limit = min(self.limit + 1, self.max_limit)
+            reason = f"runs waited, Docker API latency {latency:.2f}s"
+        else:
+            limit = self.limit
+        self.runs, self.timeouts, self.waited = 0, 0, False
+
+        if limit != self.limit:
+            logger.info(f"Adaptive workers: {self.limit} -> {limit} concurrent runs ({reason}).")
+            self.history.append({"seconds": time.perf_counter() - self.start, "limit": limit, "reason": reason})
+            async with self.condition:
+                self.limit = limit
+                self.condition.notify_all()
+        return limit
+
+    async def run(self, clients: list[aiodocker.Docker], logger: logging.Logger) -> None:
+        """Adjust the limit every `interval` seconds until cancelled."""
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.adjust(await self.measure_latency(clients), logger)
+
+    def summary(self) -> dict:
+        """The limits chosen over time, with their time-weighted average."""
+        end = time.perf_counter() - self.start
+        changes = self.history + [{"seconds": end, "limit": self.limit}]
+        weighted = sum(change["limit"] * (following["seconds"] - change["seconds"]) for change, following in zip(changes, changes[1:]))
+        return {
+            "min": min(change["limit"] for change in self.history),
+            "max": max(change["limit"] for change in self.history),
+            "average": weighted / end if end else self.limit,
+            "final": self.limit,
+            "history": self.history,
+        }
@@ -6,11 +6,13 @@ import time
 import tempfile
 import traceback
 import shutil
-import aiodocker
 import uvicorn
 from fastapi import FastAPI
 from mindforge_harness.utils import load_dataset_from_path, prepare_dataset_for_evaluation
-from mindforge_harness.run_instance import run_instance
+from mindforge_harness.docker.backends import MF_DOCKER_HOSTS, BackendPool
+from mindforge_harness.docker.image_builder import get_image_name
+from mindforge_harness.docker.resources import MF_RESOURCE_ADMISSION, get_resource_request
+from mindforge_harness.run_instance import run_instance, run_instance_multi
 
 logger = logging.getLogger(__name__)
 
@@ -32,6 +34,10 @@ parser.add_argument("--green_zone", action="store_true", default=False, help="Us
 
 parser.add_argument("--timeout", type=int, default=300, help="Timeout for the evaluation.")
 
+parser.add_argument("--resource_admission", action="store_true", default=MF_RESOURCE_ADMISSION, help="Start a run once the CPUs and memory requested by its spec are free on the Docker host.")
+
+parser.add_argument("--docker_hosts", type=str, default=MF_DOCKER_HOSTS, help="Comma-separated Docker endpoints to spread the runs over, each optionally followed by '=<capacity>'. Use the local daemon if not provided.")
+
 args = parser.parse_args()
 
 dataset = load_dataset_from_path(args.dataset_name)
@@ -42,7 +48,7 @@ dataset = {
 
 sem = asyncio.Semaphore(args.max_workers)
 
-docker_client = None
+backends = None
 
 if args.use_tmp_dir:
     log_dir = tempfile.TemporaryDirectory()
@@ -50,31 +56,39 @@ else:
     log_dir = "logs"
 
 async def run_on_instance(instance_id: str, model_patch: str):
-    global docker_client
-    if not docker_client:
-        docker_client = aiodocker.Docker()
+    global backends
+    if not backends:
+        backends = BackendPool.from_hosts(args.docker_hosts, args.max_workers, args.timeout, logger)
     async with sem:
         try:
             start_time = time.perf_counter()
             instance_log_dir = os.path.join(log_dir, instance_id)
             os.makedirs(instance_log_dir, exist_ok=True)
             instance_args = dataset[instance_id]
-            results = await run_instance(
-                client=docker_client,
-                repo=instance_args["repo"],
-                instance_id=instance_args["instance_id"],
-                base_commit=instance_args["base_commit"],
-                patches=[model_patch,instance_args["test_patch"]],
-                spec_dict=instance_args['spec_dict'],
-                tests=instance_args["FAIL_TO_PASS"] + instance_args["PASS_TO_PASS"],
-                root_log_dir=instance_log_dir,
-                timeout=args.timeout,
-                verbose=False,
-                short=True,
-                skipped_ok=True,
-                host_config= {"NetworkMode": "none", "NanoCpus": 2000000000, "Memory": 2147483648},
-                green_zone=args.green_zone
-            )
+            image_name = instance_args.get("image_name") or get_image_name(instance_args["repo"], instance_args["spec_dict"])
+            request = get_resource_request(instance_args["spec_dict"])
+
+            async def run(backend):
+                # The container is limited to the request as the host can give it, a larger one would be rejected
+                await backend.load_capacity(logger)
+                return await run_instance(
+                    client=backend.client,
+                    repo=instance_args["repo"],
+                    instance_id=instance_args["instance_id"],
+                    base_commit=instance_args["base_commit"],
+                    patches=[model_patch,instance_args["test_patch"]],
+                    spec_dict=instance_args['spec_dict'],
+                    tests=instance_args["FAIL_TO_PASS"] + instance_args["PASS_TO_PASS"],
+                    root_log_dir=instance_log_dir,
+                    timeout=args.timeout,
+                    verbose=False,
+                    short=True,
+                    skipped_ok=True,
+                    host_config={"NetworkMode": "none", **backend.resource_limits(request)},
+                    green_zone=args.green_zone,
+                    transfer_files=backend.remote,
+                )
+            _, results = await backends.run(image_name, run, logger, request=request if args.resource_admission else None)
             resolved = all([code for code in results.values()])
             time_elapsed = time.perf_counter() - start_time
             logger.info(f"Resolved {instance_id} in {time_elapsed:.2f} seconds. Resolved: {resolved}")
@@ -96,6 +110,68 @@ async def run_on_instance(instance_id: str, model_patch: str):
             if os.path.exists(instance_log_dir):
                 shutil.rmtree(instance_log_dir, ignore_errors=True)
 
+async def run_predictions_on_instance(instance_id: str, model_patches: list[str]):
+    global backends
+    if not backends:
+        backends = BackendPool.from_hosts(args.docker_hosts, args.max_workers, args.timeout, logger)
+    async with sem:
+        start_time = time.perf_counter()
+        instance_log_dir = os.path.join(log_dir, instance_id)
+        try:
+            os.makedirs(instance_log_dir, exist_ok=True)
+            instance_args = dataset[instance_id]
+            image_name = instance_args.get("image_name") or get_image_name(instance_args["repo"], instance_args["spec_dict"])
+            request = get_resource_request(instance_args["spec_dict"])
+
+            async def run(backend):
+                # The container is limited to the request as the host can give it, a larger one would be rejected
+                await backend.load_capacity(logger)
+                return await run_instance_multi(
+                    client=backend.client,
+                    repo=instance_args["repo"],
+                    instance_id=instance_args["instance_id"],
+                    base_commit=instance_args["base_commit"],
+                    patch_sets=[[model_patch, instance_args["test_patch"]] for model_patch in model_patches],
+                    spec_dict=instance_args['spec_dict'],
+                    tests=instance_args["FAIL_TO_PASS"] + instance_args["PASS_TO_PASS"],
+                    root_log_dir=instance_log_dir,
+                    timeout=args.timeout,
+                    verbose=False,
+                    short=True,
+                    skipped_ok=True,
+                    host_config={"NetworkMode": "none", **backend.resource_limits(request)},
+                    green_zone=args.green_zone
+                )
+            _, results = await backends.run(image_name, run, logger, request=request if args.resource_admission else None)
+            time_elapsed = time.perf_counter() - start_time
+            logger.info(f"Ran {len(model_patches)} predictions of {instance_id} in {time_elapsed:.2f} seconds.")
+            return [
+                {
+                    "instance_id": instance_id,
+                    "index": i,
+                    "resolved": "error" not in result and all(result.values()),
+                    "time": time_elapsed,
+                    **({"error": result["error"]} if "error" in result else {}),
+                }
+                for i, result in enumerate(results)
+            ]
+        except Exception as e:
+            logger.error(f"Error running {instance_id}: {e}")
+            logger.error(traceback.format_exc())
+            return [
+                {
+                    "instance_id": instance_id,
+                    "index": i,
+                    "resolved": False,
+                    "time": time.perf_counter() - start_time,
+                    "error": str(e)
+                }
+                for i in range(len(model_patches))
+            ]
+        finally:
+            if os.path.exists(instance_log_dir):
+                shutil.rmtree(instance_log_dir, ignore_errors=True)
+
 @app.get("/run_one_instance")
 async def run_one_instance(json_payload: dict):
     return await run_on_instance(json_payload["instance_id"], json_payload["model_patch"]   )
@@ -106,6 +182,10 @@ async def run_many_instances(json_payload: dict):
         run_on_instance(instance_id, model_patch)
         for instance_id, model_patch in json_payload.items()
     ])
+
+@app.get("/run_many_predictions")
+async def run_many_predictions(json_payload: dict):
+    return await run_predictions_on_instance(json_payload["instance_id"], json_payload["model_patches"])
     
 
 if __name__ == "__main__":
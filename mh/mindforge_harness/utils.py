@@ -1,21 +1,57 @@
 """Utility functions for the MindForge harness."""
+import asyncio
+import fnmatch
 import hashlib
 import io
+import itertools
+import logging
 import os
 import posixpath
 import re
-import shutil
+import stat
 import tarfile
+import zlib
+from typing import Iterable, Iterator
 
 import git
 import orjson
-import requests
 
 from mindforge_harness.docker.consts import DOCKER_IMAGE_COMBINED
 
 # Get the current directory
 GIT_REPO_CACHE_DIR = os.environ.get("GIT_REPO_CACHE_DIR", "git_repo_caches")
 
+# Build context streaming
+BUILD_CONTEXT_CHUNK_SIZE = 64 * 1024
+TAR_END_OF_ARCHIVE = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+# A pip requirement spelled by name, with optional extras, version specifiers, markers or URL
+REQUIREMENT = re.compile(r"^([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*([=<>!~;@,].*)?$")
+# pip options whose argument may be given as the next entry of `pip_packages`
+PIP_OPTIONS_WITH_ARGUMENT = {
+    "-i", "--index-url", "--extra-index-url", "-f", "--find-links", "-c", "--constraint",
+    "-r", "--requirement", "-e", "--editable", "--trusted-host", "--no-binary", "--only-binary",
+}
+
+# `.git` is kept, since the evaluation script checks out the instance commit inside the container
+DEFAULT_BUILD_CONTEXT_IGNORE = [
+    "**/__pycache__",
+    "**/*.py[cod]",
+    "**/.pytest_cache",
+    "**/.mypy_cache",
+    "**/.ruff_cache",
+    ".tox",
+    ".nox",
+    ".venv",
+]
+
+def parse_size(size: str) -> int:
+    """Parse a human readable size such as `512M` or `20G` into bytes."""
+    size = str(size).strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
 def is_valid_git_repo(path: str) -> bool:
     """Check if a directory is a valid Git repository."""
     try:
@@ -24,40 +60,6 @@ def is_valid_git_repo(path: str) -> bool:
     except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError):
         return False
     
-def get_cached_or_clone_repo(repo_name: str, clean_cache: bool=False) -> str:
-    """Get the cached or cloned repository path."""
-    repo_path = os.path.join(GIT_REPO_CACHE_DIR, repo_name.replace('/', '__'))
-    repo_path = os.path.abspath(repo_path)
-    
-    if os.path.exists(repo_path):
-        if not clean_cache and os.path.isdir(repo_path) and os.listdir(repo_path):
-            if is_valid_git_repo(repo_path):
-                # print(f"Using cached repo at {repo_path}.")
-                return repo_path
-            # else:
-            #     print(f"Found invalid/corrupt Git repo at {repo_path}. Will remove and re-clone.")
-        
-        try:
-            shutil.rmtree(repo_path)
-            # print(f"Removed existing repo cache at {repo_path}.")
-        except Exception as ex:
-            # print(f"Failed to remove cached repo path {repo_path} : {ex}")
-            raise
-            
-    os.makedirs(repo_path, exist_ok=True)
-    
-    try:
-        git.Repo.clone_from(f"https://github.com/{repo_name}", repo_path, recursive=True)
-    except Exception as ex:
-        # print(f"Clone failed : {ex}. Cleaning up.")
-        try:
-            shutil.rmtree(repo_path)
-        except Exception as cleanup_ex:
-            # print(f"Failed to remove partial clone : {cleanup_ex}")
-            raise
-        
-    return repo_path
-
 def extract_crash_details_from_report(report: dict) -> dict:
     """Extract crash details from the test report."""
     tests = report.get('tests', [])
@@ -131,9 +133,10 @@ def load_dataset_from_path(dataset_path: str) -> dict:
 def prepare_dataset_for_evaluation(
     raw_dataset: dict,
     instance_ids: list[str]=None,
-    prediction_path: str=None
+    prediction_path: str=None,
+    logger: logging.Logger=None,
 ) -> dict:
-    """Prepare the dataset for evaluation."""
+    """Prepare the dataset for evaluation, with canonical and interned specs."""
     dataset_dict = {data["instance_id"]: data for data in raw_dataset}
 
     # Filter dataset if instance_ids are provided
@@ -149,7 +152,7 @@ def prepare_dataset_for_evaluation(
         predictions = {data["instance_id"]: data['model_patch'] for data in load_dataset_from_path(prediction_path)}
 
     # Prepare dataset with necessary fields
-    return {
+    dataset = {
         iid: {
             'repo': data['repo'],
             'instance_id': iid,
@@ -160,6 +163,103 @@ def prepare_dataset_for_evaluation(
         }
         for iid, data in dataset_dict.items()
     }
+    stats = intern_spec_dicts(dataset.values())
+    if logger:
+        logger.info(f"{len(dataset)} instances use {stats['specs']} distinct specs and {stats['images']} images, "
+                    f"{stats['deduplicated']} images deduplicated by spec canonicalization.")
+    return dataset
+
+def normalize_python_version(python_version: str) -> str:
+    """Strip the blanks and the `python` prefix agents sometimes put in front of the version."""
+    python_version = str(python_version).strip().lower()
+    return python_version[len('python'):].strip() if python_version.startswith('python') else python_version
+
+def normalize_package_name(name: str) -> str:
+    """Normalize a package name as in PEP 503."""
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+def normalize_requirement(requirement: str) -> str:
+    """Spell a pip requirement one way: normalized name and extras, sorted specifiers without blanks."""
+    requirement = requirement.strip()
+    match = REQUIREMENT.match(requirement)
+    if not match:
+        return requirement  # Paths, URLs and options are kept as given
+    name, extras, rest = match.groups()
+    canonical = normalize_package_name(name)
+    if extras:
+        extras = sorted({normalize_package_name(e.strip()) for e in extras[1:-1].split(",") if e.strip()})
+        canonical += f"[{','.join(extras)}]" if extras else ""
+    rest = (rest or "").strip()
+    if rest.startswith("@"):
+        return f"{canonical} @ {rest[1:].strip()}"
+    specifier, _, marker = rest.partition(";")
+    specifiers = sorted(s for s in re.sub(r"\s+", "", specifier).split(",") if s)
+    canonical += ",".join(specifiers)
+    if marker.strip():
+        canonical += f"; {' '.join(marker.split())}"
+    return canonical
+
+def canonicalize_spec_dict(spec_dict: dict) -> dict:
+    """Return a copy of a spec where equivalent python versions and package lists are spelled the same.
+
+    The pip packages are installed by a single command, so the order of the requirements does not matter and
+    they are sorted. Options such as `--index-url` and their arguments are kept first, in their original order.
+    """
+    spec_dict = dict(spec_dict)
+    if spec_dict.get('python'):
+        spec_dict['python'] = normalize_python_version(spec_dict['python'])
+    if spec_dict.get('pip_packages'):
+        options, requirements = [], set()
+        previous = None
+        for pkg in (pkg.strip() for pkg in spec_dict['pip_packages']):
+            if not pkg:
+                continue
+            # The argument of an option, e.g. the URL after `-f`, stays after it
+            if REQUIREMENT.match(pkg) and previous not in PIP_OPTIONS_WITH_ARGUMENT:
+                requirements.add(normalize_requirement(pkg))
+            else:
+                options.append(pkg)
+            previous = pkg
+        spec_dict['pip_packages'] = options + sorted(requirements)
+    if isinstance(spec_dict.get('packages'), str):
+        spec_dict['packages'] = ' '.join(spec_dict['packages'].split())
+    return spec_dict
+
+def get_spec_hash(spec_dict: dict) -> str:
+    """Hash the canonical form of a spec."""
+    return consistent_hash(canonicalize_spec_dict(spec_dict))
+
+def get_image_name(repo_name: str, spec_dict: dict) -> str:
+    """Get a unique Docker Hub-compatible image name.
+
+    <dockerhub-user>/<something-unique>:<tag> (if you need a tag)
+    For simplicity, we'll do no explicit tag, just "latest".
+    Instances prepared by `prepare_dataset_for_evaluation` already carry it as 'image_name'.
+    """
+    repo_name = repo_name.lower()
+    spec_hash = get_spec_hash(spec_dict)
+    return f"eval-{repo_name.replace('/', '-')}-{spec_hash[:8]}"
+
+def intern_spec_dicts(instances: Iterable[dict]) -> dict:
+    """Canonicalize the specs of instances in place, share one dict per distinct spec and name each image once."""
+    interned = {}
+    raw_images = set()
+    images = set()
+    for instance in instances:
+        if not instance.get('spec_dict'):
+            continue
+        raw_images.add((instance['repo'].lower(), consistent_hash(instance['spec_dict'])))
+        spec_dict = canonicalize_spec_dict(instance['spec_dict'])
+        key = (instance['repo'], orjson.dumps(spec_dict, option=orjson.OPT_SORT_KEYS))
+        if key not in interned:
+            interned[key] = (spec_dict, get_image_name(instance['repo'], spec_dict))
+        instance['spec_dict'], instance['image_name'] = interned[key]
+        images.add(instance['image_name'])
+    return {
+        "specs": len({key[1] for key in interned}),
+        "images": len(images),
+        "deduplicated": len(raw_images) - len(images),
+    }
 
 
 def consistent_hash(data: dict, unhash_fields: list=['install', 'test_cmd', 'eval_commands']):
@@ -195,63 +295,163 @@ def consistent_hash(data: dict, unhash_fields: list=['install', 'test_cmd', 'eva
     return hashlib.sha256(combined_data).hexdigest()
 
 def download_requirements_by_commit(repo_name: str, requirements_txts: list[str], commit: str) -> list[str]:
-    """Get the requirements.txt file for a given commit."""
-    request_url = "https://raw.githubusercontent.com/"
-    headers = {
-    "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_11_5) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/50.0.2661.102 Safari/537.36"
-    }
-    requirements = []
-
-    def exclude_line(line: str) -> bool:
-        """Exclude lines that are not requirements."""
-        return any([line.strip().startswith(x) for x in ["-e .", "#", ".[test"]])
-
-    # Recursively get requirements from all requirements.txt files
-    while len(requirements_txts) > 0:
-        req_file = requirements_txts.pop(0)
-        req_dir = "/".join(req_file.split("/")[:-1]) # Some requirements.txt files have relative paths like ./tests/requirements.txt
-        url = posixpath.join(request_url, repo_name, commit, req_file)
-        response = requests.get(url, headers=headers)
-
-        if response.status_code != 200:
-            raise ValueError(f"Could not find requirements.txt at path {url}")
-        lines = response.text
-
-        for line in lines.split("\n"):
-            if line.strip().startswith("-r"):
-                # Handle recursive requirements
-                requirements_txts.append(posixpath.join(req_dir, line[len("-r"):].strip()))
-            else:
-                if line and not exclude_line(line):
-                    requirements.append(line)
-
-    return requirements
-
-def create_tarball(build_context_path: str, repo_path: str, additional_files: list[str]=None):
-    """Create a tarball from the build context path, including additional files."""
-    tar_stream = io.BytesIO()
-    with tarfile.open(fileobj=tar_stream, mode="w") as tar:
-        for root, _, files in os.walk(build_context_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, build_context_path)
-                tar.add(file_path, arcname=arcname)
-
-        for root, _, files in os.walk(repo_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, os.path.dirname(repo_path))
-                tar.add(file_path, arcname=arcname)
-
-        # Add additional files if provided
-        if additional_files:
-            for file_path in additional_files:
-                if os.path.exists(file_path):
-                    arcname = os.path.basename(file_path)
-                    tar.add(file_path, arcname=arcname)
-                else:
-                    raise FileNotFoundError(f"Additional file '{file_path}' not found.")
-
-    tar_stream.seek(0)
-    return tar_stream
+    """Get the requirements of requirements.txt files at a given commit, following their `-r` includes."""
+    return download_requirements_by_commits([(repo_name, requirements_txts, commit)])[0]
+
+def download_requirements_by_commits(requests: list[tuple[str, list[str], str]]) -> list[list[str]]:
+    """Get the requirements of many (repo_name, requirements_txts, commit) at once.
+
+    Synchronous wrapper of `RequirementsResolver.resolve_many`, which reads the files from the local git mirror
+    or downloads them concurrently, and caches them on disk.
+    """
+    # Imported here, the resolver depends on this module
+    from mindforge_harness.requirements_resolver import GLOBAL_REQUIREMENTS_RESOLVER
+
+    async def resolve() -> list[list[str]]:
+        try:
+            return await GLOBAL_REQUIREMENTS_RESOLVER.resolve_many(requests)
+        finally:
+            await GLOBAL_REQUIREMENTS_RESOLVER.close()
+    return asyncio.run(resolve())
+
+def load_dockerignore(path: str) -> list[str]:
+    """Load the `.dockerignore` patterns of a directory, if it has one."""
+    dockerignore_path = os.path.join(path, ".dockerignore")
+    if not os.path.isfile(dockerignore_path):
+        return []
+    with open(dockerignore_path) as f:
+        return parse_dockerignore(f.read())
+
+def parse_dockerignore(content: str) -> list[str]:
+    """Parse the patterns of a `.dockerignore` file, skipping blank lines and comments."""
+    lines = [line.strip() for line in content.splitlines()]
+    return [line for line in lines if line and not line.startswith("#")]
+
+def match_path_segments(pattern_parts: list[str], path_parts: list[str]) -> bool:
+    """Match path segments against pattern segments: `*` and `?` stay within a segment, `**` spans any number of them."""
+    if not pattern_parts:
+        return not path_parts
+    if pattern_parts[0] == "**":
+        return any(match_path_segments(pattern_parts[1:], path_parts[i:]) for i in range(len(path_parts) + 1))
+    return bool(path_parts) and fnmatch.fnmatchcase(path_parts[0], pattern_parts[0]) and match_path_segments(pattern_parts[1:], path_parts[1:])
+
+def is_ignored(relpath: str, patterns: list[str]) -> bool:
+    """Check a relative path against `.dockerignore`-style patterns. The last matching pattern wins.
+
+    As in Docker, `*.log` only matches at the root of the context, and `**/*.log` at any depth.
+    """
+    parts = relpath.split("/")
+    ignored = False
+    for pattern in patterns:
+        negate = pattern.startswith("!")
+        pattern_parts = [part for part in pattern.lstrip("!").strip("/").split("/") if part not in ("", ".")]
+        # A pattern matching a parent directory also excludes everything below it
+        if any(match_path_segments(pattern_parts, parts[:i]) for i in range(1, len(parts) + 1)):
+            ignored = not negate
+    return ignored
+
+def iter_context_files(root: str, arc_root: str, ignore_patterns: list[str]=None) -> Iterator[tuple[str, str]]:
+    """Yield (file_path, arcname) for each file under root that is not ignored."""
+    ignore_patterns = ignore_patterns or []
+    # Ignored directories can only be pruned if no pattern may re-include something below them
+    can_prune = not any(p.startswith("!") for p in ignore_patterns)
+    for dirpath, dirnames, files in os.walk(root):
+        reldir = os.path.relpath(dirpath, root)
+        reldir = "" if reldir == "." else reldir + "/"
+        if can_prune:
+            dirnames[:] = [d for d in dirnames if not is_ignored(reldir + d, ignore_patterns)]
+        dirnames.sort()
+        for file in sorted(files):
+            if not is_ignored(reldir + file, ignore_patterns):
+                yield os.path.join(dirpath, file), posixpath.join(arc_root, reldir + file) if arc_root else reldir + file
+
+def iter_tar_members(files: Iterable[tuple[str, str]]) -> Iterator[bytes]:
+    """Yield the raw tar records of the given (file_path, arcname) pairs, one chunk at a time.
+
+    The end-of-archive marker is not included, so the output of several calls can be concatenated.
+    """
+    for file_path, arcname in files:
+        st = os.lstat(file_path)
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.mode = stat.S_IMODE(st.st_mode)
+        tarinfo.mtime = int(st.st_mtime)
+        if stat.S_ISLNK(st.st_mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = os.readlink(file_path)
+        else:
+            tarinfo.size = st.st_size
+        yield tarinfo.tobuf(tarfile.GNU_FORMAT, "utf-8", "surrogateescape")
+        if not tarinfo.size:
+            continue
+        with open(file_path, "rb") as f:
+            remaining = tarinfo.size
+            while remaining > 0:
+                chunk = f.read(min(BUILD_CONTEXT_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise OSError(f"File {file_path} shrank while it was being added to the build context.")
+                remaining -= len(chunk)
+                yield chunk
+        if tarinfo.size % tarfile.BLOCKSIZE:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - tarinfo.size % tarfile.BLOCKSIZE)
+
+def gzip_chunks(chunks: Iterable[bytes], level: int=6) -> Iterator[bytes]:
+    """Compress a stream of chunks into one gzip member."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)  # wbits=31 writes a gzip header
+    for chunk in chunks:
+        if compressed := compressor.compress(chunk):
+            yield compressed
+    yield compressor.flush()
+
+class IterStream(io.RawIOBase):
+    """Read-only file object over an iterator of byte chunks, produced lazily as it is read."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        """Wrap the chunk iterator."""
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def readable(self) -> bool:
+        """Return True, the stream is readable."""
+        return True
 
+    def read(self, size: int=-1) -> bytes:
+        """Read up to size bytes, pulling at most one new chunk from the iterator unless size is negative."""
+        if size is None or size < 0:
+            data = self._buffer + b"".join(self._chunks)
+            self._buffer = b""
+            return data
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return b""
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readinto(self, b) -> int:
+        """Read into a pre-allocated buffer."""
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+def create_tarball(build_context_path: str, repo_path: str=None, additional_files: list[str]=None, ignore_patterns: list[str]=None) -> IterStream:
+    """Create a gzip compressed tarball stream from the build context path, including additional files.
+
+    The tarball is produced while the stream is read, so memory stays flat regardless of the repository size.
+    The repository is optional. Its files matching `ignore_patterns` (by default `DEFAULT_BUILD_CONTEXT_IGNORE`
+    plus the repository's own `.dockerignore`) are left out.
+    """
+    if ignore_patterns is None and repo_path:
+        ignore_patterns = DEFAULT_BUILD_CONTEXT_IGNORE + load_dockerignore(repo_path)
+
+    # Check additional files before streaming, so a missing file fails the build early
+    for file_path in additional_files or []:
+        if not os.path.exists(file_path):
+            raise FileNotFoundError(f"Additional file '{file_path}' not found.")
+
+    files = itertools.chain(
+        iter_context_files(build_context_path, ""),
+        iter_context_files(repo_path, os.path.basename(repo_path), ignore_patterns) if repo_path else [],
+        ((file_path, os.path.basename(file_path)) for file_path in additional_files or []),
+    )
+    return IterStream(gzip_chunks(itertools.chain(iter_tar_members(files), [TAR_END_OF_ARCHIVE])))
@@ -0,0 +1,143 @@
+"""Tests for the pool of Docker daemons."""
+import asyncio
+import logging
+
+import pytest
+from aiodocker.exceptions import DockerError
+
+from mindforge_harness.docker import resources
+from mindforge_harness.docker.backends import BackendPool, DockerBackend, is_backend_failure, parse_docker_hosts
+from mindforge_harness.docker.resources import get_resource_limits, get_resource_request
+
+
+class FakeImages:
+    def __init__(self, tags: list[str]):
+        self.tags = tags
+
+    async def list(self):
+        return [{"RepoTags": self.tags}]
+
+    async def inspect(self, tag: str):
+        raise DockerError(404, {"message": "No such image"})
+
+
+class FakeSystem:
+    async def info(self):
+        return {"NCPU": 8, "MemTotal": 10 * 1024 ** 3}
+
+
+class FakeDocker:
+    def __init__(self, docker_host: str, tags: list[str]):
+        self.docker_host = docker_host
+        self.images = FakeImages(tags)
+        self.system = FakeSystem()
+        self.up = True
+
+    async def version(self):
+        if not self.up:
+            raise DockerError(900, "Cannot connect to Docker Engine via unix://localhost [Connection refused]")
+        return {"Version": "fake"}
+
+    async def close(self):
+        pass
+
+
+def test_parse_docker_hosts():
+    """Test that endpoints are split, with their capacity or the default one."""
+    assert parse_docker_hosts(" unix:///var/run/docker.sock=8, tcp://10.0.0.2:2375,,", 4) == [
+        ("unix:///var/run/docker.sock", 8),
+        ("tcp://10.0.0.2:2375", 4),
+    ]
+
+
+def test_is_backend_failure():
+    """Test that the errors aiodocker raises for an unreachable daemon are told apart from the errors of a run."""
+    assert is_backend_failure(DockerError(900, "Cannot connect to Docker Engine via unix://localhost [Connection refused]"))
+    assert is_backend_failure(asyncio.TimeoutError())
+    assert not is_backend_failure(DockerError(404, "No such image"))
+    assert not is_backend_failure(ValueError("Test report missing"))
+
+
+def test_backend_pool_prefers_image_holders_and_reroutes_from_failed_daemons():
+    """Test that runs go to daemons holding their image first, respect capacities, and move off a failed daemon."""
+    first = DockerBackend("a", 1, FakeDocker("unix://backends-test-a", []))
+    second = DockerBackend("b", 1, FakeDocker("unix://backends-test-b", ["eval-image:latest"]), remote=True)
+    pool = BackendPool([first, second])
+    logger = logging.getLogger("test_backends")
+
+    async def run():
+        holder = await pool.acquire("eval-image")
+        other = await pool.acquire("eval-image")
+        assert (holder, other) == (second, first)
+        waiter = asyncio.create_task(pool.acquire("eval-image"))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()  # Every daemon is at its capacity
+        await pool.release(first)
+        assert await waiter is first
+        await pool.release(first)
+        await pool.release(second)
+
+        async def fails_on_second(backend: DockerBackend):
+            if backend is second:
+                second.client.up = False
+                # What aiodocker raises when the daemon does not answer
+                raise DockerError(900, "Cannot connect to Docker Engine via unix://localhost [Connection reset]")
+            return backend.url
+
+        assert await pool.run("eval-image", fails_on_second, logger) == (first, "a")
+        assert not second.healthy and first.active == second.active == 0
+
+        async def fails(backend: DockerBackend):
+            raise ValueError("Test report missing")
+
+        with pytest.raises(ValueError):
+            await pool.run("eval-image", fails, logger)
+        # A run error does not drain the daemon
+        assert first.healthy
+        first.healthy = False
+        with pytest.raises(Exception, match="No Docker daemon"):
+            await pool.acquire("eval-image")
+
+    asyncio.run(run())
+    report = pool.report()
+    assert report["b"] == {"runs": 2, "rerouted": 1, "image_hits": 2, "healthy": False}
+    assert report["a"]["runs"] == 4 and report["a"]["rerouted"] == 0
+
+
+def test_backend_pool_admits_runs_against_host_resources(monkeypatch):
+    """Test that runs are admitted while their requests fit the host, and that a request larger than the host runs alone."""
+    monkeypatch.setattr(resources, "MF_HOST_CPUS", 0)
+    monkeypatch.setattr(resources, "MF_HOST_MEMORY", 0)
+    large = get_resource_request({"resources": {"cpus": 4, "memory": "8G"}})
+    small = get_resource_request({"resources": {"memory": 512 * 1024 ** 2}})
+    assert large == (4.0, 8 * 1024 ** 3) and small == (resources.MF_DEFAULT_CPUS, 512 * 1024 ** 2)
+    assert get_resource_request({}) == (resources.MF_DEFAULT_CPUS, resources.MF_DEFAULT_MEMORY)
+    assert get_resource_limits(large) == {"NanoCpus": 4_000_000_000, "Memory": 8 * 1024 ** 3}
+
+    backend = DockerBackend("a", 10, FakeDocker("unix://backends-test-resources", []))
+    pool = BackendPool([backend])
+    logger = logging.getLogger("test_backends")
+
+    async def run():
+        await pool.acquire("eval-image", request=large, logger=logger)
+        # 90% of the 10 GiB of the host are admitted
+        assert (backend.cpus, backend.memory) == (8.0, 9 * 1024 ** 3)
+        await pool.acquire("eval-image", request=small, logger=logger)
+        waiter = asyncio.create_task(pool.acquire("eval-image", request=large, logger=logger))
+        await asyncio.sleep(0.01)
+        assert not waiter.done()  # 8 GiB of the 9 GiB are used
+        await pool.release(backend, large)
+        await waiter
+        await pool.release(backend, large)
+        await pool.release(backend, small)
+        assert (backend.active, backend.used_cpus, backend.used_memory) == (0, 0, 0)
+
+        # A request larger than the host is reduced to it
+        huge = (64.0, 64 * 1024 ** 3)
+        await pool.acquire("eval-image", request=huge, logger=logger)
+        assert (backend.used_cpus, backend.used_memory) == (8.0, 9 * 1024 ** 3)
+        # and its container to what the host has, or the daemon would reject it
+        assert backend.resource_limits(huge) == {"NanoCpus": 8_000_000_000, "Memory": 9 * 1024 ** 3}
+        await pool.release(backend, huge)
+
+    asyncio.run(run())
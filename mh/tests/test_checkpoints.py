@@ -0,0 +1,112 @@
+"""Tests for the post-install checkpoint images."""
+import asyncio
+import logging
+
+import pytest
+from aiodocker.exceptions import DockerError
+
+from mindforge_harness.docker import checkpoints
+from mindforge_harness.docker.checkpoints import get_checkpoint_image_name, get_or_create_checkpoint
+from mindforge_harness.docker.image_gc import ImageGarbageCollector
+from mindforge_harness.run_instance import DEFAULT_PIPELINE
+
+
+class FakeContainer:
+    def __init__(self, config: dict, status_code: int=0):
+        self.config = config
+        self.status_code = status_code
+        self.committed = None
+        self.deleted = False
+
+    async def start(self):
+        pass
+
+    async def wait(self):
+        await asyncio.sleep(0.01)
+        return {"StatusCode": self.status_code}
+
+    async def log(self, stdout=True, stderr=True):
+        return ["installed"]
+
+    async def commit(self, repository: str, tag: str, changes: list[str]):
+        self.committed = f"{repository}:{tag}"
+
+    async def delete(self, force: bool=False):
+        self.deleted = True
+
+
+class FakeContainers:
+    def __init__(self, status_code: int=0):
+        self.created = []
+        self.status_code = status_code
+
+    async def create_or_replace(self, name: str, config: dict):
+        self.created.append(FakeContainer(config, self.status_code))
+        return self.created[-1]
+
+
+class FakeImages:
+    async def list(self):
+        return []
+
+    async def inspect(self, tag: str):
+        raise DockerError(404, {"message": "No such image"})
+
+
+class FakeDocker:
+    docker_host = "unix://checkpoint-test"
+
+    def __init__(self, status_code: int=0):
+        self.containers = FakeContainers(status_code)
+        self.images = FakeImages()
+
+
+def test_checkpoint_is_created_once_per_commit_and_install(tmp_path, monkeypatch):
+    """Test that concurrent runs of a commit share one checkpoint, and that the scripts split checkout/install from the run."""
+    gc = ImageGarbageCollector(str(tmp_path / "usage.json"))
+    monkeypatch.setattr(checkpoints, "GLOBAL_IMAGE_GC", gc)
+    setup_script, eval_script = DEFAULT_PIPELINE.format_checkpoint_scripts(
+        tests=["tests/test_a.py::test_a"],
+        test_cmd="pytest",
+        eval_commands=[],
+        install="pip install -e .",
+        timeout=60,
+        pyversion="python3.11",
+        failfast=False,
+    )
+    assert "git checkout $GIT_COMMIT || exit $?" in setup_script and "pip install --no-deps --no-build-isolation -e ." in setup_script
+    assert "patch_codes.py" not in setup_script
+    assert "patch_codes.py" in eval_script and "git checkout" not in eval_script and "pip install" not in eval_script
+    assert "tests/test_a.py::test_a" in eval_script
+
+    client = FakeDocker()
+    logger = logging.getLogger("test_checkpoints")
+
+    async def run():
+        return await asyncio.gather(*(
+            get_or_create_checkpoint(client, "eval-repo-1234", "abc", setup_script, ["GIT_COMMIT=abc"], None, 60, logger)
+            for _ in range(3)
+        ))
+
+    names = asyncio.run(run())
+    expected = get_checkpoint_image_name("eval-repo-1234", "abc", setup_script)
+    assert names == [expected] * 3 and expected.startswith("eval-repo-1234-ckpt-")
+    assert len(client.containers.created) == 1
+    container = client.containers.created[0]
+    assert container.committed == f"{expected}:latest" and container.deleted
+    assert container.config["Cmd"] == ["bash", "-c", setup_script]
+    assert get_checkpoint_image_name("eval-repo-1234", "abd", setup_script) != expected
+    # Protected until every run releases it
+    assert gc.protected[f"{expected}:latest"] == 3
+
+
+def test_failed_checkpoint_setup_is_not_committed(tmp_path, monkeypatch):
+    """Test that a failed checkout or install is not committed into a checkpoint, and that its protection is released."""
+    gc = ImageGarbageCollector(str(tmp_path / "usage.json"))
+    monkeypatch.setattr(checkpoints, "GLOBAL_IMAGE_GC", gc)
+    client = FakeDocker(status_code=1)
+    logger = logging.getLogger("test_checkpoints")
+    with pytest.raises(Exception, match="exited with code 1"):
+        asyncio.run(get_or_create_checkpoint(client, "eval-repo-1234", "abc", "setup", ["GIT_COMMIT=abc"], None, 60, logger))
+    assert client.containers.created[0].committed is None and client.containers.created[0].deleted
+    assert not gc.protected
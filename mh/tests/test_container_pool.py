@@ -0,0 +1,292 @@
+"""Tests for the warm container pool."""
+import asyncio
+import io
+import logging
+import re
+import subprocess
+import tarfile
+from types import SimpleNamespace
+
+import orjson
+
+from mindforge_harness import run_instance as run_instance_module
+from mindforge_harness.docker.container_pool import RESET_SCRIPT, ContainerPool
+from mindforge_harness.run_instance import run_in_pooled_container, run_instance_multi
+
+
+class FakeStream:
+    def __init__(self, output: bytes):
+        self.messages = [SimpleNamespace(data=output)]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def read_out(self):
+        return self.messages.pop() if self.messages else None
+
+
+class FakeExec:
+    def __init__(self, exit_code: int):
+        self.exit_code = exit_code
+
+    def start(self, detach: bool=False):
+        return FakeStream(b"ok\n")
+
+    async def inspect(self):
+        return {"ExitCode": self.exit_code}
+
+
+class FakeContainer:
+    def __init__(self, name: str, reset_exit_code: int=0):
+        self.id = name
+        self.running = True
+        self.deleted = False
+        self.commands = []
+        self.files = {}
+        self.reset_exit_code = reset_exit_code
+
+    async def start(self):
+        pass
+
+    async def exec(self, cmd, stdout=True, stderr=True, environment=None):
+        self.commands.append(cmd)
+        return FakeExec(self.reset_exit_code if cmd[-1] == RESET_SCRIPT else 0)
+
+    async def put_archive(self, path: str, data: bytes):
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            for member in tar.getmembers():
+                self.files[f"{path}{member.name}"] = tar.extractfile(member).read()
+
+    async def get_archive(self, path: str):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            if path == "/results":
+                tarinfo = tarfile.TarInfo("results")
+                tarinfo.type = tarfile.DIRTYPE
+                tar.addfile(tarinfo)
+            else:
+                # The prediction decides the outcome of the test
+                outcome = "passed" if self.files.get("/patches/patch_0.patch") == b"good" else "failed"
+                data = orjson.dumps({"tests": [{"nodeid": "test_a.py::test_a", "outcome": outcome}]})
+                tarinfo = tarfile.TarInfo(path.lstrip("/"))
+                tarinfo.size = len(data)
+                tar.addfile(tarinfo, io.BytesIO(data))
+        buffer.seek(0)
+        return tarfile.open(fileobj=buffer)
+
+    async def show(self):
+        return {"State": {"Running": self.running}}
+
+    async def delete(self, force: bool=False):
+        self.deleted = True
+
+
+class FakeContainers:
+    def __init__(self):
+        self.created = []
+
+    async def create_or_replace(self, name: str, config: dict):
+        self.created.append(FakeContainer(name, reset_exit_code=1 if len(self.created) == 1 else 0))
+        return self.created[-1]
+
+
+def test_container_pool_reuses_resets_and_replaces_containers():
+    """Test that containers are reset and reused, and replaced after max_reuse runs, a failed reset or a crash."""
+    client = SimpleNamespace(containers=FakeContainers())
+    pool = ContainerPool(client, max_reuse=2, max_idle=2)
+    logger = logging.getLogger("test_container_pool")
+
+    async def run():
+        first = await pool.acquire("eval-a", {"NetworkMode": "none"}, logger)
+        await first.put_files({"/eval.sh": "echo hi"})
+        assert await first.exec(["sh", "-c", "/eval.sh"]) == (0, "ok\n")
+        await pool.release(first, logger)
+        again = await pool.acquire("eval-a", {"NetworkMode": "none"}, logger)
+        assert again is first and again.uses == 2
+        await pool.release(again, logger)  # Used max_reuse times, so deleted
+        assert first.container.deleted
+
+        second = await pool.acquire("eval-a", {"NetworkMode": "none"}, logger)
+        await pool.release(second, logger)  # Its reset fails, so it is replaced
+        assert second.container.deleted
+
+        third = await pool.acquire("eval-a", {"NetworkMode": "none"}, logger)
+        other_config = await pool.acquire("eval-a", None, logger)
+        assert other_config is not third
+        await pool.release(third, logger)
+        third.container.running = False  # Crashed while idle
+        fourth = await pool.acquire("eval-a", {"NetworkMode": "none"}, logger)
+        assert fourth is not third and third.container.deleted
+        await pool.release(fourth, logger, reusable=False)
+        await pool.release(other_config, logger)
+        await pool.close(logger)
+        return first
+
+    first = asyncio.run(run())
+    assert first.container.files == {"/eval.sh": b"echo hi"}
+    assert ["sh", "-c", RESET_SCRIPT] in first.container.commands
+    assert all(container.deleted for container in client.containers.created)
+    report = pool.report()
+    assert report["created"] == 5 and report["reused"] == 1
+    assert report["reset_failures"] == 1 and report["discarded"] == 1
+
+
+def test_run_instance_multi_installs_once_and_resets_between_predictions(tmp_path, monkeypatch):
+    """Test that the predictions of an instance share one container, set up once and reset after each prediction."""
+    async def build_docker_image_from_specs(*args, **kwargs):
+        return "eval-repo"
+
+    monkeypatch.setattr(run_instance_module, "build_docker_image_from_specs", build_docker_image_from_specs)
+    client = SimpleNamespace(containers=FakeContainers())
+    results = asyncio.run(run_instance_multi(
+        client,
+        "owner/repo",
+        "owner__repo-1",
+        "abc",
+        [["good", "test patch"], ["bad", "test patch"], ["good", "test patch"]],
+        ["test_a.py::test_a"],
+        str(tmp_path),
+        {"test_cmd": "pytest", "install": "pip install -e .", "python": "3.11"},
+    ))
+    assert results == [{"test_a.py::test_a": True}, {"test_a.py::test_a": False}, {"test_a.py::test_a": True}]
+    assert len(client.containers.created) == 1
+    container = client.containers.created[0]
+    setups = [cmd for cmd in container.commands if cmd[:2] == ["bash", "-c"]]
+    assert len(setups) == 1 and "git checkout $GIT_COMMIT" in setups[0][-1]
+    runs = [i for i, cmd in enumerate(container.commands) if cmd[-1] == "chmod +x /eval.sh && /eval.sh"]
+    resets = [i for i, cmd in enumerate(container.commands) if cmd[-1] == RESET_SCRIPT]
+    assert len(runs) == 3 and len(resets) == 2 and runs[0] < resets[0] < runs[1] < resets[1] < runs[2]
+    assert container.deleted
+    assert (tmp_path / "evaluate_logs" / "owner__repo-1" / "run_2" / "results" / "pytest_report.json").exists()
+
+
+class ShellContainer(FakeContainer):
+    """Runs the commands of the pool in a local git repository standing for the image working directory."""
+
+    def __init__(self, name: str, root):
+        super().__init__(name)
+        self.root = root
+
+    async def exec(self, cmd, stdout=True, stderr=True, environment=None):
+        self.commands.append(cmd)
+        # The absolute paths of the scripts go under the root of the fake container
+        script = re.sub(r"(?<=[\s>])/(?=patches|results|eval\.sh|pass_report\.json|\.mf_pool)", f"{self.root}/", cmd[-1])
+        process = subprocess.run(["sh", "-c", script], cwd=self.root / "testbed", capture_output=True)
+        return FakeExec(process.returncode)
+
+
+def test_container_pool_reset_keeps_the_untracked_files_of_the_image(tmp_path):
+    """Test that a reset restores the working directory of a fresh container, keeping the files the image added."""
+    testbed = tmp_path / "testbed"
+    testbed.mkdir()
+    git = ["git", "-c", "user.name=t", "-c", "user.email=t@t"]
+    subprocess.run(git + ["init", "-q"], cwd=testbed, check=True)
+    (testbed / "module.py").write_text("x = 1\n")
+    subprocess.run(git + ["add", "module.py"], cwd=testbed, check=True)
+    subprocess.run(git + ["commit", "-qm", "init"], cwd=testbed, check=True)
+    # Untracked files copied in by the Dockerfile, and the environment of the install
+    (testbed / "run_tests.sh").write_text("pytest\n")
+    (testbed / ".venv" / "bin").mkdir(parents=True)
+    (testbed / ".venv" / "bin" / "python").write_text("")
+    # The repository installed in place, with its commit in its version
+    (testbed / "repo.egg-info").mkdir()
+    (testbed / "repo.egg-info" / "PKG-INFO").write_text("Metadata-Version: 2.1\nName: repo\nVersion: 1.0+gabc\n")
+
+    container = ShellContainer("pooled", tmp_path)
+    client = SimpleNamespace(containers=SimpleNamespace(create_or_replace=lambda name, config: asyncio.sleep(0, container)))
+    pool = ContainerPool(client, max_reuse=3, max_idle=1)
+    logger = logging.getLogger("test_container_pool")
+
+    async def run():
+        session = await pool.acquire("eval-a", None, logger)
+        # A run modifies the repository and leaves files behind
+        (testbed / "module.py").write_text("x = 2\n")
+        (testbed / "new_file.py").write_text("")
+        (testbed / "build").mkdir()
+        # and reinstalls the repository at another commit, which is not a change of the packages
+        (testbed / "repo.egg-info" / "PKG-INFO").write_text("Metadata-Version: 2.1\nName: repo\nVersion: 1.0+gdef\n")
+        await pool.release(session, logger)
+        assert pool.idle[session.key] == [session]
+
+        session = await pool.acquire("eval-a", None, logger)
+        # The packages of the snapshot changed, e.g. a run installed a package
+        (tmp_path / ".mf_pool" / "packages.txt").write_text("other packages\n")
+        await pool.release(session, logger)
+
+    asyncio.run(run())
+    assert (testbed / "module.py").read_text() == "x = 1\n"
+    assert not (testbed / "new_file.py").exists() and not (testbed / "build").exists()
+    assert (testbed / "run_tests.sh").exists() and (testbed / ".venv" / "bin" / "python").exists()
+    assert pool.stats["reset_failures"] == 1 and container.deleted
+
+
+class SlowStream(FakeStream):
+    def __init__(self, output: bytes, seconds: float):
+        super().__init__(output)
+        self.seconds = seconds
+
+    async def read_out(self):
+        if self.messages:
+            await asyncio.sleep(self.seconds)
+        return await super().read_out()
+
+
+class SlowContainer(FakeContainer):
+    """A container whose setup and evaluation scripts take some time."""
+
+    async def exec(self, cmd, stdout=True, stderr=True, environment=None):
+        self.commands.append(cmd)
+        execution = FakeExec(0)
+        if cmd[:2] == ["bash", "-c"] or cmd[-1] == "chmod +x /eval.sh && /eval.sh":
+            execution.start = lambda detach=False: SlowStream(b"ok\n", 0.3)
+        return execution
+
+
+def test_run_in_pooled_container_counts_the_setup_against_the_timeout(tmp_path):
+    """Test that the setup of a container and the run it precedes share the timeout of the run."""
+    container = SlowContainer("pooled")
+    client = SimpleNamespace(containers=SimpleNamespace(create_or_replace=lambda name, config: asyncio.sleep(0, container)))
+    pool = ContainerPool(client, max_reuse=2, max_idle=1)
+    logger = logging.getLogger("test_container_pool")
+
+    async def run():
+        try:
+            await run_in_pooled_container(pool, "eval-a", None, {"/eval.sh": ""}, [], str(tmp_path), 0.5, logger, setup_script="install")
+        except TimeoutError:
+            return True
+        return False
+
+    assert asyncio.run(run())
+    assert container.deleted
+    # The phases of the run show where it stalled
+    assert (tmp_path / "results" / "phases.txt").exists()
+
+
+def test_run_instance_multi_fails_every_run_when_the_setup_fails(tmp_path, monkeypatch):
+    """Test that a failed checkout or install is reported for every prediction instead of being shared by their runs."""
+    async def build_docker_image_from_specs(*args, **kwargs):
+        return "eval-repo"
+
+    class FailingSetupContainer(FakeContainer):
+        async def exec(self, cmd, stdout=True, stderr=True, environment=None):
+            self.commands.append(cmd)
+            return FakeExec(1 if cmd[:2] == ["bash", "-c"] else 0)
+
+    containers = []
+
+    async def create_or_replace(name: str, config: dict):
+        containers.append(FailingSetupContainer(name))
+        return containers[-1]
+
+    monkeypatch.setattr(run_instance_module, "build_docker_image_from_specs", build_docker_image_from_specs)
+    client = SimpleNamespace(containers=SimpleNamespace(create_or_replace=create_or_replace))
+    results = asyncio.run(run_instance_multi(
+        client, "owner/repo", "owner__repo-1", "abc", [["good"], ["bad"], ["good"]], ["test_a.py::test_a"],
+        str(tmp_path), {"test_cmd": "pytest", "install": "pip install -e .", "python": "3.11"},
+    ))
+    assert [result["error"] for result in results] == ["Setup of the container failed with exit code 1."] * 3
+    assert len(containers) == 1 and containers[0].deleted
+    assert not any(cmd[-1] == "chmod +x /eval.sh && /eval.sh" for cmd in containers[0].commands)
@@ -0,0 +1,112 @@
+"""Tests for the build context cache."""
+import asyncio
+import io
+import os
+import subprocess
+import tarfile
+
+import git
+
+from mindforge_harness.docker.context_cache import BuildContextCache
+from mindforge_harness.docker.repo_cache import RepoCache
+
+
+def make_build_dirs(tmp_path, dockerfile: str):
+    """Create a build directory and a small repository."""
+    build_dir = tmp_path / "build"
+    build_dir.mkdir(exist_ok=True)
+    (build_dir / "Dockerfile").write_text(dockerfile)
+    repo = tmp_path / "owner__repo"
+    if not repo.exists():
+        (repo / "src").mkdir(parents=True)
+        (repo / "src" / "main.py").write_text("print('hello')\n")
+    return str(build_dir), str(repo)
+
+
+def read_context(stream) -> dict[str, bytes]:
+    """Read a build context stream back into a dict of file contents."""
+    with tarfile.open(fileobj=io.BytesIO(stream.read()), mode="r:gz") as tar:
+        return {m.name: tar.extractfile(m).read() for m in tar.getmembers() if m.isfile()}
+
+
+def test_context_cache_reuses_repo_tarball(tmp_path):
+    """Test that specs of the same repository reuse the cached repository tarball."""
+    cache = BuildContextCache(str(tmp_path / "cache"), max_size=1024 ** 3)
+
+    async def run():
+        build_dir, repo = make_build_dirs(tmp_path, "FROM a\n")
+        first = read_context(await cache.create_tarball(build_dir, repo))
+        build_dir, repo = make_build_dirs(tmp_path, "FROM b\n")  # Only the spec changed
+        second = read_context(await cache.create_tarball(build_dir, repo))
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == {"Dockerfile": b"FROM a\n", "owner__repo/src/main.py": b"print('hello')\n"}
+    assert second["Dockerfile"] == b"FROM b\n"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_context_cache_eviction(tmp_path):
+    """Test that the least recently used entries are evicted when the cache is too large."""
+    cache = BuildContextCache(str(tmp_path / "cache"), max_size=1)
+
+    async def run():
+        build_dir, repo = make_build_dirs(tmp_path, "FROM a\n")
+        await cache.get_repo_entry(repo, [])
+        (tmp_path / "owner__repo" / "src" / "new.py").write_text("x = 1\n")  # The file set changed
+        return await cache.get_repo_entry(repo, [])
+
+    entry = asyncio.run(run())
+    assert cache.misses == 2
+    assert os.listdir(cache.cache_dir) == [os.path.basename(entry)]
+
+
+def test_context_key_of_a_git_repository_follows_its_status(tmp_path):
+    """Test that the key of a git repository changes with its changed, untracked and ignored files, but not with the excluded ones."""
+    cache = BuildContextCache(str(tmp_path / "cache"), max_size=1024 ** 3)
+    _, repo = make_build_dirs(tmp_path, "FROM a\n")
+    (tmp_path / "owner__repo" / ".gitignore").write_text("build/\n")
+    git = ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", "-C", repo]
+    subprocess.run([*git, "init", "-q"], check=True)
+    subprocess.run([*git, "add", "."], check=True)
+    subprocess.run([*git, "commit", "-q", "-m", "init"], check=True)
+    patterns = ["**/__pycache__"]
+
+    keys = [cache.context_key(repo, patterns)]
+    (tmp_path / "owner__repo" / "src" / "__pycache__").mkdir()
+    (tmp_path / "owner__repo" / "src" / "__pycache__" / "main.pyc").write_bytes(b"\0")  # Excluded from the context
+    assert cache.context_key(repo, patterns) == keys[-1]
+    for change in [
+        lambda: (tmp_path / "owner__repo" / "src" / "main.py").write_text("print('bye')\n"),
+        lambda: (tmp_path / "owner__repo" / "src" / "main.py").write_text("print('bye!')\n"),  # Changed again
+        lambda: (tmp_path / "owner__repo" / "src" / "new.py").write_text("x = 1\n"),
+        lambda: (tmp_path / "owner__repo" / "build").mkdir() or (tmp_path / "owner__repo" / "build" / "out.txt").write_text("x"),
+        lambda: (tmp_path / "owner__repo" / ".gitignore").unlink(),
+        lambda: subprocess.run([*git, "tag", "v1"], check=True),
+    ]:
+        change()
+        keys.append(cache.context_key(repo, patterns))
+    assert len(set(keys)) == len(keys)
+
+
+def test_context_cache_checks_out_snapshots_only_on_a_miss(tmp_path):
+    """Test that a snapshot whose revision is cached is not checked out, and that its `.dockerignore` is applied."""
+    upstream = git.Repo.init(tmp_path / "remote" / "owner" / "repo")
+    for name, content in [("main.py", "print('hello')\n"), ("notes.txt", "x\n"), (".dockerignore", "*.txt\n")]:
+        (tmp_path / "remote" / "owner" / "repo" / name).write_text(content)
+        upstream.index.add([name])
+    upstream.index.commit("Initial commit")
+    repo_cache = RepoCache(str(tmp_path / "repos"), f"file://{tmp_path / 'remote'}/{{repo}}")
+    cache = BuildContextCache(str(tmp_path / "cache"), max_size=1024 ** 3)
+    build_dir, _ = make_build_dirs(tmp_path, "FROM a\n")
+
+    async def build_context():
+        async with repo_cache.snapshot("owner/repo", depth=1) as snapshot:
+            return read_context(await cache.create_snapshot_tarball(build_dir, snapshot))
+
+    first = asyncio.run(build_context())
+    second = asyncio.run(build_context())
+    assert first == second
+    assert "owner__repo/main.py" in first and "owner__repo/notes.txt" not in first
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert repo_cache.stats["snapshots"] == 1
@@ -0,0 +1,134 @@
+"""Tests for the Docker helpers in mindforge_harness.docker.docker_utils."""
+import asyncio
+import logging
+
+from aiodocker import DockerError
+
+from mindforge_harness.docker.docker_utils import (
+    ImageIndex,
+    get_image_index,
+    is_image_not_found,
+    normalize_image_tag,
+    pull_img_from_registry,
+    pull_stats,
+)
+
+
+class FakeImages:
+    """Minimal stand-in for `aiodocker.Docker.images`."""
+
+    def __init__(self, tags: list[str]):
+        self.tags = tags
+        self.list_calls = 0
+        self.inspect_calls = 0
+
+    async def list(self):
+        self.list_calls += 1
+        return [{'RepoTags': [tag]} for tag in self.tags] + [{'RepoTags': None}]
+
+    async def inspect(self, name: str):
+        self.inspect_calls += 1
+        if name not in self.tags:
+            raise DockerError(404, f"No such image: {name}")
+        return {'RepoTags': [name]}
+
+
+class FakeDocker:
+    """Minimal stand-in for `aiodocker.Docker`."""
+
+    def __init__(self, tags: list[str], docker_host: str="unix:///fake.sock"):
+        self.images = FakeImages(tags)
+        self.docker_host = docker_host
+
+
+def test_normalize_image_tag():
+    """Test that untagged references get the implicit latest tag."""
+    assert normalize_image_tag("eval-foo-1234") == "eval-foo-1234:latest"
+    assert normalize_image_tag("eval-foo-1234:v1") == "eval-foo-1234:v1"
+    assert normalize_image_tag("10.0.0.1:5000/eval-foo-1234") == "10.0.0.1:5000/eval-foo-1234:latest"
+
+
+def test_image_index_exact_match():
+    """Test that the index only matches exact tags and lists the daemon once."""
+    client = FakeDocker(["eval-foo-12345678:latest"])
+    index = ImageIndex()
+
+    async def run():
+        assert await index.lookup(client, "eval-foo-12345678") == "eval-foo-12345678:latest"
+        assert await index.lookup(client, "eval-foo-1234") is None
+        assert await index.lookup(client, "eval-foo-12345678") == "eval-foo-12345678:latest"
+
+    asyncio.run(run())
+    assert client.images.list_calls == 1
+    assert client.images.inspect_calls == 1  # Only the miss goes to the daemon
+
+
+def test_image_index_events():
+    """Test that builds made outside the index are found and harness events are tracked."""
+    client = FakeDocker([])
+    index = ImageIndex()
+
+    async def run():
+        assert await index.lookup(client, "eval-bar-1") is None
+        client.images.tags.append("eval-bar-1:latest")  # Built by someone else
+        assert await index.lookup(client, "eval-bar-1") == "eval-bar-1:latest"
+        index.discard("eval-bar-1")
+        client.images.tags.clear()
+        assert await index.lookup(client, "eval-bar-1") is None
+        index.add("eval-bar-2")
+        assert await index.lookup(client, "eval-bar-2") == "eval-bar-2:latest"
+
+    asyncio.run(run())
+
+
+def test_get_image_index_per_daemon():
+    """Test that clients of the same daemon share one index."""
+    assert get_image_index(FakeDocker([], "tcp://a:2375")) is get_image_index(FakeDocker([], "tcp://a:2375"))
+    assert get_image_index(FakeDocker([], "tcp://a:2375")) is not get_image_index(FakeDocker([], "tcp://b:2375"))
+
+
+class FakeRegistryImages(FakeImages):
+    """Images of a daemon pulling from a registry holding `registry_tags`."""
+
+    def __init__(self, registry_tags: list[str]):
+        super().__init__([])
+        self.registry_tags = registry_tags
+        self.pull_calls = 0
+
+    async def pull(self, name: str, auth: dict):
+        self.pull_calls += 1
+        await asyncio.sleep(0.01)
+        if name not in self.registry_tags:
+            raise DockerError(404, f"manifest for {name} not found: manifest unknown")
+        self.tags.append(name)
+        return [{'status': 'Pull complete'}]
+
+    async def tag(self, name: str, new_name: str):
+        self.tags.append(normalize_image_tag(new_name))
+
+    async def inspect(self, name: str):
+        return {'RepoTags': [name], 'Size': 1024 ** 2}
+
+    async def delete(self, name: str, force: bool):
+        self.tags.remove(name)
+
+
+def test_pull_img_from_registry_shares_concurrent_pulls():
+    """Test that concurrent pulls of an image share one pull and that missing images are told apart."""
+    client = FakeDocker([], "tcp://registry-test:2375")
+    client.images = FakeRegistryImages(["registry:5000/eval-foo-1"])
+    config = {'registry_url': 'registry:5000', 'registry_user': 'user', 'registry_pass': 'pass'}
+    logger = logging.getLogger("test_docker_utils")
+
+    async def run():
+        names = await asyncio.gather(*(pull_img_from_registry(client, "eval-foo-1", config, logger) for _ in range(3)))
+        try:
+            await pull_img_from_registry(client, "eval-foo-2", config, logger)
+        except DockerError as e:
+            return names, e
+
+    names, error = asyncio.run(run())
+    assert names == ["eval-foo-1"] * 3
+    assert client.images.pull_calls == 2
+    assert is_image_not_found(error) and not is_image_not_found(DockerError(500, "connection reset by peer"))
+    assert pull_stats["eval-foo-1"]["size"] == 1024 ** 2
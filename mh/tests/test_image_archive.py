@@ -0,0 +1,87 @@
+"""Tests for the offline image archive."""
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import tarfile
+
+from mindforge_harness.docker.image_archive import ImageArchive
+
+
+def make_save(layers: dict[str, bytes], image_name: str) -> bytes:
+    """Create a small `docker save` like OCI tarball of an image made of layers."""
+    files = {f"blobs/sha256/{hashlib.sha256(data).hexdigest()}": data for data in layers.values()}
+    files["manifest.json"] = f'[{{"RepoTags": ["{image_name}"]}}]'.encode()
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w") as tar:
+        directory = tarfile.TarInfo("blobs/sha256")
+        directory.type = tarfile.DIRTYPE
+        tar.addfile(directory)
+        for name, data in files.items():
+            tarinfo = tarfile.TarInfo(name)
+            tarinfo.size = len(data)
+            tar.addfile(tarinfo, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+class FakeExport:
+    def __init__(self, data: bytes):
+        self.data = data
+
+    async def __aenter__(self):
+        stream = asyncio.StreamReader()
+        stream.feed_data(self.data)
+        stream.feed_eof()
+        return stream
+
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeImages:
+    def __init__(self, saves: dict[str, bytes]):
+        self.saves = saves
+        self.loaded = []
+
+    def export_image(self, name: str):
+        return FakeExport(self.saves[name])
+
+    async def import_image(self, data):
+        self.loaded.append(data.read())
+        return [{'stream': 'Loaded image'}]
+
+
+class FakeDocker:
+    docker_host = "unix://archive-test"
+
+    def __init__(self, saves: dict[str, bytes]):
+        self.images = FakeImages(saves)
+
+
+def test_image_archive_dedups_shared_layers(tmp_path):
+    """Test that layers shared by images are stored once and that images load back with the same files."""
+    base = os.urandom(4096)
+    saves = {
+        "eval-a:latest": make_save({"base": base, "spec": b"spec a" * 100}, "eval-a:latest"),
+        "eval-b:latest": make_save({"base": base, "spec": b"spec b" * 100}, "eval-b:latest"),
+    }
+    client = FakeDocker(saves)
+    archive = ImageArchive(str(tmp_path / "archive"))
+    logger = logging.getLogger("test_image_archive")
+
+    async def run():
+        stats = [await archive.export_image(client, name, logger) for name in ["eval-a", "eval-b"]]
+        await archive.import_image(client, "eval-b", logger)
+        return stats
+
+    stats = asyncio.run(run())
+    assert [s["new_blobs"] for s in stats] == [3, 2]  # The base layer is stored once
+    assert len(os.listdir(archive.blobs_dir)) == 5
+    assert archive.images() == ["eval-a:latest", "eval-b:latest"]
+
+    def read_files(data: bytes) -> dict[str, bytes]:
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            return {m.name: tar.extractfile(m).read() if m.isreg() else m.type for m in tar.getmembers()}
+
+    assert read_files(client.images.loaded[0]) == read_files(saves["eval-b:latest"])
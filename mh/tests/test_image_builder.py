@@ -0,0 +1,210 @@
+"""Tests for the image builder."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiodocker.exceptions import DockerError, DockerStreamError
+
+from mindforge_harness.docker import image_builder
+from mindforge_harness.docker.build_failures import BuildFailureCache
+from mindforge_harness.docker.image_builder import (
+    BuildScheduler,
+    build_base_image,
+    format_base_dockerfile,
+    format_dockerfile,
+    get_base_image_name,
+    get_image_name,
+    run_docker_build,
+)
+from mindforge_harness.utils import consistent_hash
+
+
+def test_build_scheduler_dedup_and_concurrency(monkeypatch):
+    """Test that each distinct image is built once, with at most max_build_workers builds at a time."""
+    calls = []
+    running = 0
+    max_running = 0
+
+    async def fake_build(client, repo_name, spec_dict, docker_work_dir, **kwargs):
+        nonlocal running, max_running
+        calls.append(get_image_name(repo_name, spec_dict))
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        if spec_dict['python'] == 'broken':
+            raise Exception("Build failed")
+        return get_image_name(repo_name, spec_dict)
+
+    async def fake_lookup(client, image_name):
+        return None
+
+    monkeypatch.setattr(image_builder, "build_docker_image_from_specs", fake_build)
+    monkeypatch.setattr(image_builder, "get_from_existing_image", fake_lookup)
+
+    instances = [
+        {'repo': 'encode/httpx', 'spec_dict': {'python': f'3.{i % 5}', 'pip_packages': []}}
+        for i in range(20)
+    ] + [{'repo': 'encode/httpx', 'spec_dict': {'python': 'broken', 'pip_packages': []}}]
+
+    async def run():
+        scheduler = BuildScheduler(None, "logs/build_logs", max_build_workers=2)
+        errors = await scheduler.build_all(instances)
+        name = await scheduler.get('encode/httpx', {'python': '3.1', 'pip_packages': []})
+        return scheduler, errors, name
+
+    scheduler, errors, name = asyncio.run(run())
+    assert len(calls) == len(set(calls)) == 6
+    assert max_running == 2
+    assert list(errors) == [get_image_name('encode/httpx', {'python': 'broken', 'pip_packages': []})]
+    assert name == get_image_name('encode/httpx', {'python': '3.1', 'pip_packages': []})
+    summary = scheduler.summary()
+    assert summary['images'] == 6 and summary['failed'] == 1 and summary['queue_depth'] == 0
+    assert len(summary['build_times']) == 6
+
+
+def test_build_scheduler_plan_existing_images_skip_build_slots(monkeypatch):
+    """Test that planning reports existing images and that they do not wait behind running builds."""
+    existing = get_image_name('encode/httpx', {'python': '3.9'})
+    finished = []
+
+    async def fake_build(client, repo_name, spec_dict, docker_work_dir, **kwargs):
+        await asyncio.sleep(0.05)
+        finished.append(spec_dict['python'])
+        return get_image_name(repo_name, spec_dict)
+
+    async def fake_lookup(client, image_name):
+        return f"{image_name}:latest" if image_name == existing else None
+
+    monkeypatch.setattr(image_builder, "build_docker_image_from_specs", fake_build)
+    monkeypatch.setattr(image_builder, "get_from_existing_image", fake_lookup)
+
+    async def run():
+        scheduler = BuildScheduler(None, "logs/build_logs", max_build_workers=1)
+        plan = await scheduler.plan([
+            {'repo': 'encode/httpx', 'spec_dict': {'python': '3.10'}},
+            {'repo': 'encode/httpx', 'spec_dict': {'python': '3.9'}},
+            {'repo': 'encode/httpx', 'spec_dict': {'python': '3.9'}},
+            {'repo': 'encode/httpx', 'spec_dict': None},
+        ])
+        assert await scheduler.get('encode/httpx', {'python': '3.9'}) == existing
+        assert finished == []  # Ready while the other image is still building
+        await scheduler.get('encode/httpx', {'python': '3.10'})
+        return plan
+
+    assert asyncio.run(run()) == {"images": 2, "existing": 1, "in_registry": 0, "known_failed": 0}
+
+
+def test_spec_dockerfile_builds_from_shared_base():
+    """Test that spec Dockerfiles only add the spec layers on top of the shared base image."""
+    spec_dict = {'python': '3.9', 'pip_packages': ['pytest'], 'pre_install': ['apt-get install -y gcc']}
+    base_image = get_base_image_name(spec_dict['python'])
+    dockerfile = format_dockerfile("encode__httpx", spec_dict['python'], spec_dict['pip_packages'], None, spec_dict['pre_install'])
+
+    assert dockerfile.strip().startswith(f"FROM {base_image}")
+    assert "apt-get upgrade" not in dockerfile
+    assert "apt-get upgrade" in format_base_dockerfile(spec_dict['python'])
+    assert spec_dict['pre_install'] == ['apt-get install -y gcc']  # The spec is left untouched
+    assert base_image == get_base_image_name('python3.9')
+    assert base_image != get_base_image_name('3.9', green_zone=True)
+
+
+def test_base_image_name_only_holds_the_python_version_the_template_uses():
+    """Test that the r2e base, which does not depend on the python version, is one image for every version."""
+    assert get_base_image_name('3.9', template="r2e") == get_base_image_name('3.12', template="r2e")
+    assert "-py" not in get_base_image_name('3.9', template="r2e")
+    assert "-py3.9-" in get_base_image_name('3.9', template="slim")
+    assert get_base_image_name('3.9', template="slim") != get_base_image_name('3.12', template="slim")
+
+
+def test_build_scheduler_skips_known_failed_builds(monkeypatch, tmp_path):
+    """Test that persisted build failures fail right away, until they expire or a retry is forced."""
+    spec_dict = {'python': '3.9', 'pip_packages': ['broken']}
+    image_name = get_image_name('encode/httpx', spec_dict)
+    calls = []
+
+    async def fake_build(client, repo_name, spec_dict, docker_work_dir, **kwargs):
+        calls.append(repo_name)
+        return get_image_name(repo_name, spec_dict)
+
+    async def fake_lookup(client, image_name):
+        return None
+
+    failures = BuildFailureCache(str(tmp_path / "build_failures.json"), ttl=3600)
+    failures.record(image_name, consistent_hash(spec_dict), "pip install failed")
+    failures.record(get_image_name('encode/httpx', {'python': '3.10'}), "another spec", "pip install failed")
+    monkeypatch.setattr(image_builder, "build_docker_image_from_specs", fake_build)
+    monkeypatch.setattr(image_builder, "get_from_existing_image", fake_lookup)
+    monkeypatch.setattr(image_builder, "GLOBAL_BUILD_FAILURES", BuildFailureCache(failures.path, ttl=3600))
+
+    async def run():
+        scheduler = BuildScheduler(None, "logs/build_logs")
+        plan = await scheduler.plan([
+            {'repo': 'encode/httpx', 'spec_dict': spec_dict},
+            {'repo': 'encode/httpx', 'spec_dict': {'python': '3.10'}},  # The failure was for another spec
+        ])
+        errors = await scheduler.build_all([])
+        image_builder.GLOBAL_BUILD_FAILURES.retry = True
+        retried = await BuildScheduler(None, "logs/build_logs").get('encode/httpx', spec_dict)
+        return plan, errors, retried
+
+    plan, errors, retried = asyncio.run(run())
+    assert plan == {"images": 2, "existing": 0, "in_registry": 0, "known_failed": 1}
+    assert "pip install failed" in str(errors[image_name])
+    assert retried == image_name and len(calls) == 2
+
+
+def test_build_failures_of_concurrent_runs_are_merged(tmp_path):
+    """Test that runs sharing the failure file keep each other's entries instead of overwriting them."""
+    first = BuildFailureCache(str(tmp_path / "build_failures.json"), ttl=3600)
+    second = BuildFailureCache(first.path, ttl=3600)
+    first.record("eval-a", "hash-a", "pip install failed")
+    second.load()
+    first.record("eval-b", "hash-b", "pip install failed")
+    second.record("eval-c", "hash-c", "pip install failed")
+    second.clear("eval-a")
+    assert sorted(BuildFailureCache(first.path).load()) == ["eval-b", "eval-c"]
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_run_docker_build_records_the_errors_of_the_build(monkeypatch, tmp_path):
+    """Test that an error raised from the build stream is recorded as a failure, and a daemon error is not."""
+    failures = BuildFailureCache(str(tmp_path / "build_failures.json"), ttl=3600)
+    monkeypatch.setattr(image_builder, "GLOBAL_BUILD_FAILURES", failures)
+
+    def fake_client(error: Exception):
+        async def build(**kwargs):
+            yield {"stream": "Step 1/2 : FROM eval-base\n"}
+            raise error
+        return SimpleNamespace(images=SimpleNamespace(build=build))
+
+    with pytest.raises(Exception, match="RUN failed: exit code 1"):
+        asyncio.run(run_docker_build(fake_client(DockerStreamError("RUN failed: exit code 1")), None, "eval-a", str(tmp_path), "hash-a"))
+    assert failures.get("eval-a", "hash-a")["error"] == "RUN failed: exit code 1"
+
+    with pytest.raises(DockerError):
+        asyncio.run(run_docker_build(fake_client(DockerError(900, "Cannot connect to the Docker daemon")), None, "eval-b", str(tmp_path), "hash-b"))
+    assert failures.get("eval-b", "hash-b") is None
+
+
+def test_force_rebuild_rebuilds_each_base_image_once(monkeypatch, tmp_path):
+    """Test that a forced build also rebuilds the shared base image, but only for the first spec image using it."""
+    builds = []
+
+    async def fake_run_docker_build(client, tar_stream, image_name, build_dir, spec_hash=""):
+        builds.append(image_name)
+
+    async def fake_lookup(client, image_name):
+        return {"Id": image_name}
+
+    monkeypatch.setattr(image_builder, "run_docker_build", fake_run_docker_build)
+    monkeypatch.setattr(image_builder, "get_from_existing_image", fake_lookup)
+    monkeypatch.setattr(image_builder, "rebuilt_base_images", set())
+
+    async def run():
+        await build_base_image(None, "3.9", str(tmp_path))
+        await build_base_image(None, "3.9", str(tmp_path), force_rebuild=True)
+        await build_base_image(None, "3.9", str(tmp_path), force_rebuild=True)
+
+    asyncio.run(run())
+    assert builds == [get_base_image_name("3.9")]
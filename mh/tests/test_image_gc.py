@@ -0,0 +1,91 @@
+"""Tests for the image garbage collector."""
+import asyncio
+import logging
+
+from aiodocker.exceptions import DockerError
+
+from mindforge_harness.docker.image_gc import ImageGarbageCollector
+
+
+class FakeImages:
+    """Images of a fake daemon, sized in bytes."""
+
+    def __init__(self, images: dict[str, int], in_use: set[str]=(), aliases: dict[str, str]=None):
+        self.images = dict(images)
+        self.in_use = set(in_use)
+        self.aliases = aliases or {}  # Tags of the same image as another tag
+
+    async def list(self, filters=None, **params):
+        images = {}
+        for tag, size in self.images.items():
+            image_id = self.aliases.get(tag, tag)
+            images.setdefault(image_id, {
+                "Id": image_id, "RepoTags": [], "Size": size + 100,
+                "SharedSize": 0 if tag.startswith("eval-base-") else 100, "Created": 0,
+            })["RepoTags"].append(tag)
+        return list(images.values())
+
+    async def delete(self, name: str):
+        if name in self.in_use:
+            raise DockerError(409, {"message": "image is being used by a stopped container"})
+        del self.images[name]
+
+
+class FakeDocker:
+    docker_host = "unix://gc-test"
+
+    def __init__(self, images: FakeImages):
+        self.images = images
+
+
+def test_image_gc_evicts_least_recently_used(tmp_path):
+    """Test that unprotected images are evicted in LRU order, keeping the base image while it is needed."""
+    usage_file = str(tmp_path / "image_usage.json")
+    gc = ImageGarbageCollector(usage_file, disk_budget=250)
+    for i, tag in enumerate(["eval-a:latest", "eval-b:latest", "eval-c:latest", "eval-d:latest"]):
+        gc.touch(tag)
+        gc.last_used[tag] = i
+    gc.protect("eval-a")
+    images = FakeImages(
+        {"eval-base-x:latest": 100, "eval-a:latest": 100, "eval-b:latest": 100, "eval-c:latest": 100, "eval-d:latest": 100},
+        in_use={"eval-b:latest"},
+    )
+
+    evicted = asyncio.run(gc.collect(FakeDocker(images), logging.getLogger("test_image_gc")))
+    assert evicted == ["eval-c:latest", "eval-d:latest"]
+    assert "eval-base-x:latest" in images.images
+
+    # The order is persisted, and the base image goes once nothing needs it
+    gc.release("eval-a")
+    gc = ImageGarbageCollector(usage_file, disk_budget=150)
+    evicted = asyncio.run(gc.collect(FakeDocker(images), logging.getLogger("test_image_gc")))
+    assert evicted == ["eval-a:latest", "eval-base-x:latest"]
+    assert set(images.images) == {"eval-b:latest"}
+
+
+def test_image_gc_keeps_protected_checkpoints(tmp_path):
+    """Test that checkpoints go first in LRU order, except the ones a queued or running instance uses."""
+    gc = ImageGarbageCollector(str(tmp_path / "image_usage.json"), disk_budget=250)
+    for i, tag in enumerate(["eval-a:latest", "eval-a-ckpt-new:latest", "eval-a-ckpt-old:latest", "eval-a-ckpt-used:latest"]):
+        gc.touch(tag)
+        gc.last_used[tag] = {"eval-a-ckpt-old:latest": -1}.get(tag, i)
+    gc.protect("eval-a-ckpt-used")
+    images = FakeImages({"eval-a:latest": 100, "eval-a-ckpt-new:latest": 100, "eval-a-ckpt-old:latest": 100, "eval-a-ckpt-used:latest": 100})
+
+    evicted = asyncio.run(gc.collect(FakeDocker(images), logging.getLogger("test_image_gc")))
+    assert evicted == ["eval-a-ckpt-old:latest", "eval-a-ckpt-new:latest"]
+
+
+def test_image_gc_counts_an_image_with_several_tags_once(tmp_path):
+    """Test that the tags of one image count its size once, and free it once the last of them is removed."""
+    gc = ImageGarbageCollector(str(tmp_path / "image_usage.json"), disk_budget=250)
+    for i, tag in enumerate(["eval-a-alias:latest", "eval-a:latest", "eval-b:latest"]):
+        gc.touch(tag)
+        gc.last_used[tag] = i
+    images = FakeImages({"eval-a:latest": 100, "eval-a-alias:latest": 100, "eval-b:latest": 100}, aliases={"eval-a-alias:latest": "eval-a:latest"})
+
+    assert asyncio.run(gc.collect(FakeDocker(images), logging.getLogger("test_image_gc"))) == []
+    gc.disk_budget = 150
+    evicted = asyncio.run(gc.collect(FakeDocker(images), logging.getLogger("test_image_gc")))
+    assert evicted == ["eval-a-alias:latest", "eval-a:latest"]
+    assert set(images.images) == {"eval-b:latest"}
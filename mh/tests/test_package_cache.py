@@ -0,0 +1,102 @@
+"""Tests for the wheelhouse package cache."""
+import asyncio
+import logging
+import os
+
+import pytest
+
+from mindforge_harness.docker.package_cache import PackageCache
+
+
+class FakeContainer:
+    """Container that pretends to run `pip download` into the bound wheelhouse."""
+
+    def __init__(self, config: dict):
+        self.wheelhouse = config["HostConfig"]["Binds"][0].split(":")[0]
+        assert config["Cmd"][:3] == ["uvx", "--python", "3.11"]  # pip is not in every base image
+        self.packages = config["Cmd"][config["Cmd"].index("/wheelhouse") + 1:]
+
+    async def start(self):
+        self.lines = []
+        for package in self.packages:
+            path = os.path.join(self.wheelhouse, f"{package}-1.0-py3-none-any.whl")
+            if os.path.exists(path):
+                self.lines.append(f"File was already downloaded /wheelhouse/{os.path.basename(path)}")
+            else:
+                with open(path, "wb") as f:
+                    f.write(b"wheel")
+                self.lines.append(f"Saved /wheelhouse/{os.path.basename(path)}")
+
+    async def wait(self):
+        return {"StatusCode": 0}
+
+    async def log(self, stdout: bool, stderr: bool):
+        return self.lines
+
+    async def delete(self, force: bool):
+        pass
+
+
+class FakeContainers:
+    async def create_or_replace(self, name: str, config: dict):
+        return FakeContainer(config)
+
+
+class FakeDocker:
+    containers = FakeContainers()
+
+
+def test_package_cache_reuses_wheels(tmp_path):
+    """Test that wheels are downloaded once and linked into later builds, also offline, and that offline misses fail."""
+    cache = PackageCache(str(tmp_path / "wheelhouse"), max_size=1024 ** 3, enabled=True)
+    logger = logging.getLogger("test_package_cache")
+    build_dir = tmp_path / "build"
+
+    async def run():
+        layers = [
+            await cache.prepare_build_dir(FakeDocker(), "eval-base", "3.11", ["numpy", "pytest"], str(build_dir), logger),
+            await cache.prepare_build_dir(FakeDocker(), "eval-base", "3.11", ["pytest", "httpx"], str(build_dir), logger),
+        ]
+        cache.offline = True
+        layers.append(await cache.prepare_build_dir(FakeDocker(), "eval-base", "3.11", ["numpy", "pytest"], str(build_dir), logger))
+        with pytest.raises(Exception, match="Offline build"):
+            await cache.prepare_build_dir(FakeDocker(), "eval-base", "3.11", ["django"], str(build_dir), logger)
+        # The wheels of another python version are not reused
+        with pytest.raises(Exception, match="Offline build"):
+            await cache.prepare_build_dir(FakeDocker(), "eval-base", "3.12", ["numpy", "pytest"], str(build_dir), logger)
+        return layers
+
+    layers = asyncio.run(run())
+    assert (cache.misses, cache.hits) == (3, 3)
+    assert "UV_OFFLINE=false" in layers[0] and "UV_OFFLINE=true" in layers[2]
+    assert sorted(os.listdir(build_dir / "wheelhouse")) == ["numpy-1.0-py3-none-any.whl", "pytest-1.0-py3-none-any.whl"]
+
+
+def test_package_cache_eviction(tmp_path):
+    """Test that the least recently used wheels are evicted first."""
+    cache = PackageCache(str(tmp_path), max_size=10)
+    for i, name in enumerate(["old.whl", "new.whl"]):
+        (tmp_path / name).write_bytes(b"x" * 8)
+        os.utime(tmp_path / name, (i, i))
+    assert cache.evict() == ["old.whl"]
+    assert cache.load_manifest("eval-base", "3.11", ["new"]) is None
+
+
+def test_package_cache_refetches_wheels_evicted_before_linking(tmp_path):
+    """Test that a wheel evicted by another build between its manifest lookup and its linking is downloaded again."""
+    cache = PackageCache(str(tmp_path / "wheelhouse"), max_size=1024 ** 3, enabled=True)
+    logger = logging.getLogger("test_package_cache")
+    prefetch = cache.prefetch
+    prefetches = []
+
+    async def prefetch_then_evict(*args):
+        files = await prefetch(*args)
+        if not prefetches:
+            os.remove(os.path.join(cache.wheelhouse_dir, files[0]))  # Another build evicts it
+        prefetches.append(files)
+        return files
+
+    cache.prefetch = prefetch_then_evict
+    layer = asyncio.run(cache.prepare_build_dir(FakeDocker(), "eval-base", "3.11", ["numpy"], str(tmp_path / "build"), logger))
+    assert "UV_FIND_LINKS" in layer and len(prefetches) == 2
+    assert os.listdir(tmp_path / "build" / "wheelhouse") == ["numpy-1.0-py3-none-any.whl"]
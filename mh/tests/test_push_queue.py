@@ -0,0 +1,41 @@
+"""Tests for the background image push queue."""
+import asyncio
+import logging
+
+from mindforge_harness.docker import push_queue
+from mindforge_harness.docker.push_queue import PushQueue
+
+
+def test_push_queue_bounded_retries_and_status(monkeypatch, tmp_path):
+    """Test that pushes run in the background with bounded concurrency, once per image, with retries."""
+    attempts = {}
+    running = 0
+    max_running = 0
+
+    async def fake_push(client, image_name, registry_config, logger, on_progress=None):
+        nonlocal running, max_running
+        attempts[image_name] = attempts.get(image_name, 0) + 1
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        on_progress(1024)
+        running -= 1
+        if image_name == "eval-flaky" and attempts[image_name] < 3:
+            raise Exception("connection reset by peer")
+        if image_name == "eval-broken":
+            raise Exception("denied: requested access to the resource is denied")
+
+    monkeypatch.setattr(push_queue, "push_img_to_registry", fake_push)
+    queue = PushQueue(max_workers=2, retries=2, backoff=0.001)
+
+    async def run():
+        for image_name in ["eval-a", "eval-b", "eval-flaky", "eval-broken", "eval-a"]:
+            queue.submit(None, image_name, {}, str(tmp_path / f"{image_name}.log"))
+        assert all(status["state"] == "queued" for status in queue.status.values())  # Nothing blocks the caller
+        return await queue.join(logging.getLogger("test_push_queue"), interval=0.01)
+
+    status = asyncio.run(run())
+    assert attempts == {"eval-a": 1, "eval-b": 1, "eval-flaky": 3, "eval-broken": 3}
+    assert max_running == 2
+    assert queue.progress() == {"queued": 0, "pushing": 0, "pushed": 3, "failed": 1}
+    assert "denied" in status["eval-broken"]["error"] and status["eval-a"]["bytes"] == 1024
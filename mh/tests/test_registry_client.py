@@ -0,0 +1,47 @@
+"""Tests for the registry catalog client."""
+import asyncio
+
+from aiohttp import web
+
+from mindforge_harness.docker.registry_client import RegistryCatalog
+
+
+def test_registry_catalog_checks_in_parallel_and_caches():
+    """Test that manifest HEAD checks answer per image, only use http when asked to and are cached for the run."""
+    heads = []
+
+    async def head_manifest(request: web.Request):
+        heads.append(request.match_info['name'])
+        assert request.headers['Authorization'].startswith("Basic ")
+        await asyncio.sleep(0.01)
+        if request.match_info['name'] == "eval-foo-1" and request.match_info['tag'] == "latest":
+            return web.Response(status=200)
+        return web.Response(status=404)
+
+    async def run():
+        app = web.Application()
+        app.router.add_route("HEAD", "/v2/{name:.+}/manifests/{tag}", head_manifest)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        host = f"127.0.0.1:{runner.addresses[0][1]}"
+        config = {'registry_url': host, 'registry_user': 'user', 'registry_pass': 'pass'}
+        https_catalog = RegistryCatalog.from_config(config)
+        catalog = RegistryCatalog(host, 'user', 'pass', scheme="http")
+        try:
+            https_answers = await https_catalog.check(["eval-foo-1"], config)
+            first = await catalog.check(["eval-foo-1", "eval-foo-2", "eval-foo-1"], config)
+            second = await catalog.check(["eval-foo-2", "eval-foo-1"], config)
+        finally:
+            await https_catalog.close()
+            await catalog.close()
+            await runner.cleanup()
+        return catalog, https_answers, first, second
+
+    catalog, https_answers, first, second = asyncio.run(run())
+    assert https_answers == {"eval-foo-1": None}  # No fallback to plain http, the credentials stay encrypted
+    assert first == second == {"eval-foo-1": True, "eval-foo-2": False}
+    assert sorted(heads) == ["eval-foo-1", "eval-foo-2"]  # Each image is asked once
+    assert catalog.known_missing("eval-foo-2")
+
@@ -0,0 +1,84 @@
+"""Tests for the git repository cache."""
+import asyncio
+import os
+
+import git
+import pytest
+
+from mindforge_harness.docker.repo_cache import RepoCache
+
+
+def commit_file(repo: git.Repo, name: str, content: str) -> str:
+    """Commit a file into a repository and return the commit hash."""
+    with open(os.path.join(repo.working_dir, name), "w") as f:
+        f.write(content)
+    repo.index.add([name])
+    return repo.index.commit(f"Add {name}").hexsha
+
+
+def test_repo_cache_mirrors_once_and_fetches_new_commits(tmp_path):
+    """Test that concurrent builds share one clone, later runs fetch new commits and failed clones raise."""
+    upstream = git.Repo.init(tmp_path / "remote" / "owner" / "repo")
+    first = commit_file(upstream, "a.py", "a = 1\n")
+    remote_url = f"file://{tmp_path / 'remote'}/{{repo}}"
+
+    cache = RepoCache(str(tmp_path / "cache"), remote_url)
+
+    async def get_twice():
+        return await asyncio.gather(cache.get_repo("owner/repo"), cache.get_repo("owner/repo"))
+
+    paths = asyncio.run(get_twice())
+    assert paths[0] == paths[1] == cache.repo_path("owner/repo")
+    assert os.path.basename(paths[0]) == "owner__repo"
+    assert cache.stats == {"clones": 1, "fetches": 0, "checkouts": 1, "snapshots": 0}
+    assert git.Repo(paths[0]).head.commit.hexsha == first
+    assert git.Repo(paths[0]).remote().url == remote_url.format(repo="owner/repo")
+
+    # A new run fetches only the new commits into the mirror and the working copy
+    second = commit_file(upstream, "b.py", "b = 2\n")
+    cache = RepoCache(str(tmp_path / "cache"), remote_url)
+    path = asyncio.run(cache.get_repo("owner/repo"))
+    assert cache.stats == {"clones": 0, "fetches": 1, "checkouts": 0, "snapshots": 0}
+    assert git.Repo(path).commit(second).hexsha == second
+
+    with pytest.raises(Exception, match="Failed to clone"):
+        asyncio.run(cache.get_repo("owner/missing"))
+    assert not os.path.exists(cache.mirror_path("owner/missing"))
+
+
+def test_repo_cache_snapshots_exact_commits(tmp_path):
+    """Test that snapshots check out the requested commit, keep the asked history and are removed on exit."""
+    upstream = git.Repo.init(tmp_path / "remote" / "owner" / "repo")
+    first = commit_file(upstream, "a.py", "a = 1\n")
+    second = commit_file(upstream, "a.py", "a = 2\n")
+    cache = RepoCache(str(tmp_path / "cache"), f"file://{tmp_path / 'remote'}/{{repo}}")
+
+    async def check_snapshots():
+        async with cache.snapshot("owner/repo", first[:10], depth=0) as snapshot:
+            path = await snapshot.checkout()
+            assert os.path.basename(path) == "owner__repo"
+            assert snapshot.revision.startswith(first)
+            assert snapshot.read_file("a.py") == "a = 1\n" and snapshot.read_file("missing.py") is None
+            with open(os.path.join(path, "a.py")) as f:
+                assert f.read() == "a = 1\n"
+            # The whole history is kept, so any commit can be checked out in the image
+            assert git.Repo(path).commit(second).hexsha == second
+        assert not os.path.exists(path)
+
+        async with cache.snapshot("owner/repo", depth=1) as snapshot:
+            repo = git.Repo(await snapshot.checkout())
+            assert snapshot.revision == f"{second}-depth1"
+            assert repo.head.commit.hexsha == second
+            assert [c.hexsha for c in repo.iter_commits()] == [second]
+
+        with pytest.raises(Exception, match="not found"):
+            async with cache.snapshot("owner/repo", "0" * 40):
+                pass
+
+        # A snapshot that is not used is not checked out
+        async with cache.snapshot("owner/repo") as snapshot:
+            assert snapshot.commit == second
+        assert not os.path.exists(os.path.dirname(snapshot.path))
+
+    asyncio.run(check_snapshots())
+    assert cache.stats["clones"] == 1 and cache.stats["snapshots"] == 2
@@ -0,0 +1,61 @@
+"""Tests for the requirements resolver."""
+import asyncio
+import os
+
+import git
+from aiohttp import web
+
+from mindforge_harness.docker.repo_cache import RepoCache
+from mindforge_harness.requirements_resolver import RequirementsResolver
+
+
+def test_requirements_resolver_reads_mirror_then_http_and_caches(tmp_path):
+    """Test that includes are followed in order, files come from the mirror or HTTP, and are cached on disk."""
+    upstream = git.Repo.init(tmp_path / "remote" / "owner" / "repo")
+    files = {
+        "requirements.txt": "numpy>=1.20\n-r tests/requirements.txt\n-r docs/requirements.txt\n# comment\n-e .\n",
+        "tests/requirements.txt": "pytest\n-r ../requirements.txt\n",
+        "docs/requirements.txt": "sphinx\n",
+    }
+    for name, content in files.items():
+        os.makedirs(os.path.dirname(os.path.join(upstream.working_dir, name)), exist_ok=True)
+        with open(os.path.join(upstream.working_dir, name), "w") as f:
+            f.write(content)
+    upstream.index.add(list(files))
+    commit = upstream.index.commit("Add requirements").hexsha
+
+    repo_cache = RepoCache(str(tmp_path / "cache"), f"file://{tmp_path / 'remote'}/{{repo}}")
+    downloads = []
+
+    async def raw_file(request: web.Request):
+        downloads.append(request.match_info['path'])
+        return web.Response(text="requests\n" if request.match_info['path'] == "requirements-dev.txt" else "", status=200)
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/{repo:[^/]+/[^/]+}/{commit}/{path:.+}", raw_file)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        url = f"http://127.0.0.1:{runner.addresses[0][1]}/{{repo}}/{{commit}}/{{path}}"
+        resolver = RequirementsResolver(str(tmp_path / "requirements"), repo_cache, url)
+        try:
+            await repo_cache.get_repo("owner/repo")
+            from_mirror = await resolver.resolve("owner/repo", ["requirements.txt"], commit)
+            from_http = await resolver.resolve("other/repo", ["requirements-dev.txt"], commit)
+            stats = dict(resolver.stats)
+            many = await resolver.resolve_many([("other/repo", ["requirements-dev.txt"], commit), ("owner/repo", ["requirements.txt"], commit)])
+            cached = await RequirementsResolver(str(tmp_path / "requirements"), repo_cache, url).resolve(
+                "owner/repo", ["./requirements.txt"], commit)
+        finally:
+            await resolver.close()
+            await runner.cleanup()
+        return from_mirror, from_http, stats, cached, many
+
+    from_mirror, from_http, stats, cached, many = asyncio.run(run())
+    assert from_mirror == cached == ["numpy>=1.20", "pytest", "sphinx"]
+    assert many == [from_http, from_mirror]
+    assert from_http == ["requests"]
+    assert stats == {"cache": 0, "mirror": 3, "http": 1}
+    assert downloads == ["requirements-dev.txt"]
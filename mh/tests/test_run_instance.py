@@ -0,0 +1,42 @@
+"""Tests for the phases of the evaluation script."""
+import logging
+import subprocess
+
+import orjson
+
+from mindforge_harness.docker.consts import PHASE_MARKERS
+from mindforge_harness.evaluate import summarize_phases
+from mindforge_harness.run_instance import DEFAULT_PIPELINE
+
+
+def test_phases_are_marked_gathered_and_summarized(tmp_path):
+    """Test that the phase markers are parsed into the results, and summarized with their percentiles."""
+    eval_script = DEFAULT_PIPELINE.format_eval_script(["test_a.py::test_a"], "pytest", [], "pip install -e .", 60, "python3.11", False)
+    for phase in ["checkout", "patch", "install", "tests"]:
+        assert f"phase_start {phase}\n" in eval_script and f"phase_end {phase} $?\n" in eval_script
+    assert "phase_start eval_commands\n" in eval_script and "phase_end eval_commands $eval_rc\n" in eval_script
+
+    # The eval_commands phase ends with the status of its first failed command, not of its last one
+    eval_commands = DEFAULT_PIPELINE.format_template_vars([], "pytest", ["(exit 3)", "(exit 4)", "true"], "pip install -e .", 60, "python3.11", False)["eval_commands"]
+    status = subprocess.run(["bash", "-c", f"eval_rc=0\n{eval_commands}\nexit $eval_rc"])
+    assert status.returncode == 3
+
+    (tmp_path / "results").mkdir()
+    markers = PHASE_MARKERS.format().replace("/results", str(tmp_path / "results"))
+    subprocess.run(["bash", "-c", markers + "phase_start install\nfalse\nphase_end install $?\nphase_start tests\ntrue\nphase_end tests $?\nphase_start tests_again\n"], check=True)
+    (tmp_path / "results" / "pytest_report.json").write_bytes(orjson.dumps({"tests": [{"nodeid": "test_a.py::test_a", "outcome": "passed"}]}))
+
+    phases = DEFAULT_PIPELINE.gather_phases(str(tmp_path))
+    assert phases["install"]["exit_code"] == 1 and phases["tests"]["exit_code"] == 0
+    assert phases["tests"]["seconds"] >= 0 and "seconds" not in phases["tests_again"]
+    logger = logging.getLogger("test_run_instance")
+    assert DEFAULT_PIPELINE.gather_results(str(tmp_path), logger, ["test_a.py::test_a"]) == {"test_a.py::test_a": True}
+    assert DEFAULT_PIPELINE.gather_results(str(tmp_path), logger, ["test_a.py::test_a"], short=False)["phases"] == phases
+
+    results = {
+        f"instance-{i}": {"tests": {}, "phases": {"install": {"seconds": float(i), "exit_code": int(i == 19)}}}
+        for i in range(1, 21)
+    }
+    results["instance-error"] = {"error": "Timeout", "phases": {"install": {"start": 0.0}}}
+    summary = summarize_phases(results)
+    assert summary == {"install": {"count": 20, "failures": 1, "p50": 10.0, "p95": 19.0, "total": 210.0}}
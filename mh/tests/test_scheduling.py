@@ -0,0 +1,65 @@
+"""Tests for the scheduling policies."""
+import asyncio
+import logging
+
+from mindforge_harness import scheduling
+from mindforge_harness.scheduling import AdaptiveLimiter, group_by_affinity
+
+
+def test_group_by_affinity_groups_by_image_commit_and_install():
+    """Test that instances are grouped by image, commit and install, split by size, largest groups first."""
+    spec = {"python": "3.11", "install": "pip install -e ."}
+    instances = [
+        {"instance_id": f"a-{i}", "repo": "owner/a", "base_commit": "abc", "spec_dict": spec}
+        for i in range(5)
+    ] + [
+        {"instance_id": "a-other-commit", "repo": "owner/a", "base_commit": "def", "spec_dict": spec},
+        {"instance_id": "a-other-install", "repo": "owner/a", "base_commit": "abc", "spec_dict": {**spec, "install": "pip install ."}},
+        {"instance_id": "b-0", "repo": "owner/b", "base_commit": "abc", "spec_dict": spec},
+        {"instance_id": "b-1", "repo": "owner/b", "base_commit": "abc", "spec_dict": spec},
+        {"instance_id": "no-spec-0", "repo": "owner/b", "base_commit": "abc"},
+        {"instance_id": "no-spec-1", "repo": "owner/b", "base_commit": "abc"},
+    ]
+    groups = [[instance["instance_id"] for instance in group] for group in group_by_affinity(instances, max_group_size=3)]
+    assert groups[:3] == [["a-0", "a-1", "a-2"], ["a-3", "a-4"], ["b-0", "b-1"]]
+    assert sorted(groups[3:]) == [["a-other-commit"], ["a-other-install"], ["no-spec-0"], ["no-spec-1"]]
+
+
+def test_adaptive_limiter_grows_additively_and_shrinks_multiplicatively(monkeypatch):
+    """Test that the limit grows by one while runs wait, halves on congestion, and stays within its bounds."""
+    load = {"value": 0.5}
+    monkeypatch.setattr(scheduling, "get_host_load", lambda: load["value"])
+    limiter = AdaptiveLimiter(2, 8, max_latency=1.0, max_timeout_rate=0.1, max_load=1.5)
+    logger = logging.getLogger("test_scheduling")
+
+    async def run():
+        async with limiter:
+            async with limiter:
+                waiter = asyncio.create_task(limiter.__aenter__())
+                await asyncio.sleep(0.01)
+                assert not waiter.done()  # At the limit
+                assert await limiter.adjust(0.1, logger) == 3
+                await waiter
+                await limiter.__aexit__()
+        assert await limiter.adjust(0.1, logger) == 3  # Nobody waited
+        for _ in range(8):
+            limiter.waited = True
+            await limiter.adjust(0.1, logger)
+        assert limiter.limit == 8  # Bounded by max_limit
+
+        assert await limiter.adjust(5.0, logger) == 4  # Slow Docker API
+        for _ in range(9):
+            limiter.record(timed_out=False)
+        limiter.record(timed_out=True)
+        limiter.waited = True
+        assert await limiter.adjust(0.1, logger) == 5  # 10% of timeouts is tolerated
+        for _ in range(3):
+            limiter.record(timed_out=True)
+        assert await limiter.adjust(0.1, logger) == 2
+        load["value"] = 2.0
+        assert await limiter.adjust(0.1, logger) == 2  # Bounded by min_limit
+
+    asyncio.run(run())
+    summary = limiter.summary()
+    assert (summary["min"], summary["max"], summary["final"]) == (2, 8, 2)
+    assert [change["limit"] for change in summary["history"]] == [2, 3, 4, 5, 6, 7, 8, 4, 5, 2]
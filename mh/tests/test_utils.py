@@ -1,5 +1,16 @@
 """Tests for the utility functions in mindforge_harness.utils."""
-from mindforge_harness.utils import extract_missing_tests, extract_modified_test_files
+import io
+import tarfile
+
+from mindforge_harness.utils import (
+    canonicalize_spec_dict,
+    create_tarball,
+    extract_missing_tests,
+    extract_modified_test_files,
+    get_image_name,
+    is_ignored,
+    prepare_dataset_for_evaluation,
+)
 
 
 def test_extract_missing_tests():
@@ -107,4 +118,76 @@ new file mode 100644
         [
             "tests/test_resourcegroupstaggingapi/test_resourcegroupstagging_glue.py"
         ]
-    )
\ No newline at end of file
+    )
+
+def test_create_tarball_streams_filtered_gzip(tmp_path):
+    """Test that the build context is a gzip stream that leaves out ignored files."""
+    build_dir = tmp_path / "build"
+    build_dir.mkdir()
+    (build_dir / "Dockerfile").write_text("FROM scratch\n")
+    repo = tmp_path / "repo"
+    (repo / ".git").mkdir(parents=True)
+    (repo / ".git" / "HEAD").write_text("ref: refs/heads/main\n")
+    (repo / "pkg" / "__pycache__").mkdir(parents=True)
+    (repo / "pkg" / "__pycache__" / "mod.cpython-311.pyc").write_bytes(b"\0")
+    (repo / "pkg" / "mod.py").write_text("x = 1\n" * 50000)
+    (repo / "debug.log").write_text("noise")
+    (repo / "keep.log").write_text("signal")
+    (repo / ".dockerignore").write_text("# logs\n*.log\n!keep.log\n")
+
+    stream = create_tarball(str(build_dir), str(repo))
+    chunks = []
+    while chunk := stream.read(8192):
+        assert len(chunk) <= 8192
+        chunks.append(chunk)
+
+    with tarfile.open(fileobj=io.BytesIO(b"".join(chunks)), mode="r:gz") as tar:
+        names = set(tar.getnames())
+        assert tar.extractfile("repo/pkg/mod.py").read() == b"x = 1\n" * 50000
+    assert names == {"Dockerfile", "repo/.dockerignore", "repo/.git/HEAD", "repo/pkg/mod.py", "repo/keep.log"}
+
+
+def test_is_ignored():
+    """Test the `.dockerignore`-style matching."""
+    patterns = ["**/__pycache__", "docs", "*.log", "!keep.log"]
+    assert is_ignored("__pycache__/a.pyc", patterns)
+    assert is_ignored("src/pkg/__pycache__/a.pyc", patterns)
+    assert is_ignored("docs/index.md", patterns)
+    assert is_ignored("debug.log", patterns)
+    assert not is_ignored("keep.log", patterns)
+    assert not is_ignored("src/docs.py", patterns)
+    # As in Docker, `*` does not cross directories, only `**` does
+    assert not is_ignored("tests/requirements.txt", ["*.txt"])
+    assert is_ignored("requirements.txt", ["*.txt"])
+    assert is_ignored("tests/requirements.txt", ["**/*.txt"])
+    assert is_ignored("a/b/c/d.txt", ["a/**/d.txt"]) and is_ignored("a/d.txt", ["a/**/d.txt"])
+    assert not is_ignored("a/b/d.txt", ["a/*.txt"])
+    assert is_ignored("a/b/d.txt", ["a/*"])
+
+
+def test_equivalent_specs_share_one_image():
+    """Test that specs differing only in package order, duplicates and spellings are interned into one image."""
+    spec_a = {'python': 'python3.9', 'pip_packages': ['Foo==1.0', 'requests[Socks,security] >= 2.0, <3', 'foo == 1.0'], 'test_cmd': 'pytest'}
+    spec_b = {'python': '3.9', 'pip_packages': ['requests[security,socks]<3,>=2.0', 'foo==1.0'], 'test_cmd': 'pytest'}
+    spec_c = {'python': '3.10', 'pip_packages': ['foo==1.0'], 'test_cmd': 'pytest'}
+    raw_dataset = [
+        {'instance_id': f'i{i}', 'repo': 'encode/httpx', 'base_commit': 'abc', 'test_patch': '', 'patch': '',
+         'PASS_TO_PASS': [], 'FAIL_TO_PASS': [], 'spec_dict': spec}
+        for i, spec in enumerate([spec_a, spec_b, spec_c])
+    ]
+
+    dataset = prepare_dataset_for_evaluation(raw_dataset)
+    assert canonicalize_spec_dict(spec_a)['pip_packages'] == ['foo==1.0', 'requests[security,socks]<3,>=2.0']
+    assert dataset['i0']['spec_dict'] is dataset['i1']['spec_dict']
+    assert dataset['i0']['image_name'] == dataset['i1']['image_name'] == get_image_name('encode/httpx', spec_b)
+    assert dataset['i2']['image_name'] != dataset['i0']['image_name']
+    assert spec_a['pip_packages'][0] == 'Foo==1.0'  # The raw dataset is left untouched
+
+
+def test_canonicalize_spec_dict_keeps_pip_options_in_order():
+    """Test that pip options and their arguments are kept first and in order, while the requirements are sorted."""
+    pip_packages = ['torch==2.0', '-f', 'https://example.com/wheels', 'numpy', '--extra-index-url', 'https://a.org/simple', '--extra-index-url', 'https://b.org/simple', '--pre', 'Numpy']
+    assert canonicalize_spec_dict({'pip_packages': pip_packages})['pip_packages'] == [
+        '-f', 'https://example.com/wheels', '--extra-index-url', 'https://a.org/simple',
+        '--extra-index-url', 'https://b.org/simple', '--pre', 'numpy', 'torch==2.0',
+    ]